@@ -0,0 +1,135 @@
+import os
+import sys
+import contextlib
+import pytest
+
+# umls_mapping を import できるようにする(brat では server/src に置くので、normdb, message は brat の server/src から import する)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# テスト用のリソースに入れる合成概念の数(benchmark_data の概念に加える)
+N_SYNTHETIC_CONCEPTS = 300
+
+
+@pytest.fixture
+def tu(tmp_path, monkeypatch):
+    """
+    tmp_path/resource に benchmark_data の概念と合成した概念の UMLS_synonyms.txt を作り、text2umls をそこに向ける。
+    検索エンジンは numpy だけで動く ngram_index、翻訳は benchmark_data の対訳辞書を使う。
+    設定はテストごとに元に戻す。
+    """
+    pytest.importorskip('normdb', reason='brat の server/src が必要')
+    from umls_mapping import text2umls
+    from umls_mapping import benchmark
+    resource_path = str(tmp_path / 'resource')
+    settings = {
+        'UMLS_DB_PATH': resource_path,
+        'SEARCH_ENGINE': 'ngram_index',
+        'TRANSLATOR_BACKEND': 'dictionary',
+        'ENTITY_SEMANTIC_TYPES': {},
+        'SEARCH_TOP_K': 0,
+        'EXACT_MATCH_MIN_CUIS': 1,
+        'USE_CONCEPT_STORE': True,
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(text2umls, name, value)
+    benchmark.build_fixture(resource_path, N_SYNTHETIC_CONCEPTS)
+    return text2umls
+
+
+def init_db(tu):
+    """init_db_cpp を実行する(進捗の表示は捨てる)"""
+    with open(os.devnull, mode='w') as devnull, contextlib.redirect_stdout(devnull):
+        tu.init_db_cpp()
+
+
+@pytest.fixture
+def searcher(tu):
+    """init_db したリソースの searcher"""
+    init_db(tu)
+    searcher = tu.load_dct()
+    yield searcher
+    searcher.close()
+
+
+
+class FlakyBackend(object):
+    """down の間は翻訳に失敗する対訳辞書"""
+    def __init__(self, backend):
+        self.backend = backend
+        self.down = False
+
+    @property
+    def version(self):
+        return self.backend.version
+
+    def translate_many(self, texts, src='ja', dest='en', timeout=None):
+        from umls_mapping.translation import TranslationError
+        if self.down:
+            return {}, {text: TranslationError('service unavailable: %s' % text) for text in texts}
+        return self.backend.translate_many(texts, src=src, dest=dest, timeout=timeout)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def mapper(tu, monkeypatch):
+    """
+    テスト用のリソースの UmlsMapper。翻訳は FlakyBackend(mapper.backend)で行う。
+    失敗した語もすぐに問い合わせ直す。UmlsMapper のクラス変数はテストの後で元に戻す
+    """
+    from umls_mapping import translation
+    from umls_mapping.word2umls import UmlsMapper
+    monkeypatch.setattr(translation, 'FAILURE_CACHE_SECONDS', 0.0)
+    monkeypatch.setattr(translation, 'BREAKER_FAILURES', 1000)
+    for name in ('_UmlsMapper__instance', 'searcher', 'test_value_index', 'result_cache', 'prefetcher',
+                 'resource_version', 'resource_checked_at', '_in_use'):
+        monkeypatch.setattr(UmlsMapper, name, getattr(UmlsMapper, name))
+    monkeypatch.setattr(UmlsMapper, '_in_use', {})
+    init_db(tu)
+    UmlsMapper()
+    backend = FlakyBackend(UmlsMapper.searcher.translator.backend)
+    UmlsMapper.searcher.translator = translation.CachedTranslator(backend)
+    UmlsMapper.backend = backend
+    yield UmlsMapper
+    UmlsMapper.close()
+    del UmlsMapper.backend
+
+
+# write_rrf で作る MRCONSO の行の候補: (LAT, TS, SAB, TTY, STR, SUPPRESS)
+RRF_TERMS = [
+    ('ENG', 'P', 'MSH', 'MH', 'Term {n}', 'N'),
+    ('ENG', 'S', 'SNOMEDCT_US', 'PT', 'term  {n};  disorder', 'N'),
+    ('ENG', 'S', 'MTH', 'SY', 'TERM {n}', 'O'),
+    ('ENG', 'S', 'LNC', 'LN', 'a very long laboratory term name {n} ' + 'x' * 60, 'N'),
+    ('JPN', 'P', 'MDRJPN', 'PT', '用語{n}', 'N'),
+    ('JPN', 'S', 'MSHJPN', 'SY', '用語{n}（ＡＢＣ）', 'N'),
+    ('JPN', 'S', 'MDRJPN', 'LLT', 'ﾖｳｺﾞ{n}', 'N'),
+    ('FRE', 'P', 'MSHFRE', 'MH', 'terme {n}', 'N'),
+]
+RRF_SEMANTIC_TYPES = ['Finding', 'Disease or Syndrome', 'Laboratory Procedure', 'Organic Chemical']
+
+
+def write_rrf(data_root, n_cuis=300, seed=0):
+    """
+    data_root に MRCONSO.RRF, MRDEF.RRF, MRSTY.RRF を作る(どれも CUI 順)。同じ seed なら同じ内容になる。
+    CUI ごとの行数、言語、SAB, 定義と SemanticType の有無はばらばらにする
+    """
+    import random
+    rnd = random.Random(seed)
+    os.makedirs(data_root, exist_ok=True)
+    with open(os.path.join(data_root, 'MRCONSO.RRF'), mode='w', encoding='utf_8', newline='\n') as conso, \
+            open(os.path.join(data_root, 'MRDEF.RRF'), mode='w', encoding='utf_8', newline='\n') as mrdef, \
+            open(os.path.join(data_root, 'MRSTY.RRF'), mode='w', encoding='utf_8', newline='\n') as mrsty:
+        for i in range(n_cuis):
+            cui = 'C%07d' % (i * 7 + 1)
+            n = rnd.randint(0, 50)
+            for j, (lat, ts, sab, tty, string, suppress) in enumerate(rnd.sample(RRF_TERMS, rnd.randint(1, 6))):
+                fields = [cui, lat, ts, 'L1', 'PF', 'S1', 'Y', 'A%d' % j, '', '', '', sab, tty, 'X', string.format(n=n),
+                          '0', suppress, '']
+                conso.write('|'.join(fields) + '|\n')
+            for source in rnd.sample(['MSH', 'NCI', 'CSP'], rnd.randint(0, 2)):
+                mrdef.write('|'.join([cui, 'A1', 'AT1', '', source, 'definition of\t%s by %s' % (cui, source), 'N', '']) + '|\n')
+            for sty in rnd.sample(RRF_SEMANTIC_TYPES, rnd.randint(0, 2)):
+                mrsty.write('|'.join([cui, 'T000', 'A1', sty, 'AT1', '']) + '|\n')
+    return data_root
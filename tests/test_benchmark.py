@@ -0,0 +1,83 @@
+import io
+import os
+import sys
+import json
+import filecmp
+import pytest
+
+pytest.importorskip('normdb', reason='brat の server/src が必要')
+from umls_mapping import benchmark
+
+
+def test_percentile_and_summarize():
+    assert benchmark.percentile([], 50) is None
+    assert benchmark.percentile([1.0], 99) == 1.0
+    assert benchmark.percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert benchmark.percentile([0.0, 10.0], 95) == pytest.approx(9.5)
+    summary = benchmark.summarize([0.003, 0.001, 0.002])
+    assert summary['count'] == 3
+    assert summary['p50_ms'] == pytest.approx(2.0) and summary['max_ms'] == pytest.approx(3.0)
+    assert summary['throughput'] == pytest.approx(500.0)
+    assert benchmark.summarize([])['p95_ms'] is None
+
+
+def test_fixture_is_reproducible(tmp_path):
+    n_rows = benchmark.build_fixture(str(tmp_path / 'a'), 100, seed=1)
+    assert benchmark.build_fixture(str(tmp_path / 'b'), 100, seed=1) == n_rows
+    assert filecmp.cmp(str(tmp_path / 'a' / 'UMLS_synonyms.txt'), str(tmp_path / 'b' / 'UMLS_synonyms.txt'),
+                       shallow=False)
+    benchmark.build_fixture(str(tmp_path / 'c'), 100, seed=2)
+    assert not filecmp.cmp(str(tmp_path / 'a' / 'UMLS_synonyms.txt'), str(tmp_path / 'c' / 'UMLS_synonyms.txt'),
+                           shallow=False)
+    with open(str(tmp_path / 'a' / 'UMLS_synonyms.txt'), mode='r', encoding='utf_8') as f:
+        assert sum(1 for _ in f) - 1 == n_rows
+
+
+def run_main(monkeypatch, capsys, args):
+    monkeypatch.setattr(sys, 'argv', ['benchmark.py'] + args)
+    capsys.readouterr()
+    benchmark.main()
+    return capsys.readouterr().out
+
+
+@pytest.fixture
+def small_run(tu, monkeypatch):
+    # run() が書き換える設定はテストの後で元に戻す
+    for name in ('NGRAM', 'SEARCH_THRESHOLD'):
+        monkeypatch.setattr(tu, name, getattr(tu, name))
+    return ['--concepts', '50', '--repeat', '1', '--warmup', '0', '--init_repeat', '1']
+
+
+def test_report(tmp_path, monkeypatch, capsys, small_run):
+    output = str(tmp_path / 'report.json')
+    run_main(monkeypatch, capsys, small_run + ['--stages', '--work_dir', str(tmp_path / 'work'), '--output', output])
+    with open(output, mode='r', encoding='utf_8') as f:
+        report = json.load(f)
+    n_queries = len(benchmark.read_queries(os.path.join(benchmark.BENCHMARK_DATA_DIR, benchmark.QUERIES_NAME)))
+    assert report['config']['queries'] == n_queries
+    assert report['config']['concepts'] == 50 and report['config']['engine'] == 'ngram_index'
+    results = report['results']
+    assert results['word2UMLS']['count'] == n_queries
+    assert results['word2UMLS_many']['count'] == 1
+    assert results['init_db_cpp']['count'] == 1
+    assert results['ranked_search']['mean_candidates'] > 0
+    assert report['word2UMLS_stages']['queries'] == n_queries
+    assert set(report['word2UMLS_by_category']) <= set(category for category, _ in benchmark.read_queries(
+        os.path.join(benchmark.BENCHMARK_DATA_DIR, benchmark.QUERIES_NAME)))
+    # --work_dir のリソースは残す
+    assert os.path.exists(str(tmp_path / 'work' / 'resource' / 'UMLS_synonyms.txt'))
+    printed = io.StringIO()
+    benchmark.print_report(report, file=printed)
+    assert 'word2UMLS stage' in printed.getvalue() and 'spans/sec' in printed.getvalue()
+
+
+def test_compare_profiles(tmp_path, monkeypatch, capsys, small_run):
+    paths = []
+    for name, n_concepts in (('full', 200), ('small', 20)):
+        benchmark.build_fixture(str(tmp_path / name), n_concepts)
+        paths.append(str(tmp_path / name / 'UMLS_synonyms.txt'))
+    printed = run_main(monkeypatch, capsys, small_run + ['--synonyms'] + paths + ['--output', '-'])
+    reports = json.loads(printed)['profiles']
+    assert [report['config']['synonyms'] for report in reports] == paths
+    assert reports[0]['config']['synonym_rows'] > reports[1]['config']['synonym_rows']
+    assert reports[0]['config']['index_bytes'] > reports[1]['config']['index_bytes']
@@ -0,0 +1,80 @@
+import os
+import sys
+import pytest
+from conftest import init_db
+
+UNKNOWN = ('C0439673', (5.0, 'unknown', 'Qualitative Concept', 'Unknown', 0))
+HEADACHE = ('C0018681', (4.0, '頭痛', 'Sign or Symptom', '頭痛', 0))
+FRACTURE = ('C0016658', (3.0, '骨折', 'Injury or Poisoning', '骨折', 1))
+FEMUR = ('C0015811', (3.0, '大腿骨', 'Body Part, Organ, or Organ Component', '大腿骨', 0))
+
+
+@pytest.fixture
+def bulk_link(tu):
+    from umls_mapping import bulk_link
+    return bulk_link
+
+
+def test_rank_candidates(bulk_link):
+    scored_concept = [FEMUR, UNKNOWN, HEADACHE, FRACTURE]
+    # score, in_use の降順。Unknown は除く
+    assert bulk_link.rank_candidates(scored_concept) == [HEADACHE, FRACTURE, FEMUR]
+
+
+def test_rank_candidates_keep_unknown(bulk_link):
+    # 他の候補があれば Unknown の score が高くても使わない
+    assert bulk_link.rank_candidates([UNKNOWN, HEADACHE], keep_unknown=True) == [HEADACHE]
+    # 他に候補が無いときだけ Unknown を返す
+    assert bulk_link.rank_candidates([UNKNOWN], keep_unknown=True) == [UNKNOWN]
+    assert bulk_link.rank_candidates([UNKNOWN]) == []
+    assert bulk_link.rank_candidates([], keep_unknown=True) == []
+
+
+def write_collection(data_dir):
+    os.makedirs(os.path.join(data_dir, 'sub'))
+    with open(os.path.join(data_dir, 'annotation.conf'), mode='w', encoding='utf_8') as f:
+        f.write('[entities]\nFinding\n')
+    text = '頭痛 と 大腿骨頸部骨折 と xqzvw'
+    with open(os.path.join(data_dir, 'sub', 'doc.txt'), mode='w', encoding='utf_8') as f:
+        f.write(text)
+    ann = ['T1\tFinding 0 2\t頭痛',
+           'T2\tFinding 5 12\t大腿骨頸部骨折',
+           'T3\tFinding 15 20\txqzvw',
+           'T4\tFinding 5 8\t大腿骨',
+           'N1\tReference T4 UMLS:C0000000\tmanual']
+    with open(os.path.join(data_dir, 'sub', 'doc.ann'), mode='w', encoding='utf_8') as f:
+        f.write(''.join(line + '\n' for line in ann))
+    return ann
+
+
+@pytest.mark.parametrize('keep_unknown', [False, True])
+def test_bulk_link(tu, bulk_link, tmp_path, monkeypatch, keep_unknown):
+    init_db(tu)
+    data_dir, output_dir = str(tmp_path / 'data'), str(tmp_path / 'linked')
+    ann = write_collection(data_dir)
+    argv = ['bulk_link.py', '--data_dir', data_dir, '--output_dir', output_dir, '--workers', '1', '--candidates', '2']
+    if keep_unknown:
+        argv.append('--keep_unknown')
+    monkeypatch.setattr(sys, 'argv', argv)
+    bulk_link.main()
+
+    with open(os.path.join(output_dir, 'sub', 'doc.ann'), encoding='utf_8') as f:
+        lines = f.read().splitlines()
+    # 元の行はそのまま残し、正規化済みの T4 以外に N 行と AnnotatorNotes 行を足す
+    assert lines[:len(ann)] == ann
+    added = lines[len(ann):]
+    normalizations = [line for line in added if line.startswith('N')]
+    assert normalizations[:2] == ['N2\tReference T1 UMLS:C0018681\t頭痛',
+                                  'N3\tReference T2 UMLS:C0015806\t大腿骨頸部骨折']
+    if keep_unknown:
+        # 候補が見つからない span だけ Unknown にする
+        assert normalizations[2:] == ['N4\tReference T3 UMLS:C0439673\tUnknown']
+    else:
+        assert normalizations[2:] == []
+    notes = [line for line in added if line.startswith('#')]
+    assert len(notes) == len(normalizations)
+    assert notes[0].startswith('#1\tAnnotatorNotes T1\tC0018681 頭痛 (')
+    assert all('C0439673' not in note for note in notes[:2])
+    assert os.path.exists(os.path.join(output_dir, 'annotation.conf'))
+    with open(os.path.join(output_dir, 'sub', 'doc.txt'), encoding='utf_8') as f:
+        assert f.read() == '頭痛 と 大腿骨頸部骨折 と xqzvw'
@@ -0,0 +1,50 @@
+import threading
+from umls_mapping.cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=3)
+    for key in 'abc':
+        cache.put(key, key.upper())
+    # 参照した a は新しくなるので、次に追い出されるのは b
+    assert cache.get('a') == 'A'
+    cache.put('d', 'D')
+    assert 'b' not in cache and len(cache) == 3
+    # 上書きも参照と同じく新しくする
+    cache.put('c', 'C2')
+    cache.put('e', 'E')
+    assert 'a' not in cache
+    assert cache.values() == ['D', 'C2', 'E']
+    assert cache.get('missing', 0) == 0
+
+
+def test_stats():
+    cache = LRUCache(maxsize=2)
+    assert cache.stats()['hit_rate'] == 0.0
+    cache.put(1, 'x')
+    cache.get(1)
+    cache.get(1)
+    cache.get(2)
+    cache.put(2, 'y')
+    cache.put(3, 'z')
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1, 'evictions': 1, 'hit_rate': 2 / 3}
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['hits'] == 2
+
+
+def test_concurrent_puts_stay_bounded():
+    cache = LRUCache(maxsize=50)
+
+    def work(offset):
+        for i in range(1000):
+            cache.put(offset + i, i)
+            cache.get(offset + i // 2)
+    threads = [threading.Thread(target=work, args=(n * 10000,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['size'] == 50
+    assert stats['evictions'] == 8 * 1000 - 50
+    assert stats['hits'] + stats['misses'] == 8 * 1000
@@ -0,0 +1,65 @@
+import os
+import random
+import sqlite3
+import pytest
+
+
+def all_synonyms(tu):
+    connection = sqlite3.connect(os.path.join(tu.resource_dir(), tu.SYNONYMS_DB_NAME))
+    synonyms = [row[0] for row in connection.execute('SELECT DISTINCT synonym FROM umls_synonyms')]
+    connection.close()
+    return synonyms
+
+
+def name_samples(synonyms, n_samples=200, seed=0):
+    rnd = random.Random(seed)
+    samples = [[], ['存在しない synonym'], synonyms]
+    for _ in range(n_samples):
+        names = rnd.sample(synonyms, rnd.randint(1, 40))
+        # 重複、無い文字列、空文字列も混ぜる
+        samples.append(names + names[:3] + ['zzqx', ''])
+    return samples
+
+
+def sql_rows(searcher, names):
+    concepts, searcher.concepts = searcher.concepts, None
+    try:
+        return searcher.ids_by_names(names)
+    finally:
+        searcher.concepts = concepts
+
+
+def test_store_is_used(searcher):
+    assert searcher.concepts is not None
+
+
+def test_rows_and_order_same_as_sql(tu, searcher):
+    for names in name_samples(all_synonyms(tu)):
+        assert searcher.ids_by_names(names) == sql_rows(searcher, names)
+
+
+@pytest.mark.parametrize('semantic_types', [['Finding'], ['Laboratory Procedure', 'Disease or Syndrome'],
+                                            ['Organic Chemical']])
+def test_scoped_rows_same_as_sql(tu, searcher, semantic_types):
+    scoped = searcher.scoped(semantic_types)
+    for names in name_samples(all_synonyms(tu), n_samples=50):
+        assert scoped.ids_by_names(names) == sql_rows(scoped, names)
+
+
+def test_hash_collisions(tu, searcher, monkeypatch):
+    from umls_mapping import concept_store
+    hashes = concept_store.string_hashes
+    # ハッシュを 16 通りにして、衝突した synonym を文字列で見分けられるか確かめる
+    monkeypatch.setattr(concept_store, 'string_hashes', lambda encoded: hashes(encoded) & 0xF)
+    tu.build_concept_store()
+    searcher.concepts = tu.open_concept_store(tu.resource_dir())
+    for names in name_samples(all_synonyms(tu), n_samples=50):
+        assert searcher.ids_by_names(names) == sql_rows(searcher, names)
+
+
+def test_stale_store_is_ignored(tu, searcher):
+    connection = sqlite3.connect(os.path.join(tu.resource_dir(), tu.SYNONYMS_DB_NAME))
+    connection.execute("DELETE FROM umls_synonyms WHERE synonym = 'blood pressure'")
+    connection.commit()
+    connection.close()
+    assert tu.open_concept_store(tu.resource_dir()) is None
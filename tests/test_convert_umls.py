@@ -0,0 +1,175 @@
+import os
+import sys
+import csv
+import json
+import subprocess
+import pytest
+from conftest import write_rrf
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_tool(name, args, cwd):
+    """umls_tools の変換スクリプトを cwd で実行する"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'umls_tools', name)] + args, cwd=cwd, env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+def convert_umls2simstring(tmp_path, data_root, name, args):
+    """
+    convert_umls2simstring.py を実行して、UMLS_synonyms.txt の行と build_profile.json を返す。
+    出力先は実行ディレクトリの 2 つ上の server/src/umls_mapping/resource
+    """
+    pytest.importorskip('normdb', reason='brat の server/src が必要')
+    work_dir = tmp_path / name
+    resource_path = work_dir / 'server' / 'src' / 'umls_mapping' / 'resource'
+    resource_path.mkdir(parents=True)
+    cwd = work_dir / 'a' / 'b'
+    cwd.mkdir(parents=True)
+    run_tool('convert_umls2simstring.py', ['--data_root', data_root] + args, str(cwd))
+    with open(str(resource_path / 'UMLS_synonyms.txt'), mode='r', encoding='utf_8') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    with open(str(resource_path / 'build_profile.json'), mode='r', encoding='utf_8') as f:
+        build_profile = json.load(f)
+    return rows, build_profile
+
+
+def import_tool(name):
+    pytest.importorskip('normdb', reason='brat の server/src が必要')
+    sys.path.insert(0, os.path.join(REPO_DIR, 'umls_tools'))
+    try:
+        return __import__(name)
+    finally:
+        sys.path.pop(0)
+
+
+def serial_rows(data_root, profile):
+    """MRCONSO.RRF 全体を 1 つの区間として 1 プロセスで変換した (cui, synonym, representative)"""
+    path = os.path.join(data_root, 'MRCONSO.RRF')
+    return import_tool('convert_umls2simstring').convert_range((path, 0, os.path.getsize(path), profile))[1]
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    return write_rrf(str(tmp_path / 'META'), n_cuis=400)
+
+
+def test_parallel_same_as_serial(tmp_path, data_root):
+    serial, serial_profile = convert_umls2simstring(tmp_path, data_root, 'serial', ['--workers', '1'])
+    parallel, parallel_profile = convert_umls2simstring(tmp_path, data_root, 'parallel', ['--workers', '4'])
+    # 区間に分けて並列に変換しても、出力は行の順番まで同じ
+    assert parallel == serial
+    del serial_profile['synonyms_file'], parallel_profile['synonyms_file']
+    assert parallel_profile == serial_profile
+    assert serial[0] == ['cui', 'SemanticType', 'synonym', 'representative']
+    assert [(cui, synonym, representative) for cui, _, synonym, representative in serial[1:]] == \
+        [tuple(row) for row in serial_rows(data_root, {})]
+    assert serial_profile['rows'] == len(serial) - 1 == serial_profile['full_rows']
+
+
+def test_ranges_do_not_split_cuis(tmp_path, data_root):
+    convert_umls2simstring = import_tool('convert_umls2simstring')
+    path = os.path.join(data_root, 'MRCONSO.RRF')
+    with open(path, mode='rb') as f:
+        data = f.read()
+    for n_chunks in (1, 2, 7, 50, 10000):
+        ranges = convert_umls2simstring.cui_aligned_ranges(path, n_chunks)
+        # 区間はファイル全体を隙間なく覆い、各区間の先頭は CUI の最初の行
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        assert all(end == start for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]))
+        for start, _ in ranges[1:]:
+            assert data[start - 1:start] == b'\n'
+            assert data[start:].split(b'|', 1)[0] != data[:start - 1].rsplit(b'\n', 1)[-1].split(b'|', 1)[0]
+
+
+def convert_umls2brat(tmp_path, data_root, script):
+    """convert_umls2brat.py (script) を実行して UMLS.txt を返す。出力先は実行ディレクトリの ext_tools/umls_tools/resource"""
+    cwd = tmp_path / os.path.splitext(os.path.basename(script))[0]
+    cwd.mkdir()
+    subprocess.run([sys.executable, script, '--data_root', data_root], cwd=str(cwd), check=True,
+                   stdout=subprocess.DEVNULL)
+    with open(str(cwd / 'ext_tools' / 'umls_tools' / 'resource' / 'UMLS.txt'), mode='r', encoding='utf_8') as f:
+        return f.read()
+
+
+def test_brat_merge_join_same_as_dictionaries(tmp_path, data_root):
+    # CUI ごとの辞書を全部作ってから書き出していた、元の実装
+    original = tmp_path / 'convert_umls2brat_original.py'
+    try:
+        commit = subprocess.run(['git', 'log', '--format=%H', '--diff-filter=A', '--', 'umls_tools/convert_umls2brat.py'],
+                                cwd=REPO_DIR, check=True, stdout=subprocess.PIPE).stdout.decode().split()[-1]
+        source = subprocess.run(['git', 'show', commit + ':umls_tools/convert_umls2brat.py'], cwd=REPO_DIR, check=True,
+                                stdout=subprocess.PIPE).stdout
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        pytest.skip('元の実装を git から読めない')
+    original.write_bytes(source)
+    expected = convert_umls2brat(tmp_path, data_root, str(original))
+    converted = convert_umls2brat(tmp_path, data_root, os.path.join(REPO_DIR, 'umls_tools', 'convert_umls2brat.py'))
+    assert converted == expected
+    assert 'info:Definition:definition of ' in converted and 'attr:SemanticType:' in converted
+
+
+def test_brat_rejects_unsorted_input(tmp_path, data_root):
+    convert_umls2brat_module = import_tool('convert_umls2brat')
+    path = os.path.join(data_root, 'MRSTY.RRF')
+    with open(path, mode='r', encoding='utf_8') as f:
+        lines = f.readlines()
+    with open(path, mode='w', encoding='utf_8') as f:
+        f.writelines(lines[::-1])
+    with pytest.raises(ValueError):
+        list(convert_umls2brat_module.iter_cui_groups(path))
+
+
+def test_profile_filters_rows(tmp_path, data_root):
+    full, full_profile = convert_umls2simstring(tmp_path, data_root, 'full', [])
+    clinical, build_profile = convert_umls2simstring(tmp_path, data_root, 'clinical', ['--profile', 'clinical'])
+    profile = import_tool('convert_umls2simstring').load_profile('clinical')
+    assert build_profile['profile'] == 'clinical'
+    assert build_profile['filters'] == {key: value if key == 'max_length' else sorted(value)
+                                        for key, value in profile.items()}
+    # 絞り込んだ行は、1 プロセスで同じ profile で変換したものと同じで、全部の行に含まれる
+    assert [(cui, synonym, representative) for cui, _, synonym, representative in clinical[1:]] == \
+        [tuple(row) for row in serial_rows(data_root, profile)]
+    # (代表表記は残った行から選び直すので比べない)
+    assert set(tuple(row[:3]) for row in clinical[1:]) < set(tuple(row[:3]) for row in full[1:])
+    assert all(len(row[2]) <= profile['max_length'] for row in clinical[1:])
+    # SUPPRESS が 'N' でない行(TERM n)と、clinical に無いソース(MTH, MSHFRE)の行は残らない
+    assert not any(row[2].startswith('terme ') for row in clinical[1:])
+    # 削減率の報告は、絞り込まない場合の件数と比べる
+    assert build_profile['rows'] == len(clinical) - 1 < build_profile['full_rows'] == full_profile['rows']
+    assert build_profile['cuis'] <= build_profile['full_cuis'] == full_profile['cuis']
+
+
+def test_profile_semantic_types_and_file(tmp_path, data_root):
+    profile_file = tmp_path / 'profiles.json'
+    profile_file.write_text(json.dumps({'findings': {'semantic_types': ['Finding']}}), encoding='utf_8')
+    rows, build_profile = convert_umls2simstring(tmp_path, data_root, 'findings',
+                                                 ['--profile', 'findings', '--profile_file', str(profile_file)])
+    assert len(rows) > 1
+    assert all('Finding' in row[1].split('/') for row in rows[1:])
+    assert build_profile['cuis'] == len(set(row[0] for row in rows[1:])) < build_profile['full_cuis']
+    convert_umls2simstring_module = import_tool('convert_umls2simstring')
+    with pytest.raises(ValueError):
+        convert_umls2simstring_module.load_profile('missing')
+    profile_file.write_text(json.dumps({'bad': {'languages': ['ENG']}}), encoding='utf_8')
+    with pytest.raises(ValueError):
+        convert_umls2simstring_module.load_profile('bad', str(profile_file))
+
+
+def test_init_db_records_profile(tu, tmp_path, data_root):
+    from umls_mapping import benchmark
+    from conftest import init_db
+    convert_umls2simstring(tmp_path, data_root, 'clinical', ['--profile', 'clinical'])
+    synonyms_path = str(tmp_path / 'clinical' / 'server' / 'src' / 'umls_mapping' / 'resource' / 'UMLS_synonyms.txt')
+    benchmark.copy_synonyms(tu.resource_dir(), synonyms_path)
+    init_db(tu)
+    build_profile = tu.read_build_profile()
+    assert build_profile['profile'] == 'clinical'
+    assert build_profile == tu.read_build_profile_file(synonyms_path)
+    # UMLS_synonyms.txt が build_profile.json を書いた後に変わっていれば、その profile は記録しない
+    with open(os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'), mode='a', encoding='utf_8') as f:
+        f.write('"C9999999"\t"Finding"\t"extra synonym"\t"extra synonym"\n')
+    init_db(tu)
+    assert tu.read_build_profile() is None
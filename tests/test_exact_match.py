@@ -0,0 +1,75 @@
+import os
+
+# synonym に完全一致する query と、近似文字列検索では他の概念も候補になる query
+EXACT_QUERYS = ['blood pressure', 'headache', '糖尿病', 'aspirin']
+
+
+def read_queries():
+    from umls_mapping import benchmark
+    queries = benchmark.read_queries(os.path.join(benchmark.BENCHMARK_DATA_DIR, benchmark.QUERIES_NAME))
+    return [querys for _, querys in queries]
+
+
+def test_exact_rows_match_fuzzy_rows(searcher):
+    exact = searcher.ranked_search_many(EXACT_QUERYS)
+    fuzzy = searcher.fuzzy().ranked_search_many(EXACT_QUERYS)
+    assert set(exact) == set(EXACT_QUERYS)
+    for query in EXACT_QUERYS:
+        assert all(row[0] == 1.0 and row[2] == query for row in exact[query])
+        # 近似文字列検索で score 1.0 の行と同じ
+        assert exact[query] == [row for row in fuzzy[query] if row[2] == query]
+        assert exact[query] == searcher.ranked_search(query)
+    # 近似文字列検索では他の概念も候補になる
+    assert len(fuzzy['blood pressure']) > len(exact['blood pressure'])
+
+
+def test_not_exact_falls_back_to_fuzzy(searcher):
+    # 完全一致しない query や、CUI が exact_min_cuis 個に満たない query は近似文字列検索にまわす
+    assert searcher.exact_search_many(['blood pressur']) == {}
+    searcher.exact_min_cuis = 2
+    assert searcher.exact_search_many(EXACT_QUERYS) == {}
+    assert searcher.ranked_search_many(['headache']) == searcher.fuzzy().ranked_search_many(['headache'])
+
+
+def test_min_cuis_zero_is_fuzzy(tu, searcher):
+    querys_list = read_queries()
+    fuzzy = tu.word2UMLS_many(querys_list, searcher, 'UMLS', fuzzy=True)
+    assert fuzzy == tu.word2UMLS_many(querys_list, searcher.fuzzy(), 'UMLS')
+    # EXACT_MATCH_MIN_CUIS = 0 で作った searcher は常に近似文字列検索する
+    tu.EXACT_MATCH_MIN_CUIS = 0
+    disabled = tu.load_dct()
+    try:
+        assert disabled.exact_min_cuis == 0
+        assert disabled.fuzzy() is disabled
+        assert disabled.exact_search_many(EXACT_QUERYS) == {}
+        assert tu.word2UMLS_many(querys_list, disabled, 'UMLS') == fuzzy
+    finally:
+        disabled.close()
+    # 近道を使っても、残った概念の score は近似文字列検索と同じで、落ちるのは完全一致しなかった概念だけ
+    for querys, exact, scored_concept in zip(querys_list, tu.word2UMLS_many(querys_list, searcher, 'UMLS'), fuzzy):
+        scores = {cui: value[0] for cui, value in scored_concept}
+        assert {cui: value[0] for cui, value in exact}.items() <= scores.items(), querys
+
+
+def test_trimmed_querys_are_fuzzy(tu, searcher):
+    # 部分一致検索で削った query には近道を使わないので、span 全体が synonym でなければ近似文字列検索と同じ
+    querys_list = [['白血球数値'], ['血圧値'], ['白血球数の低下'], ['血圧測定'], ['血圧']]
+    exact = tu.word2UMLS_many(querys_list, searcher, 'UMLS')
+    assert exact[:-1] == tu.word2UMLS_many(querys_list[:-1], searcher, 'UMLS', fuzzy=True)
+    # 他の span の query 全体(血圧)と削った query が同じ文字列でも、1 件ずつ検索したときと変わらない
+    assert [tu.word2UMLS(querys, searcher, 'UMLS') for querys in querys_list] == exact
+
+
+def test_exact_hits_are_counted(tu, searcher):
+    from umls_mapping import instrumentation
+    metrics = instrumentation.MetricsExporter()
+    previous = instrumentation.set_instrumentation(instrumentation.StageInstrumentation([metrics]))
+    try:
+        tu.word2UMLS(['blood pressure'], searcher, 'UMLS')
+        counts = metrics.snapshot()['counts']
+        assert counts.get('exact_hits', 0) >= 1
+        metrics.reset()
+        tu.word2UMLS(['blood pressure'], searcher, 'UMLS', fuzzy=True)
+        assert metrics.snapshot()['counts'].get('exact_hits', 0) == 0
+    finally:
+        instrumentation.set_instrumentation(previous)
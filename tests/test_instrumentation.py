@@ -0,0 +1,129 @@
+import time
+import logging
+import threading
+import pytest
+from umls_mapping import instrumentation
+from umls_mapping.instrumentation import StageInstrumentation, MetricsExporter, LogLineExporter
+
+
+class Recorder(object):
+    def __init__(self):
+        self.records = []
+
+    def export(self, record):
+        self.records.append(record)
+
+
+def test_stages_and_counts():
+    recorder = Recorder()
+    stages = StageInstrumentation([recorder])
+    # query() の外では記録しない
+    with stages.stage('ignored'):
+        stages.count('ignored')
+    with stages.query(['a', 'b']) as record:
+        with stages.stage('outer'):
+            with stages.stage('inner'):
+                time.sleep(0.01)
+        with stages.stage('outer'):
+            pass
+        stages.count('candidates', 3)
+        stages.count('candidates')
+        # 入れ子の query は外側にまとめる
+        with stages.query(['c']):
+            stages.count('nested')
+    assert recorder.records == [record]
+    assert record.querys == ['a', 'b']
+    assert set(record.stages) == {'outer', 'inner'}
+    assert record.stages['outer'] >= record.stages['inner'] >= 0.01
+    assert record.total >= record.stages['outer']
+    assert record.counts == {'candidates': 4, 'nested': 1}
+
+
+def test_bind_records_other_threads():
+    recorder = Recorder()
+    stages = StageInstrumentation([recorder])
+
+    def translate():
+        with stages.stage('translate'):
+            stages.count('translation_retries')
+    with stages.query(['a']):
+        thread = threading.Thread(target=stages.bind(translate))
+        thread.start()
+        thread.join()
+        # bind しなければ別スレッドの stage は記録しない
+        thread = threading.Thread(target=lambda: stages.count('unbound'))
+        thread.start()
+        thread.join()
+    assert set(recorder.records[0].stages) == {'translate'}
+    assert recorder.records[0].counts == {'translation_retries': 1}
+    # query の外で bind したものはそのまま
+    assert stages.bind(translate) is translate
+
+
+def test_threads_record_separately():
+    metrics = MetricsExporter()
+    stages = StageInstrumentation([metrics])
+
+    def work(i):
+        for _ in range(20):
+            with stages.query([str(i)]):
+                with stages.stage('search'):
+                    stages.count('candidates', i)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snapshot = metrics.snapshot()
+    assert snapshot['queries'] == 160
+    assert snapshot['stages']['search']['count'] == 160
+    assert snapshot['counts'] == {'candidates': 20 * sum(range(8))}
+
+
+def test_metrics_exporter_slowest():
+    from umls_mapping.instrumentation import QueryRecord
+    metrics = MetricsExporter(slowest=3)
+    for i, total in enumerate([0.5, 0.1, 0.5, 0.9, 0.2, 0.7]):
+        record = QueryRecord([str(i)])
+        record.total = total
+        record.stages = {'retrieve': total / 2}
+        metrics.export(record)
+    snapshot = metrics.snapshot()
+    assert [record['total'] for record in snapshot['slowest']] == [0.9, 0.7, 0.5]
+    assert snapshot['stages']['retrieve'] == {'count': 6, 'total_sec': pytest.approx(1.45), 'max_sec': 0.45}
+    assert snapshot['total_sec'] == pytest.approx(2.9)
+    metrics.reset()
+    assert metrics.snapshot()['queries'] == 0 and metrics.snapshot()['slowest'] == []
+
+
+def test_log_line_threshold(caplog):
+    from umls_mapping.instrumentation import QueryRecord
+    exporter = LogLineExporter(threshold_ms=100.0)
+    fast, slow = QueryRecord(['fast']), QueryRecord(['slow', 'query'])
+    fast.total, slow.total = 0.01, 0.25
+    slow.stages = {'translate': 0.2}
+    slow.counts = {'translation_retries': 2}
+    with caplog.at_level(logging.INFO, logger='umls_mapping.timings'):
+        exporter.export(fast)
+        exporter.export(slow)
+    assert [record.getMessage() for record in caplog.records] == [
+        'word2UMLS total=250.00ms translate=200.00ms translation_retries=2 query=slow|query']
+
+
+def test_word2umls_stages(tu, searcher):
+    querys_list = [['頭痛と心不全'], ['血圧'], ['blood pressur']]
+    expected = tu.word2UMLS_many(querys_list, searcher, 'UMLS')
+    metrics = MetricsExporter()
+    previous = instrumentation.set_instrumentation(StageInstrumentation([metrics]))
+    try:
+        # 計測しても結果は変わらない
+        assert tu.word2UMLS_many(querys_list, searcher, 'UMLS') == expected
+        assert [tu.word2UMLS(querys, searcher, 'UMLS') for querys in querys_list] == expected
+    finally:
+        assert instrumentation.set_instrumentation(previous) is not None
+    snapshot = metrics.snapshot()
+    # word2UMLS_many 1 回と word2UMLS 3 回
+    assert snapshot['queries'] == 4
+    assert {'direct_search', 'translate'} <= set(snapshot['stages'])
+    assert snapshot['counts']['trim_querys'] > 0
+    assert not instrumentation.get_instrumentation().enabled
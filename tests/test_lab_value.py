@@ -0,0 +1,28 @@
+import os
+
+# 検査値・血圧・文字で書かれた値・検査名でないもの・全角空白を混ぜる
+LAB_QUERYS = [
+    ['白血球数 2.0'], ['白血球数 12'], ['wbc 5.0'], ['クレアチニン 1.5', 'ast 100'], ['ast 高値'], ['ast 低値'],
+    ['ast 普通'], ['血圧 150', '血圧 90'], ['血圧 110', '血圧 70'], ['ヘモグロビン 20'], ['頭痛'], ['頭痛 3'],
+    ['ＡＳＴ　５０'], ['creatine kinase 300'], ['ast 1.2.3'], [],
+]
+
+
+def read_queries():
+    from umls_mapping import benchmark
+    queries = benchmark.read_queries(os.path.join(benchmark.BENCHMARK_DATA_DIR, benchmark.QUERIES_NAME))
+    return [querys for _, querys in queries]
+
+
+def test_many_same_as_per_span(tu):
+    test_value_index = tu.test_value_set()
+    # 同じ querys を何度も含む
+    querys_list = LAB_QUERYS + read_queries() + LAB_QUERYS[::-1]
+    expected = [tu.lab_value_normalization(querys, test_value_index) for querys in querys_list]
+    normalized = tu.lab_value_normalization_many(querys_list, test_value_index)
+    assert normalized == expected
+    assert '白血球数_low' in normalized[0] and '白血球数_high' in normalized[1]
+    assert normalized[7] == ['血圧_high', 'blood_pressure_abnormal'] and normalized[8] == ['血圧_normal']
+    # 同じ querys の結果は別のリストなので、書き換えても他の span に影響しない
+    normalized[0].append('x')
+    assert normalized[-1] == expected[-1]
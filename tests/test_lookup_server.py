@@ -0,0 +1,77 @@
+import os
+import threading
+import pytest
+
+QUERIES = ['血圧', '頭痛と心不全', 'headache', '白血球数 2.0', '存在しない語', '']
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def client(request, mapper, tmp_path):
+    from umls_mapping import lookup_server
+    from umls_mapping.lookup_client import UmlsLookupClient
+    if request.param == 'unix':
+        socket_path = str(tmp_path / 'lookup.sock')
+        server = lookup_server.make_server(socket_path=socket_path)
+        address = 'unix:' + socket_path
+    else:
+        server = lookup_server.make_server(port=0)
+        address = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield UmlsLookupClient(address, timeout=30.0)
+    server.shutdown()
+    server.server_close()
+
+
+def test_round_trip_same_as_mapper(mapper, client):
+    # サーバを通しても、同じプロセスで UmlsMapper を呼んだ結果と(タプルも含めて)同じ
+    expected = [mapper.word2umls(None, None, None, query) for query in QUERIES]
+    mapper.result_cache.clear()
+    assert [client.word2umls(None, None, None, query) for query in QUERIES] == expected
+    assert client.word2umls_many(QUERIES) == mapper.word2umls_many(QUERIES) == expected
+    assert client.word2umls(None, None, None, '血圧', fuzzy=True) == mapper.word2umls(None, None, None, '血圧',
+                                                                                   fuzzy=True)
+    scoped = client.word2umls_many(['血圧', 'headache'], semantic_types=['Finding'])
+    assert scoped == mapper.word2umls_many(['血圧', 'headache'], semantic_types=['Finding'])
+
+
+def test_concurrent_clients(mapper, client):
+    expected = mapper.word2umls_many(QUERIES)
+    results = {}
+
+    def work(i):
+        # 接続はスレッドごと
+        results[i] = [client.word2umls(None, None, None, query) for query in QUERIES]
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: expected for i in range(8)}
+
+
+def test_stats_and_errors(mapper, client):
+    from umls_mapping.lookup_client import LookupServerError
+    client.word2umls(None, None, None, '血圧')
+    client.word2umls(None, None, None, '血圧')
+    stats = client.stats()
+    assert stats['cache']['hits'] >= 1
+    assert set(['prefetch', 'build_profile', 'uptime', 'startup']) <= set(stats)
+    with pytest.raises(LookupServerError):
+        client._request('GET', '/missing')
+    # 同じ接続を使い続けられる
+    assert client._request('GET', '/health') == {'status': 'ok'}
+
+
+def test_prefetch(mapper, client, tmp_path, monkeypatch):
+    ann_path = str(tmp_path / 'doc.ann')
+    with open(ann_path, mode='w', encoding='utf_8') as f:
+        f.write('T1\tFinding 0 2\t血圧\nT2\tFinding 3 11\theadache\n')
+    monkeypatch.setattr(mapper, 'ann_path', staticmethod(
+        lambda collection, document: os.path.join(str(tmp_path), document + '.ann') if document else None))
+    assert client.prefetch('/', 'doc') == 2
+    assert client.prefetch('/', 'doc') == 0
+    # 先読みした候補を返す(検索ダイアログと同じ結果)
+    assert client.word2umls('/', 'doc', 'T1', '血圧') == mapper.word2umls(None, None, None, '血圧')
+    assert client.word2umls('/', 'doc', 'T2', 'headache') == mapper.word2umls(None, None, None, 'headache')
+    assert client.stats()['prefetch']['hits'] >= 2
@@ -0,0 +1,98 @@
+import threading
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+QUERIES = ['血圧', '頭痛と心不全', 'headache', '白血球数 2.0', '身長', 'blood pressur', '糖尿病', 'aspirin']
+N_THREADS = 8
+
+
+def test_concurrent_lookups_same_as_serial(mapper):
+    expected = {query: mapper.word2umls(None, None, None, query) for query in QUERIES}
+    expected_many = mapper.word2umls_many(QUERIES)
+    for _ in range(3):
+        mapper.result_cache.clear()
+
+        def work(i):
+            query = QUERIES[i % len(QUERIES)]
+            if i % 3 == 0:
+                return [query], mapper.word2umls_many([query])
+            return [query], [mapper.word2umls(None, None, None, query)]
+        with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
+            for querys, results in executor.map(work, range(len(QUERIES) * 8)):
+                assert results == [expected[query] for query in querys]
+    assert expected_many == [expected[query] for query in QUERIES]
+    assert mapper._in_use == {}
+
+
+def test_singleton_is_created_once(mapper, monkeypatch):
+    calls = []
+    barrier = threading.Barrier(N_THREADS)
+    monkeypatch.setattr(mapper, '_UmlsMapper__instance', None)
+    monkeypatch.setattr(mapper, '_initialize', classmethod(lambda cls: calls.append(1)))
+
+    def create(_):
+        barrier.wait(timeout=10)
+        return mapper()
+    with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
+        instances = list(executor.map(create, range(N_THREADS)))
+    assert len(calls) == 1
+    assert all(instance is instances[0] for instance in instances)
+
+
+def test_reload_while_searching(tu, mapper, monkeypatch):
+    # リソースが作り直されたことにして、検索中に searcher を何度も差し替える
+    expected = {query: mapper.word2umls(None, None, None, query) for query in QUERIES}
+    versions = itertools.count()
+    monkeypatch.setattr(tu, 'resource_fingerprint', lambda: next(versions))
+    monkeypatch.setattr(mapper, 'RESOURCE_CHECK_INTERVAL', 0.0)
+    closed = []
+    load_dct = tu.load_dct
+
+    def loading():
+        searcher = load_dct()
+        close = searcher.close
+
+        def closing():
+            closed.append(searcher)
+            close()
+        searcher.close = closing
+        loaded.append(searcher)
+        return searcher
+    loaded = []
+    monkeypatch.setattr(tu, 'load_dct', loading)
+
+    def work(i):
+        query = QUERIES[i % len(QUERIES)]
+        return query, mapper.word2umls(None, None, None, query)
+    # 差し替えには時間がかかり、その間の検索は古い searcher で行うので、何回かに分けて差し替えを起こす
+    for _ in range(4):
+        with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
+            for query, result in executor.map(work, range(len(QUERIES) * 4)):
+                assert result == expected[query]
+    assert len(loaded) >= 4
+    # 差し替えられた searcher は全て、使っていた検索が終わってから 1 度だけ閉じる。今の searcher は閉じない
+    assert mapper._in_use == {}
+    assert mapper.searcher is loaded[-1]
+    assert sorted(map(id, closed)) == sorted(map(id, loaded[:-1]))
+
+
+def _many_in_child(args):
+    from umls_mapping import text2umls
+    searcher, querys_list = text2umls.load_dct(), args
+    try:
+        return text2umls.word2UMLS_many(querys_list, searcher, 'UMLS')
+    finally:
+        searcher.close()
+
+
+def test_stage_executor_after_fork(tu, searcher):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('fork が使えない')
+    querys_list = [[query] for query in QUERIES]
+    # 親で stage のスレッドプールを作ってから fork しても、子の word2UMLS_many が返ってくる
+    expected = tu.word2UMLS_many(querys_list, searcher, 'UMLS')
+    assert tu._executor is not None
+    with multiprocessing.get_context('fork').Pool(processes=1) as pool:
+        assert pool.apply_async(_many_in_child, (querys_list,)).get(timeout=60) == expected
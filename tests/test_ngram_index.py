@@ -0,0 +1,91 @@
+import os
+import csv
+import math
+import random
+import pytest
+from umls_mapping import ngram_index
+
+THRESHOLDS = [0.5, 0.65, 0.8, 0.95, 1.0]
+SEED_SYNONYMS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'umls_mapping', 'benchmark_data', 'seed_synonyms.txt')
+
+
+def seed_synonyms():
+    with open(SEED_SYNONYMS, mode='r', encoding='utf_8') as f:
+        return [row[2] for row in csv.reader(f, delimiter='\t')][1:]
+
+
+def synthetic_term(rnd):
+    if rnd.random() < 0.5:
+        return ''.join(rnd.choice('血圧身長白球数骨折頭痛心不全') for _ in range(rnd.randint(2, 6)))
+    return ' '.join(''.join(rnd.choice('abcdefghij') for _ in range(rnd.randint(3, 8)))
+                    for _ in range(rnd.randint(1, 3)))
+
+
+def brute_force_features(string, n, mark=ngram_index.DEFAULT_MARK):
+    """simstring の C++ 版(be=false)の特徴量: n 文字より短ければ mark で埋め、n-gram に出現回数を付ける"""
+    if len(string) < n:
+        string = string + mark * (n - len(string))
+    seen = {}
+    features = set()
+    for i in range(len(string) - n + 1):
+        ngram = string[i:i + n]
+        seen[ngram] = seen.get(ngram, 0) + 1
+        features.add((ngram, seen[ngram]))
+    return features
+
+
+def brute_force_retrieve(strings, query, n, threshold):
+    """cosine 類似度が threshold 以上の文字列(simstring と同じく、共通特徴量数 >= ceil(α√(|X||Y|)) で判定する)"""
+    x = brute_force_features(query, n)
+    results = []
+    for string in set(strings):
+        y = brute_force_features(string, n)
+        if len(x) > 0 and len(y) > 0 and len(x & y) >= math.ceil(threshold * math.sqrt(len(x) * len(y))):
+            results.append(string)
+    return sorted(results)
+
+
+@pytest.fixture(scope='module')
+def strings():
+    rnd = random.Random(0)
+    synthetic = [synthetic_term(rnd) for _ in range(500)]
+    return seed_synonyms() + synthetic + ['a', 'ab', 'aaa', 'abab', '𠮷野家', 'ｱ']
+
+
+@pytest.fixture(scope='module')
+def queries(strings):
+    rnd = random.Random(1)
+    # 文字列そのもの、その一部、どれにも似ていないもの
+    sample = rnd.sample(strings, 60)
+    return sample + [s[:rnd.randint(1, len(s))] for s in sample] + ['血圧', 'zz', 'a', 'blood pressure high']
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_retrieve_same_as_brute_force(tmp_path, strings, queries, n):
+    path = str(tmp_path / 'index.db')
+    writer = ngram_index.NgramIndexWriter(path, n, False, True)
+    for string in strings:
+        writer.insert(string)
+    writer.close()
+    reader = ngram_index.NgramIndexReader(path)
+    for threshold in THRESHOLDS:
+        reader.threshold = threshold
+        for query in queries:
+            assert sorted(reader.retrieve(query)) == brute_force_retrieve(strings, query, n, threshold), \
+                (threshold, query)
+
+
+def test_duplicates_and_empty_index(tmp_path):
+    path = str(tmp_path / 'index.db')
+    writer = ngram_index.NgramIndexWriter(path, 2, False, True)
+    for string in ['血圧', '血圧', 'blood pressure']:
+        writer.insert(string)
+    writer.close()
+    reader = ngram_index.NgramIndexReader(path)
+    reader.threshold = 1.0
+    assert reader.retrieve('血圧') == ['血圧']
+
+    empty_path = str(tmp_path / 'empty.db')
+    ngram_index.NgramIndexWriter(empty_path, 2, False, True).close()
+    assert ngram_index.NgramIndexReader(empty_path).retrieve('血圧') == []
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+N_THREADS = 8
+
+
+class Resource(object):
+    """プールに入れるオブジェクト。同時に 2 つのスレッドが使ったら記録する"""
+    def __init__(self):
+        self.users = 0
+        self.shared = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def use(self, barrier=None):
+        with self.lock:
+            self.users += 1
+            self.shared = self.shared or self.users > 1
+        if barrier is not None:
+            barrier.wait(timeout=10)
+        with self.lock:
+            self.users -= 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(tu):
+    created = []
+
+    def create():
+        created.append(Resource())
+        return created[-1]
+    pool = tu.ObjectPool(create)
+    pool.created = created
+    return pool
+
+
+def use_concurrently(pool, n_threads, barrier=None):
+    def work(_):
+        with pool.get() as obj:
+            obj.use(barrier)
+            return obj
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(work, range(n_threads)))
+
+
+def test_concurrent_leases_do_not_share(pool):
+    # 全スレッドが同時に借りているので、スレッドの数だけ作られ、1 つを 2 つのスレッドが使うことは無い
+    used = use_concurrently(pool, N_THREADS, threading.Barrier(N_THREADS))
+    assert len(set(map(id, used))) == N_THREADS
+    assert len(pool.created) == N_THREADS
+    assert not any(obj.shared for obj in pool.created)
+    # 返したものを使い回すので、もう一度使っても増えない
+    use_concurrently(pool, N_THREADS)
+    assert len(pool.created) == N_THREADS
+    assert not any(obj.shared for obj in pool.created)
+
+
+def test_sequential_leases_reuse_one_object(pool):
+    for _ in range(10):
+        with pool.get() as obj:
+            obj.use()
+    assert len(pool.created) == 1
+
+
+def test_returned_on_error_and_closed(pool):
+    with pytest.raises(ValueError):
+        with pool.get():
+            raise ValueError()
+    with pool.get() as obj:
+        assert obj is pool.created[0]
+    pool.close()
+    assert all(obj.closed for obj in pool.created)
+    # close() の後に借りると新しく作る
+    with pool.get() as obj:
+        assert obj is pool.created[-1] and not obj.closed
+
+
+def test_synonyms_connections_are_read_only(tu, searcher):
+    with searcher.connections.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("DELETE FROM umls_synonyms")
+    import normdb
+    with pytest.raises(normdb.dbNotFoundError):
+        with tu.SynonymsConnectionPool(os.path.join(tu.resource_dir(), 'missing.db')).connection():
+            pass
+
+
+def test_threads_share_searcher(tu, searcher):
+    # SQL と simstring の reader を複数のスレッドから同時に使っても、1 スレッドで検索した結果と同じ
+    searcher.concepts = None
+    queries = ['blood pressure', 'headache', '糖尿病', 'aspirin', '頭痛', 'hypertension', 'ast', '血圧']
+    expected = [(searcher.ids_by_names([query]), searcher.ranked_search(query)) for query in queries]
+
+    def search(i):
+        query = queries[i % len(queries)]
+        return searcher.ids_by_names([query]), searcher.ranked_search(query)
+    with ThreadPoolExecutor(max_workers=N_THREADS) as executor:
+        results = list(executor.map(search, range(len(queries) * 10)))
+    assert results == expected * 10
+    # 接続と reader は同時に使われた数までしか増えない
+    assert len(searcher.connections._objects) <= N_THREADS
+    assert len(searcher.db._objects) <= N_THREADS
@@ -0,0 +1,80 @@
+import time
+import threading
+import pytest
+
+# 先読みの 1 回の検索にかかる時間(秒)
+LOOKUP_SECONDS = 0.3
+
+
+class SlowLookup(object):
+    """word2umls_many の代わり。検索した span を記録し、1 回ごとに LOOKUP_SECONDS かかる"""
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, query_strings, database, semantic_types):
+        with self._lock:
+            self.calls.append(list(query_strings))
+        self.started.set()
+        time.sleep(LOOKUP_SECONDS)
+        return [[('C%07d' % len(query), (1.0, query, 'Finding', query, 0))] for query in query_strings]
+
+
+@pytest.fixture
+def document(tmp_path, tu):
+    """span を 64 個持つ .ann"""
+    ann_path = str(tmp_path / 'doc.ann')
+    spans = ['span%02d' % i for i in range(64)]
+    with open(ann_path, mode='w', encoding='utf_8') as f:
+        for i, text in enumerate(spans):
+            f.write('T%d\tFinding %d %d\t%s\n' % (i + 1, i * 10, i * 10 + len(text), text))
+    return ann_path, spans
+
+
+@pytest.fixture
+def prefetcher(tu):
+    from umls_mapping.prefetch import DocumentPrefetcher
+    lookup = SlowLookup()
+    prefetcher = DocumentPrefetcher(lookup, batch_size=16, wait=5.0)
+    prefetcher.lookup_calls = lookup
+    yield prefetcher
+    prefetcher.close()
+
+
+def test_queued_span_is_looked_up_inline(prefetcher, document):
+    ann_path, spans = document
+    assert prefetcher.prefetch(ann_path) == len(spans)
+    prefetcher.lookup_calls.started.wait()
+    # 最後の span は 4 番目の batch で順番待ち。先読みを待たずにその場で検索する
+    start = time.monotonic()
+    result = prefetcher.get(ann_path, 'UMLS', 'T64', 'span63')
+    elapsed = time.monotonic() - start
+    assert result == [('C0000006', (1.0, 'span63', 'Finding', 'span63', 0))]
+    assert elapsed < 2 * LOOKUP_SECONDS
+    assert prefetcher.stats()['inline'] == 1
+    assert ['span63'] in prefetcher.lookup_calls.calls
+
+
+def test_running_span_waits_for_prefetch(prefetcher, document):
+    ann_path, spans = document
+    prefetcher.prefetch(ann_path)
+    prefetcher.lookup_calls.started.wait()
+    # 最初の span は先読みのスレッドが検索中なので、その結果を待つ
+    result = prefetcher.get(ann_path, 'UMLS', 'T1', 'span00')
+    assert result == [('C0000006', (1.0, 'span00', 'Finding', 'span00', 0))]
+    assert prefetcher.stats()['inline'] == 0
+    assert ['span00'] not in prefetcher.lookup_calls.calls
+
+
+def test_inline_span_is_not_looked_up_again(prefetcher, document):
+    ann_path, spans = document
+    prefetcher.prefetch(ann_path)
+    prefetcher.lookup_calls.started.wait()
+    prefetcher.get(ann_path, 'UMLS', 'T64', 'span63')
+    deadline = time.monotonic() + 10.0
+    while prefetcher.stats()['pending'] > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    searched = [query for call in prefetcher.lookup_calls.calls for query in call]
+    assert sorted(searched) == sorted(spans)
+    assert prefetcher.stats()['spans'] == len(spans)
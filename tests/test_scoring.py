@@ -0,0 +1,50 @@
+import random
+import pytest
+from umls_mapping.scoring import NgramCosineScorer, make_scorer
+
+pytest.importorskip('simstring')
+from simstring.feature_extractor.character_ngram import CharacterNgramFeatureExtractor
+from simstring.measure.cosine import CosineMeasure
+
+# 同じ n-gram を何度も含む文字列、区切り文字を含む文字列、日本語、サロゲートペアの文字など
+STRINGS = ['aab', 'abab', 'aaaa', 'a$b', '$$', 'b', 'blood pressure', 'blood pressure abnormal', 'pressure blood',
+           '大腿骨頸部骨折', '骨折 大腿', '左大腿骨頸部骨折です', '血圧', '血圧_high', 'ｹｯｾｲ', '𠮷野家', 'white blood cell count']
+
+
+def random_strings(n_strings, seed=0):
+    rnd = random.Random(seed)
+    alphabet = 'ab $血圧骨'
+    return [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 12))) for _ in range(n_strings)]
+
+
+def expected_similarities(n, query, candidates):
+    feature_extractor = CharacterNgramFeatureExtractor(n)
+    measure = CosineMeasure()
+    features = feature_extractor.features(query)
+    return [measure.similarity(features, feature_extractor.features(s)) for s in candidates]
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_same_as_simstring_cosine(n):
+    scorer = NgramCosineScorer(n)
+    candidates = STRINGS + random_strings(200, seed=n)
+    for query in STRINGS + random_strings(20, seed=n + 10):
+        expected = expected_similarities(n, query, candidates)
+        assert scorer.similarities(query, candidates).tolist() == pytest.approx(expected, abs=1e-12)
+
+
+def test_empty_candidates():
+    assert NgramCosineScorer(2).similarities('血圧', []).tolist() == []
+
+
+def test_make_scorer():
+    scorer = make_scorer(CharacterNgramFeatureExtractor(2), CosineMeasure())
+    assert isinstance(scorer, NgramCosineScorer)
+    assert scorer.n == 2
+    # 詰められない n や、似ていない類似度には作らない
+    assert make_scorer(CharacterNgramFeatureExtractor(4), CosineMeasure()) is None
+
+    class OverlapMeasure(object):
+        def similarity(self, x, y):
+            return float(len(set(x) & set(y)))
+    assert make_scorer(CharacterNgramFeatureExtractor(2), OverlapMeasure()) is None
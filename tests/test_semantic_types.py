@@ -0,0 +1,53 @@
+import pytest
+from conftest import init_db
+
+# benchmark_data/seed_synonyms.txt の、SemanticType を 2 つ持つ概念
+ASPIRIN_CUI = 'C0004057'
+ASPIRIN_TYPES = ['Pharmacologic Substance', 'Organic Chemical']
+
+
+@pytest.fixture
+def scoped_searcher(tu):
+    """SemanticType ごとの検索用 DB を作ったリソースの searcher"""
+    tu.ENTITY_SEMANTIC_TYPES = {'Medication': ['Pharmacologic Substance'], 'Chemical': ['Organic Chemical'],
+                                'Finding': ['Finding']}
+    init_db(tu)
+    searcher = tu.load_dct()
+    yield searcher
+    searcher.close()
+
+
+def test_has_semantic_type(tu):
+    assert tu.has_semantic_type('Pharmacologic Substance/Organic Chemical', frozenset(['Organic Chemical']))
+    assert tu.has_semantic_type('Finding', frozenset(['Finding', 'Disease or Syndrome']))
+    assert not tu.has_semantic_type('Pharmacologic Substance/Organic Chemical', frozenset(['Finding']))
+    # 部分文字列では一致しない
+    assert not tu.has_semantic_type('Organic Chemical', frozenset(['Chemical']))
+
+
+@pytest.mark.parametrize('semantic_type', ASPIRIN_TYPES)
+@pytest.mark.parametrize('use_concept_store', [True, False])
+def test_multi_type_concept_found_under_each_type(tu, scoped_searcher, semantic_type, use_concept_store):
+    searcher = scoped_searcher.scoped({semantic_type})
+    if not use_concept_store:
+        searcher.concepts = None
+    # SemanticType ごとの検索用 DB に入っている
+    assert searcher.db is not scoped_searcher.db
+    assert 'aspirin' in searcher.retrieve('aspirin')
+    # 候補の行から落ちない
+    rows = searcher.ids_by_names(['aspirin', 'アスピリン'])
+    assert sorted(set(row[0] for row in rows)) == [ASPIRIN_CUI]
+    assert len(rows) == 2
+    for fuzzy in (False, True):
+        concepts = dict(tu.word2UMLS(['aspirin'], scoped_searcher, 'UMLS', frozenset([semantic_type]), fuzzy))
+        assert ASPIRIN_CUI in concepts
+
+
+def test_multi_type_concept_excluded_under_other_type(scoped_searcher, tu):
+    searcher = scoped_searcher.scoped({'Finding'})
+    assert 'aspirin' not in searcher.retrieve('aspirin')
+    assert searcher.ids_by_names(['aspirin']) == []
+    concepts = dict(tu.word2UMLS(['aspirin'], scoped_searcher, 'UMLS', frozenset(['Finding']), True))
+    assert ASPIRIN_CUI not in concepts
+    # Unknown は SemanticType によらず返す
+    assert tu.UNKNOWN_CUI in concepts
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import math
+import subprocess
+from conftest import init_db
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 起動時に import しないモジュール
+DEFERRED_MODULES = ['pandas', 'numpy', 'sklearn', 'MeCab', 'googletrans', 'simstring_cpp']
+
+
+def imported_modules(code, resource_path):
+    """code を別のプロセスで実行し、その後に import されている DEFERRED_MODULES を返す"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    script = '\n'.join([
+        'import sys, json',
+        'from umls_mapping import text2umls as tu',
+        'tu.UMLS_DB_PATH = %r' % resource_path,
+        code,
+        'print(json.dumps([m for m in %r if m in sys.modules]))' % DEFERRED_MODULES,
+    ])
+    output = subprocess.run([sys.executable, '-c', script], env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode('utf_8').strip().splitlines()[-1])
+
+
+def comparable(test_value_index):
+    """test_value.csv の欠損(NaN)は NaN 同士で等しくならないので None にして比べる"""
+    return {name: tuple(None if math.isnan(bound) else bound for bound in bounds)
+            for name, bounds in test_value_index.items()}
+
+
+def test_import_defers_heavy_modules(tu):
+    assert imported_modules('', tu.resource_dir()) == []
+
+
+def test_artifact_avoids_pandas_and_sklearn(tu):
+    code = 'tu.test_value_set(); tu.english_stop_words()'
+    # startup_tables.json が無ければ test_value.csv と sklearn から作る
+    assert set(imported_modules(code, tu.resource_dir())) >= {'pandas', 'sklearn'}
+    init_db(tu)
+    assert os.path.exists(os.path.join(tu.resource_dir(), tu.STARTUP_ARTIFACT_NAME))
+    assert 'pandas' not in imported_modules(code, tu.resource_dir())
+    assert 'sklearn' not in imported_modules(code, tu.resource_dir())
+
+
+def test_artifact_same_as_sources(tu, monkeypatch):
+    init_db(tu)
+    assert comparable(tu.test_value_set()) == comparable(tu.build_test_value_index())
+    monkeypatch.setattr(tu, '_stop_words', None)
+    assert tu.english_stop_words() == frozenset(tu._sklearn_stop_words())
+
+
+def test_stale_artifact_is_ignored(tu):
+    init_db(tu)
+    csv_path = os.path.join(tu.resource_dir(), 'test_value.csv')
+    with open(csv_path, mode='a', encoding='utf_8') as f:
+        f.write('999,テスト検査,x,mg/dl,1,2\n')
+    # test_value.csv が変わったら startup_tables.json は使わない
+    assert tu.test_value_set()['テスト検査'] == (1.0, 2.0)
+    tu.build_startup_artifact()
+    assert tu.test_value_set()['テスト検査'] == (1.0, 2.0)
+    with open(os.path.join(tu.resource_dir(), tu.STARTUP_ARTIFACT_NAME), mode='w', encoding='utf_8') as f:
+        f.write('{broken')
+    assert tu.load_startup_artifact() is None
+    assert comparable(tu.test_value_set()) == comparable(tu.build_test_value_index())
@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from umls_mapping.tokenizer import TaggerPool, ContentWordTokenizer
+
+
+class FakeTagger(object):
+    """MeCab.Tagger の代わり。同時に 2 つのスレッドから使われたら記録する"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.busy = threading.Lock()
+
+    def use(self):
+        if not self.busy.acquire(blocking=False):
+            self.pool.shared = True
+            return
+        time.sleep(0.005)
+        self.busy.release()
+
+
+class FakeTaggerPool(TaggerPool):
+    def __init__(self, maxsize):
+        super(FakeTaggerPool, self).__init__(maxsize)
+        self.created = []
+        self.shared = False
+
+    def _create(self):
+        self.created.append(FakeTagger(self))
+        return self.created[-1]
+
+
+@pytest.mark.parametrize('maxsize', [1, 3, 8])
+def test_pool_bounds_taggers(maxsize):
+    pool = FakeTaggerPool(maxsize)
+
+    def work(_):
+        with pool.tagger() as tagger:
+            tagger.use()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(32)))
+    # Tagger は同時に借りられる数(maxsize)までしか作らず、1 つを 2 つのスレッドが同時に使わない
+    assert 1 <= len(pool.created) <= maxsize
+    assert not pool.shared
+
+
+@pytest.fixture
+def tokenizer():
+    pytest.importorskip('MeCab')
+    if 'MECABRC' in os.environ and not os.path.exists(os.environ['MECABRC']):
+        pytest.skip('mecabrc が無い')
+    return ContentWordTokenizer(cache_size=4)
+
+
+def test_content_words_cached(tokenizer):
+    words = tokenizer.content_words('白血球数の低下を認めた')
+    assert '白血球' in words and 'の' not in words and 'を' not in words
+    # 2 回目はキャッシュから返すので形態素解析しない
+    assert tokenizer.content_words('白血球数の低下を認めた') is words
+    stats = tokenizer.cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_cache_is_bounded(tokenizer):
+    querys = ['頭痛', '発熱', '咳嗽', '嘔吐', '腹痛', '下痢']
+    expected = [tokenizer.content_words(query) for query in querys]
+    assert len(tokenizer.cache) == 4 and tokenizer.cache.stats()['evictions'] == 2
+    # 追い出された query も同じ結果になる
+    assert [tokenizer.content_words(query) for query in querys] == expected
+
+
+def test_threads_get_same_words(tokenizer):
+    querys = ['白血球数の低下', '血圧の上昇を認める', '頭痛と発熱', '腎機能が悪化した'] * 8
+    expected = [tuple(ContentWordTokenizer(cache_size=0)._parse(query)) for query in querys]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(tokenizer.content_words, querys)) == expected
@@ -0,0 +1,86 @@
+import os
+import csv
+import itertools
+import numpy as np
+import pytest
+from conftest import init_db
+
+HEADER = ['cui', 'SemanticType', 'synonym', 'representative', 'in_use']
+# 検索(simstring の特徴量)と順位付け(前後に $ を付けた特徴量)で類似度の順が入れ替わる synonym
+COUNTEREXAMPLE = [['C0000001', 'Finding', 'addaaa', 'addaaa', '1'],
+                  ['C0000002', 'Finding', 'bdaaddc', 'bdaaddc', '1']]
+COUNTEREXAMPLE_QUERY = 'bdaaadd'
+
+
+def write_synonyms(tu, rows):
+    with open(os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'), mode='w', encoding='utf_8', newline='\n') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n', quoting=csv.QUOTE_ALL)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+@pytest.fixture
+def counterexample_searcher(tu):
+    write_synonyms(tu, COUNTEREXAMPLE)
+    init_db(tu)
+    searcher = tu.load_dct()
+    searcher.exact_min_cuis = 0
+    yield searcher
+    searcher.close()
+
+
+def top_rows(ranked, k):
+    """上位 k 個の CUI の最大 score の行(_search_id と同じく CUI ごとに最後の行)"""
+    best = {}
+    for row in ranked:
+        best[row[1]] = row
+    return sorted(best.values(), key=lambda x: (x[0], x[1]), reverse=True)[:k]
+
+
+def test_top_k_counterexample(counterexample_searcher):
+    searcher = counterexample_searcher
+    full = searcher.ranked_search(COUNTEREXAMPLE_QUERY)
+    assert [row[:2] for row in top_rows(full, 1)] == [[0.75, 'C0000002']]
+    searcher.top_k = 1
+    ranked = searcher.ranked_search_many([COUNTEREXAMPLE_QUERY])[COUNTEREXAMPLE_QUERY]
+    assert top_rows(ranked, 1) == top_rows(full, 1)
+
+
+@pytest.mark.parametrize('top_k', [1, 3, 10])
+def test_top_k_matches_full_search(searcher, top_k):
+    queries = ['blood pressure', '血圧', 'diabetes', 'fracture', 'leukocytosis', 'ast上昇', 'heigth', '骨折 大腿']
+    full = searcher.fuzzy().ranked_search_many(queries)
+    searcher = searcher.fuzzy()
+    searcher.top_k = top_k
+    ranked = searcher.ranked_search_many(queries)
+    for query in queries:
+        assert top_rows(ranked[query], top_k) == top_rows(full[query], top_k)
+        assert len(set(row[1] for row in ranked[query])) <= top_k
+
+
+def test_unretrieved_score_bound():
+    from umls_mapping.scoring import NgramCosineScorer, unretrieved_score_bound
+    from umls_mapping.ngram_index import features
+    scorer = NgramCosineScorer(2)
+    # 'ab' の 2 文字からなる長さ 1-7 の文字列の全ての組で、検索の cosine が閾値未満なら score は上限以下
+    strings = [''.join(s) for m in range(1, 8) for s in itertools.product('ab', repeat=m)]
+    codes, occurrences, owners = features(strings, 2)
+    keys = [set() for _ in strings]
+    for code, occurrence, owner in zip(codes.tolist(), occurrences.tolist(), owners.tolist()):
+        keys[owner].add((code, occurrence))
+    for threshold in (0.9, 0.8):
+        for i, query in enumerate(strings):
+            scores = scorer.similarities(query, strings)
+            retrieval = np.array([len(keys[i] & keys[j]) / np.sqrt(len(keys[i]) * len(keys[j])) for j in range(len(strings))])
+            missed = scores[retrieval < threshold]
+            assert missed.max(initial=0.0) <= unretrieved_score_bound(len(query), threshold, 2) + 1e-12
+
+
+def test_top_k_stops_early(searcher):
+    searcher = searcher.fuzzy()
+    searcher.top_k = 1
+    # 完全一致の CUI は上限を超えるので閾値 0.9 で打ち切る。score 0.8 では打ち切れない
+    assert searcher._top_k_settled('hypertension', {'C0020538': 1.0}, 0.9)
+    assert not searcher._top_k_settled('hypertension', {'C0020538': 0.8}, 0.9)
+    # $ を含む query は上限が成り立たない
+    assert not searcher._top_k_settled('hyper$ension', {'C0020538': 1.0}, 0.9)
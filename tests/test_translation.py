@@ -0,0 +1,58 @@
+import threading
+import pytest
+
+
+class FakeTranslator(object):
+    """googletrans.Translator の代わり。作られたときの timeout を記録する"""
+    timeouts = []
+
+    def __init__(self, service_urls=None, timeout=None):
+        self.timeouts.append(timeout)
+
+    def translate(self, text, src='ja', dest='en'):
+        class Translated(object):
+            pass
+        translated = Translated()
+        translated.text = 'en:' + text
+        return translated
+
+
+@pytest.fixture
+def fake_google(monkeypatch):
+    googletrans = pytest.importorskip('googletrans')
+    FakeTranslator.timeouts = []
+    monkeypatch.setattr(googletrans, 'Translator', FakeTranslator)
+    return FakeTranslator
+
+
+def test_translator_uses_request_timeout(tmp_path, fake_google):
+    import httpx
+    from umls_mapping.translation import make_translator
+    translator = make_translator('google', str(tmp_path), timeout=7.0)
+    backend = translator.backend
+    try:
+        # 最初の呼び出しの残りの予算(0.5 秒)ではなく、設定されたタイムアウトで Translator を作る
+        assert backend.translate('頭痛', timeout=0.5) == 'en:頭痛'
+        assert backend.translate_many(['頭痛', '発熱'], timeout=0.5) == ({'頭痛': 'en:頭痛', '発熱': 'en:発熱'}, {})
+    finally:
+        translator.close()
+    assert fake_google.timeouts == [httpx.Timeout(7.0)]
+
+
+def test_budget_is_enforced_by_future(tmp_path, fake_google, monkeypatch):
+    import httpx
+    from umls_mapping.translation import GoogleTranslatorBackend, TranslationError
+    release = threading.Event()
+    translate = FakeTranslator.translate
+
+    def slow_translate(self, text, src='ja', dest='en'):
+        release.wait(5.0)
+        return translate(self, text, src, dest)
+    monkeypatch.setattr(FakeTranslator, 'translate', slow_translate)
+    backend = GoogleTranslatorBackend(request_timeout=30.0)
+    try:
+        with pytest.raises(TranslationError):
+            backend.translate('頭痛', timeout=0.1)
+    finally:
+        release.set()
+    assert fake_google.timeouts == [httpx.Timeout(30.0)]
@@ -0,0 +1,62 @@
+import pytest
+
+# 直接検索で見つからず、部分一致検索にまわる query の候補
+TRIM_QUERYS = [('the blood pressure was measured', True), ('very severe headache attack', True),
+               ('aspirin and headache', True), ('血圧の測定値', False), ('頭痛と発熱の悪化', False),
+               ('白血球数の低下', False), ('zzqx blood pressure', True)]
+
+
+def test_trim_querys_english(tu):
+    right, left = tu._trim_querys('the high blood pressure', True)
+    # ストップワード(the)を除き、右から・左から 1 単語ずつ削る
+    assert right == ['high blood pressure', 'high blood', 'high']
+    assert left == ['blood pressure', 'pressure']
+    assert tu._trim_querys('headache', True) == (['headache'], [])
+
+
+def test_trim_querys_japanese(tu):
+    pytest.importorskip('MeCab')
+    right, left = tu._trim_querys('白血球数の低下', False)
+    # 内容語だけを区切らずにつなぐ
+    assert right[0] == ''.join(tu.get_tokenizer().content_words('白血球数の低下'))
+    assert all(query in right[0] for query in right + left)
+    assert len(left) == len(right) - 1
+
+
+def sequential_trim(tu, searcher, query, is_alnum_flag):
+    """部分一致検索を query ごとに 1 つずつ検索する(まとめる前のやり方)"""
+    base_score = 0.0 if is_alnum_flag else 2.0
+    org_len_features = float(len(searcher.feature_extractor.features(query)))
+    scored_concept = {}
+    right_querys, left_querys = tu._trim_querys(query, is_alnum_flag)
+    for querys in (right_querys, left_querys):
+        for partial_query in querys:
+            results = tu.partial_search(searcher.fuzzy(), partial_query, 'UMLS', org_len_features, base_score)
+            if len(results) != 0:
+                tu._concept_update(scored_concept, results)
+                break
+    return scored_concept
+
+
+def test_batched_trim_same_as_sequential(tu, searcher, monkeypatch):
+    searches = [(query, flag) for query, flag in TRIM_QUERYS if len(searcher.ranked_search(query)) == 0]
+    assert len(searches) >= 4
+    ranked = searcher.ranked_search_many([query for query, _ in searches])
+    searched = []
+    ranked_search_many = type(searcher).ranked_search_many
+
+    def recording(self, querys):
+        searched.append(list(querys))
+        return ranked_search_many(self, querys)
+    monkeypatch.setattr(type(searcher), 'ranked_search_many', recording)
+    trimmed = tu._trim_search_round(searcher, searches, ranked)
+    # 部分一致検索の query は重複を除いて 1 回でまとめて検索する
+    assert len(searched) == 1
+    assert len(searched[0]) == len(set(searched[0]))
+    assert set(searched[0]) == set(q for query, flag in searches for q in sum(tu._trim_querys(query, flag), []))
+    for query, flag in searches:
+        scored_concept, direct_hit = tu._word2umls_impl(query, {}, flag, searcher, 'UMLS', ranked, trimmed)
+        assert not direct_hit
+        assert scored_concept == sequential_trim(tu, searcher, query, flag)
+    # まとめて検索した結果があれば、ここでは検索しない
+    assert len(searched) == 1
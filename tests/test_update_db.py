@@ -0,0 +1,178 @@
+import os
+import csv
+import sqlite3
+import pytest
+from conftest import init_db
+
+
+def read_rows(path):
+    with open(path, mode='r', encoding='utf_8') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    return rows[0], rows[1:]
+
+
+def write_rows(path, header, rows):
+    with open(path, mode='w', encoding='utf_8', newline='\n') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n', quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def table_rows(tu):
+    connection = sqlite3.connect(os.path.join(tu.resource_dir(), tu.SYNONYMS_DB_NAME))
+    rows = sorted(connection.execute('SELECT cui, semantic, synonym, representative, in_use FROM umls_synonyms'))
+    connection.close()
+    return rows
+
+
+def edit(rows):
+    """
+    (cui, synonym) を 2 つ追加、1 つ削除、2 つ変更する
+    :return: 書き換えた行
+    """
+    edited = []
+    for cui, semantic, synonym, representative, in_use in rows:
+        if (cui, synonym) == ('C0018681', 'headache'):
+            # 削除
+            continue
+        if (cui, synonym) == ('C0005823', 'blood pressure'):
+            # in_use の変更
+            in_use = '1'
+        if (cui, synonym) == ('C0011849', 'diabetes'):
+            # SemanticType の変更(同じ CUI の他の行は変えない)
+            semantic = 'Disease or Syndrome/Finding'
+        edited.append([cui, semantic, synonym, representative, in_use])
+        if (cui, synonym) == ('C0018681', '頭痛'):
+            # 既にある CUI への追加
+            edited.append([cui, semantic, 'cephalalgia', representative, '0'])
+    # 新しい CUI の追加
+    edited.append(['C9999999', 'Finding', 'neu synonym', 'neu synonym', ''])
+    return edited
+
+
+@pytest.fixture
+def new_synonyms(tu, tmp_path):
+    header, rows = read_rows(os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'))
+    path = str(tmp_path / 'UMLS_synonyms.txt')
+    write_rows(path, header, edit(rows))
+    return path
+
+
+def test_counts(tu, new_synonyms):
+    init_db(tu)
+    assert tu.update_db_cpp(new_synonyms) == (2, 1, 2)
+    # 同じファイルでもう一度更新しても何も変わらない
+    assert tu.update_db_cpp(new_synonyms) == (0, 0, 0)
+
+
+def test_duplicate_rows_count_as_changed(tu, tmp_path):
+    # 同じ (cui, synonym) の行が 2 つあり、片方だけ消えた場合は(行は削除だが) (cui, synonym) としては変更
+    header, rows = read_rows(os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'))
+    i = next(i for i, row in enumerate(rows) if row[2] == 'femur')
+    duplicated = rows[:i + 1] + [rows[i][:1] + ['Body Part'] + rows[i][2:]] + rows[i + 1:]
+    write_rows(os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'), header, duplicated)
+    init_db(tu)
+    path = str(tmp_path / 'UMLS_synonyms.txt')
+    write_rows(path, header, rows)
+    assert tu.update_db_cpp(path) == (0, 0, 1)
+
+
+def test_same_rows_as_init_db(tu, new_synonyms):
+    init_db(tu)
+    tu.update_db_cpp(new_synonyms)
+    updated = table_rows(tu)
+    searcher = tu.load_dct()
+    try:
+        assert 'cephalalgia' in searcher.retrieve('cephalalgia')
+        assert [row[0] for row in searcher.ids_by_names(['cephalalgia', 'headache'])] == ['C0018681']
+    finally:
+        searcher.close()
+    os.replace(new_synonyms, os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'))
+    init_db(tu)
+    assert updated == table_rows(tu)
+
+
+SEMANTIC_GROUPS = {'Finding': ['Finding'], 'Lab_test': ['Laboratory Procedure']}
+
+
+def mtime(tu, name):
+    return os.stat(os.path.join(tu.resource_dir(), name)).st_mtime_ns
+
+
+def search_all(tu, searcher, queries):
+    """全体と SemanticType を限定した検索の行と、word2UMLS の結果"""
+    results = []
+    for semantic_types in [None] + [frozenset(types) for types in SEMANTIC_GROUPS.values()]:
+        scoped = searcher.scoped(semantic_types)
+        results.append(scoped.ids_by_names(queries))
+        results.append(scoped.fuzzy().ranked_search_many(queries))
+        results.append(tu.word2UMLS_many([[query] for query in queries], searcher, 'UMLS', semantic_types))
+    return results
+
+
+def test_update_adds_deltas_without_rebuilding(tu, new_synonyms):
+    tu.ENTITY_SEMANTIC_TYPES = SEMANTIC_GROUPS
+    init_db(tu)
+    finding_db = tu.semantic_index_name(['Finding'])
+    lab_db = tu.semantic_index_name(['Laboratory Procedure'])
+    before = {name: mtime(tu, name) for name in (tu.CONCEPT_STORE_NAME, finding_db, lab_db)}
+    tu.update_db_cpp(new_synonyms)
+    # 全体の concept store と SemanticType ごとの DB は作り直さない
+    assert {name: mtime(tu, name) for name in before} == before
+    store = tu.open_concept_store(tu.resource_dir())
+    # 行が変わった synonym (headache, blood pressure, diabetes, cephalalgia, neu synonym)だけが差分に入る
+    assert store.delta is not None
+    assert sorted(store.delta.synonyms.to_list()) == ['blood pressure', 'cephalalgia', 'diabetes', 'headache',
+                                                      'neu synonym']
+    # Finding の行が新たに加わった synonym だけが、Finding の差分の DB に入る
+    indexes = tu.load_semantic_indexes(tu.resource_dir())
+    assert indexes[frozenset(['Finding'])][1] is not None
+    assert indexes[frozenset(['Laboratory Procedure'])][1] is None
+    searcher = tu.load_dct()
+    try:
+        finding = searcher.scoped({'Finding'})
+        assert finding.delta_db is not None
+        assert 'diabetes' in finding.retrieve('diabetes')
+        assert 'neu synonym' in finding.retrieve('neu synonym')
+    finally:
+        searcher.close()
+
+
+def test_repeated_updates_same_as_init_db(tu, new_synonyms, tmp_path):
+    tu.ENTITY_SEMANTIC_TYPES = SEMANTIC_GROUPS
+    init_db(tu)
+    header, rows = read_rows(new_synonyms)
+    # 2 回目の更新: 追加した行を消し、別の synonym を変える(前の差分の synonym も入れ直す)
+    second = [row for row in rows if row[2] != 'cephalalgia']
+    second = [row[:1] + ['Finding'] + row[2:] if row[2] == 'ast' else row for row in second]
+    second_path = str(tmp_path / 'second.txt')
+    write_rows(second_path, header, second)
+    tu.update_db_cpp(new_synonyms)
+    tu.update_db_cpp(second_path)
+    store = tu.open_concept_store(tu.resource_dir())
+    assert {'cephalalgia', 'headache', 'ast'} <= set(store.delta.synonyms.to_list())
+
+    queries = ['cephalalgia', 'headache', 'diabetes', 'neu synonym', 'ast', 'blood pressure', '頭痛', 'hypertension']
+    searcher = tu.load_dct()
+    try:
+        assert searcher.concepts.delta is not None
+        updated = search_all(tu, searcher, queries)
+    finally:
+        searcher.close()
+    os.replace(second_path, os.path.join(tu.resource_dir(), 'UMLS_synonyms.txt'))
+    init_db(tu)
+    searcher = tu.load_dct()
+    try:
+        assert searcher.concepts.delta is None
+        assert search_all(tu, searcher, queries) == updated
+    finally:
+        searcher.close()
+
+
+def test_large_delta_rebuilds_store(tu, new_synonyms, monkeypatch):
+    init_db(tu)
+    monkeypatch.setattr(tu, 'CONCEPT_DELTA_MAX_FRACTION', 0.0)
+    tu.update_db_cpp(new_synonyms)
+    assert not os.path.exists(os.path.join(tu.resource_dir(), tu.CONCEPT_DELTA_STORE_NAME))
+    store = tu.open_concept_store(tu.resource_dir())
+    assert store is not None and store.delta is None
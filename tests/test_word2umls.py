@@ -0,0 +1,57 @@
+import time
+import pytest
+
+# 英語に翻訳して検索すると、日本語の検索では見つからない頭痛(C0018681)も見つかる
+QUERY = '頭痛と心不全'
+ENGLISH_ONLY_CUI = 'C0018681'
+
+
+def cuis(scored_concept):
+    return [cui for cui, _ in scored_concept]
+
+
+def test_untranslated_spans_are_reported(tu, mapper):
+    untranslated = set()
+    querys_list = [['身長'], [QUERY]]
+    results = tu.word2UMLS_many(querys_list, mapper.searcher, 'UMLS', untranslated=untranslated)
+    assert untranslated == set()
+    assert ENGLISH_ONLY_CUI in cuis(results[1])
+    mapper.backend.down = True
+    # 翻訳の結果はキャッシュされているので、問い合わせない語は失敗しない
+    assert tu.word2UMLS_many(querys_list, mapper.searcher, 'UMLS', untranslated=untranslated) == results
+    assert untranslated == set()
+    # 身長の訳語はキャッシュにある
+    tu.word2UMLS_many([['身長'], ['頭痛と心不全です']], mapper.searcher, 'UMLS', untranslated=untranslated)
+    assert untranslated == {1}
+
+
+def test_untranslated_result_is_not_cached(mapper):
+    mapper.backend.down = True
+    degraded = mapper.word2umls(None, None, None, QUERY)
+    assert ENGLISH_ONLY_CUI not in cuis(degraded)
+    assert len(mapper.result_cache) == 0
+    assert cuis(mapper.word2umls_many([QUERY])[0]) == cuis(degraded)
+    assert len(mapper.result_cache) == 0
+    # 翻訳サービスが戻ったら英語の候補も返し、それをキャッシュする
+    mapper.backend.down = False
+    recovered = mapper.word2umls(None, None, None, QUERY)
+    assert ENGLISH_ONLY_CUI in cuis(recovered)
+    assert len(mapper.result_cache) == 1
+    assert mapper.word2umls_many([QUERY, '身長']) == [recovered, mapper.word2umls(None, None, None, '身長')]
+
+
+def test_untranslated_result_is_not_prefetched(mapper, tmp_path):
+    ann_path = str(tmp_path / 'doc.ann')
+    with open(ann_path, mode='w', encoding='utf_8') as f:
+        f.write('T1\tFinding 0 6\t%s\nT2\tFinding 7 9\t身長\n' % QUERY)
+    prefetcher = mapper.prefetcher
+    # 身長の訳語だけ先にキャッシュしておく
+    mapper.word2umls_many(['身長'])
+    mapper.backend.down = True
+    prefetcher.prefetch(ann_path)
+    deadline = time.monotonic() + 10.0
+    while prefetcher.stats()['pending'] > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # 翻訳に失敗した span は先読みの候補に入れず、検索ダイアログではその場で検索する
+    assert prefetcher.get(ann_path, 'UMLS', 'T1', QUERY.lower()) is None
+    assert prefetcher.get(ann_path, 'UMLS', 'T2', '身長') is not None
@@ -0,0 +1,42 @@
+import os
+import random
+import pytest
+
+
+def read_queries():
+    from umls_mapping import benchmark
+    queries = benchmark.read_queries(os.path.join(benchmark.BENCHMARK_DATA_DIR, benchmark.QUERIES_NAME))
+    return [querys for _, querys in queries]
+
+
+def querys_samples(seed=0):
+    rnd = random.Random(seed)
+    querys_list = read_queries()
+    # 同じ span、大文字小文字だけが違う span、複数の query を持つ span を混ぜる
+    samples = querys_list + rnd.sample(querys_list, 10) + [[querys[0].upper()] for querys in querys_list[:5]]
+    samples += [sum(rnd.sample(querys_list, 2), []) for _ in range(5)]
+    rnd.shuffle(samples)
+    return samples
+
+
+@pytest.mark.parametrize('semantic_types, fuzzy', [(None, False), (None, True), (frozenset(['Finding']), False)])
+def test_many_same_as_one_by_one(tu, searcher, semantic_types, fuzzy):
+    querys_list = querys_samples()
+    expected = [tu.word2UMLS(querys, searcher, 'UMLS', semantic_types, fuzzy) for querys in querys_list]
+    assert tu.word2UMLS_many(querys_list, searcher, 'UMLS', semantic_types, fuzzy) == expected
+    assert tu.word2UMLS_many([], searcher, 'UMLS', semantic_types, fuzzy) == []
+
+
+def test_each_query_translated_once(tu, searcher, monkeypatch):
+    translated = []
+    translate_many = searcher.translator.translate_many
+
+    def recording(texts, src='ja'):
+        translated.append(list(texts))
+        return translate_many(texts, src=src)
+    monkeypatch.setattr(searcher.translator, 'translate_many', recording)
+    querys_list = querys_samples(seed=1)
+    tu.word2UMLS_many(querys_list, searcher, 'UMLS')
+    # 翻訳はまとめて 1 回で、同じ query(小文字にしたもの)は 1 度だけ
+    assert len(translated) == 1
+    assert sorted(translated[0]) == sorted(set(query.lower() for querys in querys_list for query in querys))
@@ -0,0 +1,350 @@
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umls_mapping import text2umls as tu
+from umls_mapping.tokenizer import get_tokenizer
+from umls_mapping import instrumentation
+
+
+# ベンチマーク用のリソース(合成した UMLS_synonyms.txt の元、検査値の基準値、対訳辞書、クエリ)
+BENCHMARK_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_data')
+SEED_SYNONYMS_NAME = 'seed_synonyms.txt'
+QUERIES_NAME = 'queries.tsv'
+
+# 合成する概念(C1000000 以降)の表記に使う文字と意味タイプ
+SYNTHETIC_KANJI = '血圧身長白球数骨折頭痛心不全腎肝肺胃腸炎症高低上下左右大小急慢性正常異値検査部赤'
+SYNTHETIC_LATIN = 'abcdefghijklmnopqrstuvwxyz'
+SYNTHETIC_TYPES = ['Finding', 'Disease or Syndrome', 'Laboratory Procedure', 'Pharmacologic Substance']
+PERCENTILES = (50, 95, 99)
+
+
+def _synthetic_term(rnd):
+    if rnd.random() < 0.5:
+        return ''.join(rnd.choice(SYNTHETIC_KANJI) for _ in range(rnd.randint(2, 6)))
+    return ' '.join(''.join(rnd.choice(SYNTHETIC_LATIN) for _ in range(rnd.randint(3, 8)))
+                    for _ in range(rnd.randint(1, 3)))
+
+
+def build_fixture(resource_path, n_concepts, seed=0):
+    """
+    resource_path に benchmark_data の概念と合成した概念 n_concepts 個からなる UMLS_synonyms.txt を作り、
+    test_value.csv と translation_dict.tsv をコピーする。同じ seed なら同じ内容になる。
+    :return: UMLS_synonyms.txt の行数(ヘッダを除く)
+    """
+    if not os.path.exists(resource_path):
+        os.makedirs(resource_path)
+    for name in ('test_value.csv', 'translation_dict.tsv'):
+        shutil.copyfile(os.path.join(BENCHMARK_DATA_DIR, name), os.path.join(resource_path, name))
+    rnd = random.Random(seed)
+    n_rows = 0
+    with open(os.path.join(BENCHMARK_DATA_DIR, SEED_SYNONYMS_NAME), mode='r', encoding='utf_8') as sf, \
+            open(os.path.join(resource_path, 'UMLS_synonyms.txt'), mode='w', encoding='utf_8', newline='\n') as of:
+        for line in sf:
+            of.write(line)
+            n_rows += 1
+        n_rows -= 1
+        writer = csv.writer(of, delimiter='\t', lineterminator='\n', quoting=csv.QUOTE_ALL)
+        for i in range(n_concepts):
+            cui = 'C%07d' % (1000000 + i)
+            s_type = rnd.choice(SYNTHETIC_TYPES)
+            synonyms = []
+            for _ in range(rnd.randint(1, 4)):
+                synonym = _synthetic_term(rnd)
+                if synonym not in synonyms:
+                    synonyms.append(synonym)
+            for synonym in synonyms:
+                writer.writerow([cui, s_type, synonym, synonyms[0], rnd.choice(['', '0', '1'])])
+                n_rows += 1
+    return n_rows
+
+
+def copy_synonyms(resource_path, synonyms_path):
+    """
+    resource_path に synonyms_path の UMLS_synonyms.txt (と build_profile.json)をコピーし、
+    test_value.csv と translation_dict.tsv は benchmark_data のものをコピーする。
+    :return: UMLS_synonyms.txt の行数(ヘッダを除く)
+    """
+    if not os.path.exists(resource_path):
+        os.makedirs(resource_path)
+    for name in ('test_value.csv', 'translation_dict.tsv'):
+        shutil.copyfile(os.path.join(BENCHMARK_DATA_DIR, name), os.path.join(resource_path, name))
+    # build_profile.json は UMLS_synonyms.txt の mtime を記録しているので、mtime ごとコピーする
+    shutil.copy2(synonyms_path, os.path.join(resource_path, 'UMLS_synonyms.txt'))
+    profile_path = os.path.join(os.path.dirname(os.path.abspath(synonyms_path)), tu.BUILD_PROFILE_NAME)
+    if os.path.exists(profile_path):
+        shutil.copy2(profile_path, os.path.join(resource_path, tu.BUILD_PROFILE_NAME))
+    with open(synonyms_path, mode='r', encoding='utf_8') as f:
+        return sum(1 for _ in f) - 1
+
+
+def index_bytes(resource_path):
+    """init_db_cpp で作る検索用のファイル(simstring DB, umls_synonyms.db, concept store)の合計サイズ"""
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(resource_path, '*'))
+               if os.path.basename(path).startswith(('UMLS.', 'umls_')))
+
+
+def read_queries(path):
+    """:return: [(カテゴリ, [クエリ, ...]), ...]"""
+    queries = []
+    with open(path, mode='r', encoding='utf_8') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if len(row) < 2 or row[0].startswith('#'):
+                continue
+            queries.append((row[0], row[1:]))
+    return queries
+
+
+def percentile(sorted_values, p):
+    """sorted_values の p パーセンタイル(線形補間)"""
+    if len(sorted_values) == 0:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(latencies):
+    """
+    :param latencies: 1 回ごとの所要時間(秒)
+    :return: 件数、スループット(回/秒)、パーセンタイル(ミリ秒)
+    """
+    values = sorted(latencies)
+    total = sum(values)
+    summary = {'count': len(values), 'total_sec': total,
+               'throughput': len(values) / total if total > 0 else None}
+    for p in PERCENTILES:
+        value = percentile(values, p)
+        summary['p%d_ms' % p] = None if value is None else value * 1000.0
+    summary['mean_ms'] = total / len(values) * 1000.0 if values else None
+    summary['max_ms'] = values[-1] * 1000.0 if values else None
+    return summary
+
+
+def _timed(latencies, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    latencies.append(time.perf_counter() - start)
+    return result
+
+
+def run(args, synonyms_path=None, work_dir=None):
+    """
+    :param synonyms_path: 合成した辞書の代わりに使う UMLS_synonyms.txt (convert_umls2simstring.py の出力)
+    :param work_dir: リソースを置くディレクトリ(None なら args.work_dir、それも無ければ一時ディレクトリ)
+    """
+    keep_work_dir = (work_dir or args.work_dir) is not None
+    work_dir = work_dir or args.work_dir or tempfile.mkdtemp(prefix='umls_benchmark_')
+    resource_path = os.path.abspath(os.path.join(work_dir, 'resource'))
+    # text2umls のリソースをベンチマーク用のディレクトリに向ける。翻訳は対訳辞書でオフラインに行う
+    tu.UMLS_DB_PATH = resource_path
+    tu.TRANSLATOR_BACKEND = 'dictionary'
+    tu.NGRAM = args.ngram
+    tu.SEARCH_THRESHOLD = args.threshold
+    tu.SEARCH_TOP_K = args.top_k
+    tu.EXACT_MATCH_MIN_CUIS = args.exact_min_cuis
+    tu.SEARCH_ENGINE = args.engine
+    tu.USE_CONCEPT_STORE = not args.sql
+    # --semantic_types のときは、その SemanticType の検索用 DB を作り、限定して検索する
+    semantic_types = frozenset(args.semantic_types) if args.semantic_types else None
+    tu.ENTITY_SEMANTIC_TYPES = {'benchmark': sorted(semantic_types)} if semantic_types else {}
+    if synonyms_path is not None:
+        n_rows = copy_synonyms(resource_path, synonyms_path)
+    else:
+        n_rows = build_fixture(resource_path, args.concepts, args.seed)
+    queries = read_queries(args.queries)
+
+    # init_db_cpp (最初の 1 回だけ pandas / sklearn の import 時間が入らないように先に import しておく)
+    tu.english_stop_words()
+    import pandas
+    init_latencies = []
+    for _ in range(args.init_repeat):
+        with open(os.devnull, mode='w') as devnull, contextlib.redirect_stdout(devnull):
+            _timed(init_latencies, tu.init_db_cpp)
+
+    build_profile = tu.read_build_profile(resource_path)
+    searcher = tu.load_dct().scoped(semantic_types)
+    test_value_index = tu.test_value_set()
+    tokenizer = get_tokenizer()
+    # UmlsMapper.word2umls と同じく小文字にしてから検査値を正規化する
+    lowered = [(category, [q.lower() for q in querys]) for category, querys in queries]
+    normalized = [(category, tu.lab_value_normalization(querys, test_value_index)) for category, querys in lowered]
+
+    # --stages のときは計測する回の word2UMLS を stage ごとに集計する
+    metrics = instrumentation.MetricsExporter() if args.stages else None
+    stage_instrumentation = instrumentation.StageInstrumentation([metrics]) if args.stages else None
+    latencies = {'lab_value_normalization': [], 'ranked_search': [], 'word2UMLS': []}
+    # 1 回の word2UMLS_many でクエリ全体(1 周分)をまとめて処理する時間
+    batch_latencies = []
+    category_latencies = {}
+    candidates = []
+    for iteration in range(args.warmup + args.repeat):
+        measured = iteration >= args.warmup
+        for (category, querys), (_, norm_querys) in zip(lowered, normalized):
+            lab, ranked, word = [], [], []
+            _timed(lab, tu.lab_value_normalization, querys, test_value_index)
+            for query in norm_querys:
+                result = _timed(ranked, searcher.ranked_search, query)
+                if measured:
+                    candidates.append(len(result))
+            if args.cold:
+                tokenizer.cache.clear()
+            if measured and stage_instrumentation is not None:
+                instrumentation.set_instrumentation(stage_instrumentation)
+            _timed(word, tu.word2UMLS, norm_querys, searcher, 'UMLS', semantic_types)
+            instrumentation.set_instrumentation(None)
+            if measured:
+                latencies['lab_value_normalization'].extend(lab)
+                latencies['ranked_search'].extend(ranked)
+                latencies['word2UMLS'].extend(word)
+                category_latencies.setdefault(category, []).extend(word)
+        if args.cold:
+            tokenizer.cache.clear()
+        batch = []
+        _timed(batch, tu.word2UMLS_many, [norm_querys for _, norm_querys in normalized], searcher, 'UMLS',
+               semantic_types)
+        if measured:
+            batch_latencies.extend(batch)
+    searcher.close()
+
+    results = {'init_db_cpp': summarize(init_latencies)}
+    for name, values in latencies.items():
+        results[name] = summarize(values)
+    results['ranked_search']['mean_candidates'] = sum(candidates) / len(candidates) if candidates else None
+    results['word2UMLS_many'] = summarize(batch_latencies)
+    # word2UMLS を 1 つずつ呼んだ場合と比べるため、span(queries の 1 行)あたりの処理数も出す
+    spans = len(queries) * len(batch_latencies)
+    results['word2UMLS_many']['spans_per_sec'] = spans / results['word2UMLS_many']['total_sec'] \
+        if batch_latencies and results['word2UMLS_many']['total_sec'] > 0 else None
+    report = {
+        'config': {
+            'ngram': args.ngram,
+            'threshold': args.threshold,
+            'top_k': args.top_k,
+            'exact_min_cuis': args.exact_min_cuis,
+            'engine': args.engine,
+            'concept_store': not args.sql,
+            'semantic_types': sorted(semantic_types) if semantic_types else None,
+            'synonyms': synonyms_path,
+            'profile': build_profile['profile'] if build_profile is not None else None,
+            'index_bytes': index_bytes(resource_path),
+            'concepts': args.concepts if synonyms_path is None else None,
+            'synonym_rows': n_rows,
+            'queries': len(queries),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'cold': args.cold,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'scorer': searcher.scorer is not None,
+        },
+        'results': results,
+        'word2UMLS_by_category': {category: summarize(values) for category, values in category_latencies.items()},
+    }
+    if metrics is not None:
+        report['word2UMLS_stages'] = metrics.snapshot()
+    if not keep_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report, file=sys.stdout):
+    config = report['config']
+    print('engine={engine} concept_store={concept_store} semantic_types={semantic_types} NGRAM={ngram} threshold={threshold} top_k={top_k} exact_min_cuis={exact_min_cuis} profile={profile} concepts={concepts} rows={synonym_rows} queries={queries} '
+          'repeat={repeat}'.format(**config), file=file)
+    rows = [(name, summary) for name, summary in report['results'].items()]
+    rows += [('word2UMLS[%s]' % category, summary) for category, summary in report['word2UMLS_by_category'].items()]
+    print('{:<32}{:>8}{:>10}{:>10}{:>10}{:>12}'.format('', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/sec'),
+          file=file)
+    for name, summary in rows:
+        print('{:<32}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}'.format(
+            name, summary['count'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'],
+            summary['throughput'] or 0.0), file=file)
+    batch = report['results'].get('word2UMLS_many')
+    if batch is not None and batch.get('spans_per_sec') is not None:
+        print('spans/sec: word2UMLS {:.1f}, word2UMLS_many {:.1f}'.format(
+            report['results']['word2UMLS']['throughput'] or 0.0, batch['spans_per_sec']), file=file)
+    stages = report.get('word2UMLS_stages')
+    if stages is not None:
+        print('{:<32}{:>8}{:>10}{:>10}'.format('word2UMLS stage', 'count', 'total ms', 'max ms'), file=file)
+        for name, stat in sorted(stages['stages'].items(), key=lambda x: -x[1]['total_sec']):
+            print('{:<32}{:>8}{:>10.1f}{:>10.3f}'.format(
+                name, stat['count'], stat['total_sec'] * 1000.0, stat['max_sec'] * 1000.0), file=file)
+        print(' '.join('{}={}'.format(name, n) for name, n in sorted(stages['counts'].items())), file=file)
+
+
+def print_profile_summary(reports, file=sys.stdout):
+    """--synonyms で複数の辞書を測ったときに、索引の大きさと候補数を最初の辞書と比べる"""
+    base = reports[0]
+    print('{:<24}{:>12}{:>12}{:>12}{:>12}{:>14}'.format('profile', 'rows', 'index MB', 'candidates', 'reduction',
+                                                        'word2UMLS/s'), file=file)
+    for report in reports:
+        config = report['config']
+        candidates = report['results']['ranked_search']['mean_candidates']
+        base_candidates = base['results']['ranked_search']['mean_candidates']
+        reduction = 1.0 - candidates / base_candidates if candidates is not None and base_candidates else None
+        print('{:<24}{:>12}{:>12.1f}{:>12.1f}{:>12}{:>14.1f}'.format(
+            config['profile'] or os.path.basename(os.path.dirname(os.path.abspath(config['synonyms']))),
+            config['synonym_rows'], config['index_bytes'] / 1024.0 / 1024.0, candidates or 0.0,
+            '-' if report is base or reduction is None else '{:.1f}%'.format(reduction * 100.0),
+            report['results']['word2UMLS']['throughput'] or 0.0), file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='latency benchmark of the UMLS lookup pipeline (offline)')
+    parser.add_argument('--concepts', type=int, default=20000, help='number of synthetic concepts added to the fixture')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measured passes over the query corpus')
+    parser.add_argument('--warmup', type=int, default=1, help='number of passes before measuring')
+    parser.add_argument('--init_repeat', type=int, default=3, help='number of init_db_cpp runs')
+    parser.add_argument('--ngram', type=int, default=tu.NGRAM)
+    parser.add_argument('--threshold', type=float, default=tu.SEARCH_THRESHOLD)
+    parser.add_argument('--engine', type=str, default=tu.SEARCH_ENGINE, choices=['simstring', 'ngram_index'])
+    parser.add_argument('--sql', action='store_true', help='look up synonyms with SQL instead of the concept store')
+    parser.add_argument('--semantic_types', type=str, nargs='*', default=None,
+                        help='search only these SemanticTypes (as for a brat entity type in ENTITY_SEMANTIC_TYPES)')
+    parser.add_argument('--top_k', type=int, default=tu.SEARCH_TOP_K, help='top-k search (0: return every candidate)')
+    parser.add_argument('--exact_min_cuis', type=int, default=tu.EXACT_MATCH_MIN_CUIS,
+                        help='skip fuzzy search when an exact synonym match has this many CUIs (0: always fuzzy)')
+    parser.add_argument('--synonyms', type=str, nargs='+', default=None,
+                        help='benchmark these UMLS_synonyms.txt (e.g. built with different convert_umls2simstring.py --profile) instead of the synthetic fixture, and compare them')
+    parser.add_argument('--queries', type=str, default=os.path.join(BENCHMARK_DATA_DIR, QUERIES_NAME))
+    parser.add_argument('--cold', action='store_true', help='clear the MeCab result cache before each word2UMLS call')
+    parser.add_argument('--stages', action='store_true', help='also report per-stage timings of word2UMLS')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', type=str, default=None, help='keep the generated resource here (default: a temporary directory)')
+    parser.add_argument('--output', type=str, default=None, help='write the results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    if args.synonyms is None:
+        report = run(args)
+        reports = [report]
+    else:
+        # 辞書ごとに別のディレクトリで測る
+        reports = [run(args, synonyms_path, os.path.join(args.work_dir, str(i)) if args.work_dir else None)
+                   for i, synonyms_path in enumerate(args.synonyms)]
+        report = {'profiles': reports}
+    if args.output == '-':
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        for r in reports:
+            print_report(r)
+        if args.synonyms is not None:
+            print_profile_summary(reports)
+        if args.output is not None:
+            with open(args.output, mode='w', encoding='utf_8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
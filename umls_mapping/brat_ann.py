@@ -0,0 +1,89 @@
+import os
+import re
+from collections import namedtuple
+
+
+# brat の standoff 形式(.ann)の text-bound annotation
+# offsets は [(start, end), ...] (不連続な span は複数になる)
+TextBound = namedtuple('TextBound', ['id', 'type', 'offsets', 'text'])
+# N 行: N1<TAB>Reference T1 UMLS:C0000000<TAB>name
+Normalization = namedtuple('Normalization', ['id', 'target', 'database', 'key', 'name'])
+
+_offset_re = re.compile(r'^(\d+) (\d+)$')
+
+
+def parse_ann_lines(lines):
+    """
+    .ann の行から text-bound annotation と normalization を取り出す。それ以外の行は無視する。
+    :return: (text_bounds, normalizations)
+    """
+    text_bounds, normalizations = [], []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('T'):
+            fields = line.split('\t')
+            if len(fields) < 3:
+                continue
+            type_offsets = fields[1].split(' ', 1)
+            if len(type_offsets) < 2:
+                continue
+            offsets = []
+            for part in type_offsets[1].split(';'):
+                m = _offset_re.match(part)
+                if m is None:
+                    offsets = None
+                    break
+                offsets.append((int(m.group(1)), int(m.group(2))))
+            if offsets:
+                text_bounds.append(TextBound(fields[0], type_offsets[0], tuple(offsets), fields[2]))
+        elif line.startswith('N'):
+            fields = line.split('\t')
+            args = fields[1].split(' ') if len(fields) > 1 else []
+            if len(args) < 3 or ':' not in args[2]:
+                continue
+            database, key = args[2].split(':', 1)
+            normalizations.append(Normalization(fields[0], args[1], database, key,
+                                                fields[2] if len(fields) > 2 else ''))
+    return text_bounds, normalizations
+
+
+def read_ann(ann_path):
+    """
+    :return: (.ann の全行, text_bounds, normalizations)
+    """
+    if not os.path.exists(ann_path):
+        return [], [], []
+    with open(ann_path, mode='r', encoding='utf_8') as f:
+        lines = f.read().splitlines()
+    text_bounds, normalizations = parse_ann_lines(lines)
+    return lines, text_bounds, normalizations
+
+
+def find_text_bound(ann_path, annotation_id):
+    """ann_path の中の annotation_id の text-bound annotation を返す(無ければ None)"""
+    for text_bound in read_ann(ann_path)[1]:
+        if text_bound.id == annotation_id:
+            return text_bound
+    return None
+
+
+def next_ids(lines, prefix):
+    """prefix(N, # など)の ID のうち、まだ使われていない番号を順に返す"""
+    used = set()
+    for line in lines:
+        ann_id = line.split('\t', 1)[0]
+        if ann_id.startswith(prefix) and ann_id[len(prefix):].isdigit():
+            used.add(int(ann_id[len(prefix):]))
+    n = 1
+    while True:
+        if n not in used:
+            yield '%s%d' % (prefix, n)
+        n += 1
+
+
+def format_normalization(n_id, target, database, key, name):
+    return '%s\tReference %s %s:%s\t%s' % (n_id, target, database, key, name.replace('\t', ' ').replace('\n', ' '))
+
+
+def format_note(note_id, target, note):
+    return '%s\tAnnotatorNotes %s\t%s' % (note_id, target, note.replace('\t', ' ').replace('\n', ' '))
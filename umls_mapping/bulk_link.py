@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import multiprocessing
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umls_mapping import brat_ann
+
+
+def find_documents(data_dir):
+    """data_dir 以下の brat 文書(.txt)を拡張子なしのパスで返す"""
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.txt'):
+                yield os.path.join(root, name[:-len('.txt')])
+
+
+def rank_candidates(scored_concept, keep_unknown=False):
+    """
+    word2umls の結果から Unknown を除き、brat の検索ダイアログと同じ順(score, in_use の降順)に並べる。
+    keep_unknown が True なら、他に候補が無いときだけ Unknown を返す(Unknown の score は他の候補より高いので順位付けには入れない)。
+    """
+    from umls_mapping.text2umls import UNKNOWN_CUI
+    ranked = sorted([x for x in scored_concept if x[0] != UNKNOWN_CUI], reverse=True, key=lambda x: (x[1][0], x[1][4]))
+    if keep_unknown and len(ranked) == 0:
+        ranked = [x for x in scored_concept if x[0] == UNKNOWN_CUI]
+    return ranked
+
+
+_database = None
+
+
+def _init_worker(database):
+    global _database
+    from umls_mapping.word2umls import UmlsMapper
+    UmlsMapper()
+    _database = database
+
+
+def _link(batch):
+    from umls_mapping.word2umls import UmlsMapper
+    texts, semantic_types = batch
+    return [((text, semantic_types), scored_concept)
+            for text, scored_concept in zip(texts, UmlsMapper.word2umls_many(texts, _database, semantic_types))]
+
+
+def link_texts(queries, database, workers, batch_size=64):
+    """
+    queries(重複なし)を batch_size 個ずつ process pool で word2umls_many にかける
+    :param queries: [(span の文字列, 検索する SemanticType の frozenset または None), ...]
+    :return: {query: scored_concept}
+    """
+    # word2umls_many は SemanticType の組ごとに呼ぶ
+    texts_by_types = {}
+    for text, semantic_types in queries:
+        texts_by_types.setdefault(semantic_types, []).append(text)
+    batches = [(texts[start:start + batch_size], semantic_types) for semantic_types, texts in texts_by_types.items()
+               for start in range(0, len(texts), batch_size)]
+    results = {}
+    start_time = time.time()
+    reported = 0
+    with multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(database,)) as pool:
+        for linked in pool.imap_unordered(_link, batches):
+            results.update(linked)
+            if len(results) - reported >= 1000:
+                reported = len(results)
+                elapsed = time.time() - start_time
+                print('{}/{} spans, {:.1f} spans/sec'.format(len(results), len(queries), len(results) / max(elapsed, 1e-6)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Link every text-bound annotation of a brat collection to UMLS')
+    parser.add_argument('--data_dir', type=str, required=True, help='brat data directory (searched recursively)')
+    parser.add_argument('--output_dir', type=str, required=True, help='directory to write the linked collection to')
+    parser.add_argument('--database', type=str, default='UMLS', help='normalization DB name used in tools.conf')
+    parser.add_argument('--types', type=str, nargs='*', default=None, help='entity types to link (default: all)')
+    parser.add_argument('--candidates', type=int, default=0,
+                        help='also write the top N candidates as an AnnotatorNotes line')
+    parser.add_argument('--keep_unknown', action='store_true', help='write Unknown when nothing else is found')
+    parser.add_argument('--overwrite', action='store_true', help='re-link spans that already have a normalization')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # 文書と span を集め、同じ文字列は(検索する SemanticType ごとに)一度だけ検索する
+    from umls_mapping.text2umls import semantic_types_for_entity
+    documents = []
+    queries = {}
+    for doc in find_documents(args.data_dir):
+        lines, text_bounds, normalizations = brat_ann.read_ann(doc + '.ann')
+        linked = set(n.target for n in normalizations if n.database == args.database)
+        targets = [t for t in text_bounds
+                   if (args.types is None or t.type in args.types) and (args.overwrite or t.id not in linked)]
+        for t in targets:
+            queries.setdefault((t.text.lower(), semantic_types_for_entity(t.type)), None)
+        documents.append((doc, lines, targets))
+    n_spans = sum(len(targets) for _, _, targets in documents)
+    print('{} documents, {} spans, {} distinct queries'.format(len(documents), n_spans, len(queries)))
+
+    results = link_texts(list(queries), args.database, args.workers)
+
+    n_linked = 0
+    for doc, lines, targets in documents:
+        out_base = os.path.join(args.output_dir, os.path.relpath(doc, args.data_dir))
+        os.makedirs(os.path.dirname(out_base), exist_ok=True)
+        shutil.copyfile(doc + '.txt', out_base + '.txt')
+        n_ids = brat_ann.next_ids(lines, 'N')
+        note_ids = brat_ann.next_ids(lines, '#')
+        out_lines = list(lines)
+        for t in targets:
+            ranked = rank_candidates(results.get((t.text.lower(), semantic_types_for_entity(t.type)), []),
+                                     args.keep_unknown)
+            if len(ranked) == 0:
+                continue
+            cui, (score, synonym, semantic, representative, in_use) = ranked[0]
+            out_lines.append(brat_ann.format_normalization(next(n_ids), t.id, args.database, cui, representative))
+            n_linked += 1
+            if args.candidates > 0:
+                note = ' | '.join(['%s %s (%.3f)' % (c, v[3], v[0]) for c, v in ranked[:args.candidates]])
+                out_lines.append(brat_ann.format_note(next(note_ids), t.id, note))
+        with open(out_base + '.ann', mode='w', encoding='utf_8', newline='\n') as f:
+            f.write(''.join([line + '\n' for line in out_lines]))
+    # annotation.conf などの設定ファイルもコピーしておく
+    for root, dirs, files in os.walk(args.data_dir):
+        for name in files:
+            if name.endswith('.conf'):
+                out_dir = os.path.join(args.output_dir, os.path.relpath(root, args.data_dir))
+                os.makedirs(out_dir, exist_ok=True)
+                shutil.copyfile(os.path.join(root, name), os.path.join(out_dir, name))
+    print('linked {}/{} spans'.format(n_linked, n_spans))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import glob
+import heapq
+import hashlib
+import functools
+import sqlite3 as sqlite
+import numpy as np
+
+
+# umls_synonyms テーブルを読み出し専用の配列にしたもの。init_db / update_db のときに作る。
+# 配列は memory-map して読むので、brat の複数のプロセスで同じページキャッシュを共有できる。
+#
+# path には設定(JSON)を書き、配列は path.<名前>.npy に置く。
+#   synonym_*         : synonym の文字列表(昇順)。synonym i の行は [row_offsets[i], row_offsets[i+1])
+#   synonym_hashes / synonym_hash_ids : synonym の UTF-8 のハッシュ(昇順)と synonym の番号。文字列から番号を引くのに使う
+#   row_cuis          : 各行の CUI。CUI が全て C + 数字 7 桁なら数字の部分(cui_encoding が 'int')、そうでなければ文字列表での番号
+#   row_semantics / row_representatives : 各行の SemanticType、代表表記の文字列表での番号
+#   row_in_use        : 各行の in_use
+#   cui_* / semantic_* / representative_* : 文字列表
+# 行の並びは SELECT ... ORDER BY synonym, id と同じ(SQL で synonym IN (...) を引いたときと同じ)。
+#
+# update_db では全体を作り直さず、行が変わった synonym だけの差分(delta)を同じ形式で作り、全体(base)に重ねる。
+# delta には行が無くなった synonym も行 0 個で入れ、delta にある synonym は base の行を使わない。
+STORE_FORMAT = 'concept_store'
+STORE_VERSION = 1
+STRING_TABLES = ['synonym', 'cui', 'semantic', 'representative']
+ROW_ARRAYS = ['row_offsets', 'synonym_hashes', 'synonym_hash_ids', 'row_cuis', 'row_semantics',
+              'row_representatives', 'row_in_use']
+# 作るときに SQL から一度に読む行数
+BUILD_FETCH_SIZE = 100000
+CUI_PATTERN = re.compile(r'^C[0-9]{7}$')
+# 代表表記の文字列をキャッシュする数
+REPRESENTATIVE_CACHE_SIZE = 65536
+
+
+def _array_path(path, name):
+    return '%s.%s.npy' % (path, name)
+
+
+def _id_dtype(max_value):
+    return np.uint16 if max_value <= np.iinfo(np.uint16).max else np.uint32
+
+
+def string_hashes(encoded):
+    """UTF-8 のバイト列の 64 bit ハッシュ(プロセスによらず同じ値)"""
+    digests = b''.join(hashlib.blake2b(b, digest_size=8).digest() for b in encoded)
+    return np.frombuffer(digests, dtype='<u8')
+
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class StringTable(object):
+    """UTF-8 を連結した配列と offset の配列で持つ文字列表"""
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, strings):
+        encoded = [s.encode('utf_8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf_8')
+
+    def to_list(self):
+        return [self[i] for i in range(len(self))]
+
+
+class _Interner(object):
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __call__(self, string):
+        i = self.ids.get(string)
+        if i is None:
+            i = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+
+def remove_store(path):
+    if os.path.exists(path):
+        os.remove(path)
+    for array_path in glob.glob(path + '.*.npy'):
+        os.remove(array_path)
+
+
+def _all_rows(connection):
+    """umls_synonyms の全行を synonym ごとにまとめて synonym の順に返す"""
+    cursor = connection.execute(
+        'SELECT synonym, cui, semantic, representative, in_use FROM umls_synonyms ORDER BY synonym, id')
+    synonym, rows = None, []
+    while True:
+        fetched = cursor.fetchmany(BUILD_FETCH_SIZE)
+        if not fetched:
+            break
+        for row in fetched:
+            if row[0] != synonym:
+                if synonym is not None:
+                    yield synonym, rows
+                synonym, rows = row[0], []
+            rows.append(row)
+    if synonym is not None:
+        yield synonym, rows
+
+
+def _rows_of(connection, synonyms, chunk_size=500):
+    """synonyms (昇順)の行を synonym ごとにまとめて返す(行が無い synonym も返す)"""
+    for start in range(0, len(synonyms), chunk_size):
+        chunk = synonyms[start:start + chunk_size]
+        rows_by_synonym = {}
+        for row in connection.execute(
+                'SELECT synonym, cui, semantic, representative, in_use FROM umls_synonyms WHERE synonym IN (%s)'
+                ' ORDER BY synonym, id' % ','.join(['?'] * len(chunk)), chunk):
+            rows_by_synonym.setdefault(row[0], []).append(row)
+        for synonym in chunk:
+            yield synonym, rows_by_synonym.get(synonym, [])
+
+
+def build_concept_store(synonyms_db_path, path, synonyms=None, base=None):
+    """
+    umls_synonyms.db の umls_synonyms テーブルから path に concept store を作る。
+    synonyms を渡すと、その synonym の行だけの差分を作る(base はそれを重ねる ConceptStore)。
+    :return: 行数
+    """
+    connection = sqlite.connect(synonyms_db_path)
+    if synonyms is None:
+        groups = _all_rows(connection)
+    else:
+        groups = _rows_of(connection, sorted(set(synonyms)))
+    synonyms = []
+    row_offsets = []
+    cuis, semantics, representatives = _Interner(), _Interner(), _Interner()
+    row_cuis, row_semantics, row_representatives, row_in_use = [], [], [], []
+    n_rows = 0
+    for synonym, rows in groups:
+        synonyms.append(synonym)
+        row_offsets.append(n_rows)
+        for _, cui, semantic, representative, in_use in rows:
+            row_cuis.append(cuis(cui))
+            row_semantics.append(semantics(semantic))
+            row_representatives.append(representatives(representative))
+            row_in_use.append(in_use)
+            n_rows += 1
+    connection.close()
+    row_offsets.append(n_rows)
+
+    hashes = string_hashes([synonym.encode('utf_8') for synonym in synonyms])
+    cui_encoding = 'int' if all(CUI_PATTERN.match(cui) for cui in cuis.strings) else 'table'
+    if cui_encoding == 'int':
+        cui_numbers = np.array([int(cui[1:]) for cui in cuis.strings], dtype=np.uint32)
+        row_cuis = cui_numbers[np.array(row_cuis, dtype=np.int64)]
+        cuis.strings = []
+    hash_order = np.argsort(hashes, kind='stable')
+    arrays = {
+        'row_offsets': np.array(row_offsets, dtype=np.int64),
+        'synonym_hashes': hashes[hash_order],
+        'synonym_hash_ids': hash_order.astype(np.uint32),
+        'row_cuis': row_cuis if cui_encoding == 'int' else np.array(row_cuis, dtype=_id_dtype(len(cuis.strings))),
+        'row_semantics': np.array(row_semantics, dtype=_id_dtype(len(semantics.strings))),
+        'row_representatives': np.array(row_representatives, dtype=_id_dtype(len(representatives.strings))),
+        'row_in_use': np.array(row_in_use, dtype=np.int64),
+    }
+    for name, strings in (('synonym', synonyms), ('cui', cuis.strings), ('semantic', semantics.strings),
+                          ('representative', representatives.strings)):
+        table = StringTable.build(strings)
+        arrays[name + '_blob'] = table.blob
+        arrays[name + '_offsets'] = table.offsets
+
+    remove_store(path)
+    for name, array in arrays.items():
+        np.save(_array_path(path, name), array)
+    # 設定は最後に書く。元の umls_synonyms.db と対応しているかは synonyms_db で確かめる
+    header = {'format': STORE_FORMAT, 'version': STORE_VERSION, 'rows': n_rows, 'synonyms': len(synonyms),
+              'cui_encoding': cui_encoding, 'synonyms_db': file_fingerprint(synonyms_db_path)}
+    if base is not None:
+        # 差分を重ねる base (base を作り直したら、この差分は使わない)
+        header['base'] = base.header['synonyms_db']
+    with open(path, mode='w', encoding='utf_8') as f:
+        json.dump(header, f)
+    return n_rows
+
+
+class ConceptStore(object):
+    """
+    concept store を memory-map で開く。rows_by_names() は UmlsSearcherCpp.ids_by_names() と同じ行を同じ順に返す。
+    配列は読み出し専用なので、複数のスレッドから使ってよい。update_db の差分は attach() で重ねる。
+    """
+    def __init__(self, path):
+        with open(path, mode='r', encoding='utf_8') as f:
+            header = json.load(f)
+        if header.get('format') != STORE_FORMAT or header.get('version') != STORE_VERSION:
+            raise ValueError('%s is not a concept_store (version %d) file' % (path, STORE_VERSION))
+        self.path = path
+        self.header = header
+        arrays = {}
+        for name in ROW_ARRAYS + [t + suffix for t in STRING_TABLES for suffix in ('_blob', '_offsets')]:
+            # np.memmap のままだと演算のたびに memmap を作るので、同じメモリを指す ndarray にしておく
+            arrays[name] = np.load(_array_path(path, name), mmap_mode='r').view(np.ndarray)
+        for name in ROW_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.synonyms = StringTable(arrays['synonym_blob'], arrays['synonym_offsets'])
+        self.cuis = StringTable(arrays['cui_blob'], arrays['cui_offsets'])
+        self.cui_encoding = header.get('cui_encoding', 'table')
+        self.representatives = StringTable(arrays['representative_blob'], arrays['representative_offsets'])
+        self._representative = functools.lru_cache(maxsize=REPRESENTATIVE_CACHE_SIZE)(self.representatives.__getitem__)
+        # SemanticType の種類は少ないので Python の文字列にしておく
+        self.semantics = StringTable(arrays['semantic_blob'], arrays['semantic_offsets']).to_list()
+        self.delta = None
+
+    def attach(self, delta):
+        """
+        この store に重ねて作った差分 delta を重ねる。別の store に重ねるものなら重ねない
+        :return: 重ねたか
+        """
+        if delta.header.get('base') != self.header['synonyms_db']:
+            return False
+        self.delta = delta
+        return True
+
+    def matches(self, synonyms_db_path):
+        """umls_synonyms.db から作ったものか(作った後に DB が変わっていないか)。差分を重ねていれば差分で確かめる"""
+        header = self.delta.header if self.delta is not None else self.header
+        try:
+            return header.get('synonyms_db') == file_fingerprint(synonyms_db_path)
+        except OSError:
+            return False
+
+    def synonym_ids(self, names):
+        """:return: names と同じ順の synonym の番号(numpy の配列。無いものは -1)"""
+        encoded = [name.encode('utf_8') for name in names]
+        n_hashes = len(self.synonym_hashes)
+        if len(encoded) == 0 or n_hashes == 0:
+            return np.full(len(encoded), -1, dtype=np.int64)
+        hashes = string_hashes(encoded)
+        positions = np.minimum(np.searchsorted(self.synonym_hashes, hashes), n_hashes - 1)
+        ids = np.where(self.synonym_hashes[positions] == hashes,
+                       self.synonym_hash_ids[positions].astype(np.int64), -1)
+        # ハッシュが一致したものは文字列も比べる(UTF-8 のバイト列をまとめて比べる)
+        hits = np.flatnonzero(ids >= 0)
+        if len(hits) == 0:
+            return ids
+        starts = self.synonyms.offsets[ids[hits]]
+        lengths = self.synonyms.offsets[ids[hits] + 1] - starts
+        query_lengths = np.array([len(encoded[i]) for i in hits.tolist()], dtype=np.int64)
+        same = lengths == query_lengths
+        query_bytes = np.frombuffer(b''.join([encoded[i] for i in hits[same].tolist()]), dtype=np.uint8)
+        if len(query_bytes) > 0:
+            # 長さが同じものについて、各バイトの位置の配列を作って比べる
+            counts = lengths[same]
+            positions_in_blob = np.repeat(starts[same] - (np.cumsum(counts) - counts), counts) + np.arange(len(query_bytes))
+            differs = self.synonyms.blob[positions_in_blob] != query_bytes
+            owners = np.repeat(np.arange(len(counts)), counts)
+            mismatched = np.zeros(len(counts), dtype=bool)
+            np.logical_or.at(mismatched, owners, differs)
+            same[np.flatnonzero(same)[mismatched]] = False
+        for i in hits[~same].tolist():
+            ids[i] = self._find_colliding(encoded[i], int(hashes[i]), int(positions[i]) + 1)
+        return ids
+
+    def _find_colliding(self, encoded, h, position):
+        # 別の synonym とハッシュが衝突していた場合は、同じハッシュの続きを探す
+        while position < len(self.synonym_hashes) and int(self.synonym_hashes[position]) == h:
+            candidate = int(self.synonym_hash_ids[position])
+            if self.synonyms.blob[self.synonyms.offsets[candidate]:self.synonyms.offsets[candidate + 1]].tobytes() == encoded:
+                return candidate
+            position += 1
+        return -1
+
+    def rows_by_names(self, strs, semantic_types=None):
+        """
+        :param semantic_types: SemanticType の集合。None でなければ、そのどれかを含む行だけを返す
+            (semantic は CUI の SemanticType を '/' でつないだもの)
+        :return: [(cui, synonym, semantic, representative, in_use), ...] synonym の昇順
+        """
+        if self.delta is None:
+            return self._rows_by_names(strs, semantic_types)
+        # 差分にある synonym は差分の行だけを使う。どちらも synonym の昇順なので、synonym で併合する
+        names = sorted(set(strs))
+        in_delta = (self.delta.synonym_ids(names) >= 0).tolist()
+        base_rows = self._rows_by_names([name for name, found in zip(names, in_delta) if not found], semantic_types)
+        delta_rows = self.delta._rows_by_names([name for name, found in zip(names, in_delta) if found], semantic_types)
+        return list(heapq.merge(base_rows, delta_rows, key=lambda row: row[1]))
+
+    def _rows_by_names(self, strs, semantic_types):
+        names = sorted(set(strs))
+        ids = self.synonym_ids(names)
+        found = ids >= 0
+        ids = ids[found]
+        if len(ids) == 0:
+            return []
+        names = [name for name, ok in zip(names, found.tolist()) if ok]
+        starts = self.row_offsets[ids]
+        counts = self.row_offsets[ids + 1] - starts
+        # 各 synonym の行番号を並べる
+        rows = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+        owners = np.repeat(np.arange(len(ids)), counts)
+        if semantic_types is not None:
+            allowed = [i for i, semantic in enumerate(self.semantics)
+                       if not semantic_types.isdisjoint(semantic.split('/'))]
+            keep = np.isin(self.row_semantics[rows], allowed)
+            rows, owners = rows[keep], owners[keep]
+        owners = owners.tolist()
+        if self.cui_encoding == 'int':
+            cuis = ['C%07d' % n for n in self.row_cuis[rows].tolist()]
+        else:
+            cuis = [self.cuis[i] for i in self.row_cuis[rows].tolist()]
+        semantics = self.semantics
+        representative = self._representative
+        return [(cui, names[owner], semantics[semantic], representative(rep), in_use)
+                for cui, owner, semantic, rep, in_use in zip(cuis, owners, self.row_semantics[rows].tolist(),
+                                                            self.row_representatives[rows].tolist(),
+                                                            self.row_in_use[rows].tolist())]
+
+    def close(self):
+        pass
@@ -0,0 +1,225 @@
+import time
+import heapq
+import logging
+import threading
+import contextlib
+
+
+# 何も記録しない stage / query の context manager (使い回せる)
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class NullInstrumentation(object):
+    """
+    既定の計測。何も記録しない。
+    word2UMLS などの hot path から呼ばれるので、できるだけ軽くしておく。
+    """
+    enabled = False
+
+    def query(self, querys):
+        return _NULL_CONTEXT
+
+    def stage(self, name):
+        return _NULL_CONTEXT
+
+    def count(self, name, n=1):
+        pass
+
+    def bind(self, func):
+        return func
+
+
+class QueryRecord(object):
+    """1 回の word2UMLS の計測結果。stages は stage ごとの所要時間(秒)、counts は候補数・再試行回数など"""
+    __slots__ = ('querys', 'total', 'stages', 'counts')
+
+    def __init__(self, querys):
+        self.querys = list(querys)
+        self.total = 0.0
+        self.stages = {}
+        self.counts = {}
+
+    def as_dict(self):
+        return {'querys': self.querys, 'total': self.total, 'stages': dict(self.stages), 'counts': dict(self.counts)}
+
+
+class _Stage(object):
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self.record.stages
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class _Query(object):
+    __slots__ = ('instrumentation', 'record', 'start')
+
+    def __init__(self, instrumentation, record):
+        self.instrumentation = instrumentation
+        self.record = record
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record.total = time.perf_counter() - self.start
+        self.instrumentation._finish(self.record)
+        return False
+
+
+class StageInstrumentation(object):
+    """
+    word2UMLS 1 回ごとに stage の所要時間と件数を記録し、exporters に渡す。
+    記録はスレッドごとに行う。query() の外で呼ばれた stage() / count() は無視する。
+    stage は入れ子になることがある(trim の中の retrieve など)。所要時間はそれぞれの stage で数える。
+    """
+    enabled = True
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self._local = threading.local()
+
+    def _current(self):
+        return getattr(self._local, 'record', None)
+
+    def query(self, querys):
+        if self._current() is not None:
+            # word2UMLS の中から word2UMLS が呼ばれた場合は外側にまとめる
+            return _NULL_CONTEXT
+        record = QueryRecord(querys)
+        self._local.record = record
+        return _Query(self, record)
+
+    def _finish(self, record):
+        self._local.record = None
+        for exporter in self.exporters:
+            exporter.export(record)
+
+    def stage(self, name):
+        record = self._current()
+        if record is None:
+            return _NULL_CONTEXT
+        return _Stage(record, name)
+
+    def count(self, name, n=1):
+        record = self._current()
+        if record is not None:
+            record.counts[name] = record.counts.get(name, 0) + n
+
+    def bind(self, func):
+        """
+        別のスレッドで func を呼んでも、その中の stage() / count() が今の query に記録されるようにする。
+        (word2UMLS の翻訳をスレッドプールで行う場合など)
+        """
+        record = self._current()
+        if record is None:
+            return func
+
+        def bound(*args, **kwargs):
+            previous = self._current()
+            self._local.record = record
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.record = previous
+        return bound
+
+
+class LogLineExporter(object):
+    """
+    1 回の word2UMLS を 1 行のログにする。threshold_ms 以上かかったものだけを出す(外れ値を探すため)。
+    """
+    def __init__(self, logger=None, level=logging.INFO, threshold_ms=0.0):
+        self.logger = logger if logger is not None else logging.getLogger('umls_mapping.timings')
+        self.level = level
+        self.threshold_ms = threshold_ms
+
+    def format(self, record):
+        fields = ['total=%.2fms' % (record.total * 1000.0)]
+        fields += ['%s=%.2fms' % (name, seconds * 1000.0) for name, seconds in sorted(record.stages.items())]
+        fields += ['%s=%d' % (name, n) for name, n in sorted(record.counts.items())]
+        return 'word2UMLS %s query=%s' % (' '.join(fields), '|'.join(record.querys))
+
+    def export(self, record):
+        if record.total * 1000.0 >= self.threshold_ms and self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, self.format(record))
+
+
+class MetricsExporter(object):
+    """
+    stage ごとの回数・合計・最大と、件数の合計を集計する。snapshot() で取り出す。
+    所要時間が長かった query を slowest 件だけ残す。
+    """
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.total = 0.0
+            self.stages = {}
+            self.counts = {}
+            self._slowest = []
+            self._sequence = 0
+
+    def export(self, record):
+        with self._lock:
+            self.queries += 1
+            self.total += record.total
+            for name, seconds in record.stages.items():
+                stat = self.stages.get(name)
+                if stat is None:
+                    stat = self.stages[name] = [0, 0.0, 0.0]
+                stat[0] += 1
+                stat[1] += seconds
+                stat[2] = max(stat[2], seconds)
+            for name, n in record.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            # 同じ所要時間のときに QueryRecord 同士を比べないように通し番号を挟む
+            self._sequence += 1
+            item = (record.total, self._sequence, record)
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, item)
+            elif self.slowest > 0:
+                heapq.heappushpop(self._slowest, item)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'queries': self.queries,
+                'total_sec': self.total,
+                'stages': {name: {'count': n, 'total_sec': total, 'max_sec': longest}
+                           for name, (n, total, longest) in self.stages.items()},
+                'counts': dict(self.counts),
+                'slowest': [record.as_dict() for _, _, record in sorted(self._slowest, reverse=True)],
+            }
+
+
+_instrumentation = NullInstrumentation()
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+    """
+    計測を差し替える。None を渡すと既定(何も記録しない)に戻す。
+    :return: それまでの計測
+    """
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation if instrumentation is not None else NullInstrumentation()
+    return previous
@@ -0,0 +1,133 @@
+import os
+import json
+import socket
+import threading
+import http.client
+
+
+# lookup_server.py の待ち受け先。'http://127.0.0.1:8765' または 'unix:/path/to/socket'
+DEFAULT_SERVER = os.environ.get('UMLS_LOOKUP_SERVER', 'http://127.0.0.1:8765')
+DEFAULT_TIMEOUT = 30.0
+
+
+class LookupServerError(Exception):
+    pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.unix_path)
+        self.sock = sock
+
+
+class UmlsLookupClient(object):
+    """
+    lookup_server.py への軽量クライアント。接続はスレッドごとに張りっぱなしにして再利用する。
+    """
+    def __init__(self, server=DEFAULT_SERVER, timeout=DEFAULT_TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.server.startswith('unix:'):
+                connection = _UnixHTTPConnection(self.server[len('unix:'):], timeout=self.timeout)
+            else:
+                address = self.server.split('://', 1)[-1].rstrip('/')
+                connection = http.client.HTTPConnection(address, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload).encode('utf_8')
+        headers = {'Content-Type': 'application/json'}
+        # サーバが接続を切っていた場合に備えて 1 回だけ張り直す
+        for retry in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = json.loads(response.read().decode('utf_8'))
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                self._local.connection = None
+                if retry == 1:
+                    raise LookupServerError('lookup server %s: %s' % (self.server, e))
+            except OSError as e:
+                connection.close()
+                self._local.connection = None
+                raise LookupServerError('lookup server %s: %s' % (self.server, e))
+        if response.status != 200:
+            raise LookupServerError(data.get('error', 'HTTP %d' % response.status))
+        return data
+
+    def word2umls(self, collection, document, annotation_id, query_string='', database='UMLS', semantic_types=None,
+                  fuzzy=False):
+        data = self._request('POST', '/word2umls', {
+            'collection': collection,
+            'document': document,
+            'annotation_id': annotation_id,
+            'query_string': query_string,
+            'database': database,
+            'semantic_types': sorted(semantic_types) if semantic_types else None,
+            'fuzzy': fuzzy,
+        })
+        # JSON ではタプルがリストになるので UmlsMapper.word2umls と同じ形に戻す
+        return [(cui, tuple(values)) for cui, values in data['result']]
+
+    def word2umls_many(self, query_strings, database='UMLS', semantic_types=None, fuzzy=False):
+        data = self._request('POST', '/word2umls_many', {
+            'query_strings': list(query_strings),
+            'database': database,
+            'semantic_types': sorted(semantic_types) if semantic_types else None,
+            'fuzzy': fuzzy,
+        })
+        return [[(cui, tuple(values)) for cui, values in result] for result in data['results']]
+
+    def prefetch(self, collection, document, database='UMLS'):
+        data = self._request('POST', '/prefetch', {
+            'collection': collection,
+            'document': document,
+            'database': database,
+        })
+        return data['scheduled']
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+
+class RemoteUmlsMapper(object):
+    """
+    UmlsMapper と同じ呼び出し方で lookup_server.py に問い合わせる。
+    brat の norm.py では `from umls_mapping.lookup_client import RemoteUmlsMapper as UmlsMapper` とすればよい。
+    """
+    client = None
+
+    @classmethod
+    def word2umls(cls, collection, document, annotation_id, query_string='', database='UMLS', semantic_types=None,
+                  fuzzy=False):
+        if cls.client is None:
+            cls.client = UmlsLookupClient()
+        return cls.client.word2umls(collection, document, annotation_id, query_string, database, semantic_types,
+                                    fuzzy)
+
+    @classmethod
+    def word2umls_many(cls, query_strings, database='UMLS', semantic_types=None, fuzzy=False):
+        if cls.client is None:
+            cls.client = UmlsLookupClient()
+        return cls.client.word2umls_many(query_strings, database, semantic_types, fuzzy)
+
+    @classmethod
+    def prefetch(cls, collection, document, database='UMLS'):
+        if cls.client is None:
+            cls.client = UmlsLookupClient()
+        return cls.client.prefetch(collection, document, database)
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umls_mapping.word2umls import UmlsMapper
+from umls_mapping import instrumentation
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """
+    POST /word2umls  {"collection", "document", "annotation_id", "query_string", "database",
+                      "semantic_types"(省略可), "fuzzy"(省略可)}
+                     -> {"result": [...]}
+    POST /word2umls_many {"query_strings": [...], "database", "semantic_types"(省略可), "fuzzy"(省略可)}
+                     -> {"results": [[...], ...]}
+    POST /prefetch   {"collection", "document", "database"} -> {"scheduled": 新たに検索する span の数}
+    GET  /stats      キャッシュの統計と起動時間の内訳(--timings のときは stage ごとの所要時間も)
+    GET  /health
+    """
+    protocol_version = 'HTTP/1.1'
+    verbose = False
+    # --timings のときの instrumentation.MetricsExporter
+    metrics = None
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = {'cache': UmlsMapper.cache_stats(), 'prefetch': UmlsMapper.prefetch_stats(),
+                     'build_profile': UmlsMapper.build_profile(), 'uptime': time.time() - self.server.started_at,
+                     'startup': UmlsMapper.startup_report()}
+            if self.metrics is not None:
+                stats['stages'] = self.metrics.snapshot()
+            self._send(200, stats)
+        elif self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': 'not found: %s' % self.path})
+
+    def do_POST(self):
+        if self.path not in ('/word2umls', '/word2umls_many', '/prefetch'):
+            self._send(404, {'error': 'not found: %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf_8'))
+            if self.path == '/prefetch':
+                response = {'scheduled': UmlsMapper.prefetch(request.get('collection'), request.get('document'),
+                                                             request.get('database', 'UMLS'))}
+            elif self.path == '/word2umls_many':
+                response = {'results': UmlsMapper.word2umls_many(request.get('query_strings', []),
+                                                                 request.get('database', 'UMLS'),
+                                                                 request.get('semantic_types'),
+                                                                 bool(request.get('fuzzy', False)))}
+            else:
+                response = {'result': UmlsMapper.word2umls(request.get('collection'), request.get('document'),
+                                                           request.get('annotation_id'),
+                                                           request.get('query_string', ''),
+                                                           request.get('database', 'UMLS'),
+                                                           request.get('semantic_types'),
+                                                           bool(request.get('fuzzy', False)))}
+        except Exception as e:
+            self._send(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        self._send(200, response)
+
+    def _send(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf_8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix ソケットでは client_address が空になる
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super(LookupHandler, self).log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(host='127.0.0.1', port=8765, socket_path=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, LookupHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), LookupHandler)
+        server.daemon_threads = True
+    server.started_at = time.time()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UMLS lookup server shared by brat workers')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', type=str, default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--timings', action='store_true', help='record per-stage timings of word2UMLS and report them in /stats')
+    parser.add_argument('--slow_ms', type=float, default=None, help='log a timing line for lookups slower than this (implies --timings)')
+    args = parser.parse_args()
+
+    if args.timings or args.slow_ms is not None:
+        LookupHandler.metrics = instrumentation.MetricsExporter()
+        exporters = [LookupHandler.metrics]
+        if args.slow_ms is not None:
+            logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+            exporters.append(instrumentation.LogLineExporter(threshold_ms=args.slow_ms))
+        instrumentation.set_instrumentation(instrumentation.StageInstrumentation(exporters))
+
+    start_time = time.time()
+    UmlsMapper()
+    print('dictionary loaded in {:.1f} sec ({})'.format(
+        time.time() - start_time,
+        ', '.join('{} {:.2f}s'.format(k, v) for k, v in UmlsMapper.startup_report().items())))
+    LookupHandler.verbose = args.verbose
+    server = make_server(args.host, args.port, args.socket)
+    print('listening on {}'.format('unix:' + args.socket if args.socket else 'http://%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
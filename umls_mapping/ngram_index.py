@@ -0,0 +1,211 @@
+import os
+import json
+import glob
+import math
+import numpy as np
+from umls_mapping.scoring import ngram_codes, MAX_PACKED_NGRAM
+
+
+# simstring_cpp の代わりに使える n-gram 転置インデックス(numpy のみで動く)。
+# simstring_cpp.writer / reader と同じく、writer に文字列を insert して close し、reader の retrieve で
+# cosine 類似度が threshold 以上の文字列を引く。特徴量は simstring の C++ 版と同じく、
+# n-gram に文字列内での出現回数を付けて区別したもの。
+#
+# path には設定(JSON)を書き、配列は path.<名前>.npy に置く。配列は読み出し時に memory-map する。
+#   strings.npy          : 全文字列の UTF-8 を連結したもの(uint8)
+#   string_offsets.npy   : 文字列 i の UTF-8 は strings[string_offsets[i]:string_offsets[i+1]]
+#   size_offsets.npy     : 文字列は特徴量数の順に番号を振ってあり、特徴量数 l の文字列の番号は [size_offsets[l], size_offsets[l+1])
+#   feature_codes.npy    : 特徴量の n-gram (uint64 に詰めたもの、昇順)
+#   feature_occurrences.npy : 特徴量の出現回数(同じ n-gram の中で昇順、1 から連番)
+#   feature_offsets.npy  : 特徴量 f を含む文字列の番号は postings[feature_offsets[f]:feature_offsets[f+1]] (昇順)
+#   postings.npy         : 文字列の番号(文字列数に合わせて uint16 / uint32)
+INDEX_FORMAT = 'ngram_index'
+INDEX_VERSION = 1
+ARRAY_NAMES = ['strings', 'string_offsets', 'size_offsets', 'feature_codes', 'feature_occurrences',
+               'feature_offsets', 'postings']
+# simstring の C++ 版が n-gram の穴埋めに使う文字
+DEFAULT_MARK = '\x01'
+# 特徴量を作るときに一度に処理する文字列の数
+BUILD_CHUNK_SIZE = 200000
+
+# 類似度(simstring_cpp.cosine に合わせた名前)。cosine だけに対応する
+cosine = 'cosine'
+
+
+def _array_path(path, name):
+    return '%s.%s.npy' % (path, name)
+
+
+def _min_dtype(max_value):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def features(strings, n, be=False, mark=DEFAULT_MARK):
+    """
+    strings の各文字列の特徴量を返す。
+    :return: (codes, occurrences, owners) 特徴量 i は n-gram codes[i] の occurrences[i] 回目の出現で、文字列 owners[i] のもの
+    """
+    codes, owners = ngram_codes(strings, n, mark, be)
+    # (文字列, n-gram) ごとに何回目の出現かを数える
+    order = np.lexsort((codes, owners))
+    codes, owners = codes[order], owners[order]
+    boundary = np.ones(len(codes), dtype=bool)
+    boundary[1:] = (codes[1:] != codes[:-1]) | (owners[1:] != owners[:-1])
+    group_starts = np.flatnonzero(boundary)
+    positions = np.arange(len(codes))
+    occurrences = positions - group_starts[np.cumsum(boundary) - 1] + 1
+    return codes, occurrences, owners
+
+
+def remove_index(path):
+    if os.path.exists(path):
+        os.remove(path)
+    for array_path in glob.glob(path + '.*.npy'):
+        os.remove(array_path)
+
+
+class NgramIndexWriter(object):
+    """
+    simstring_cpp.writer(path, n, be, unicode) と同じ使い方でインデックスを作る。索引は close() でまとめて作る。
+    """
+    def __init__(self, path, n, be=False, unicode=True, mark=DEFAULT_MARK):
+        if not 1 <= n <= MAX_PACKED_NGRAM:
+            raise ValueError('n must be between 1 and %d: %d' % (MAX_PACKED_NGRAM, n))
+        self.path = path
+        self.n = n
+        self.be = be
+        self.mark = mark
+        self.strings = []
+
+    def insert(self, string):
+        self.strings.append(string)
+
+    def close(self):
+        strings = sorted(set(self.strings))
+        self.strings = []
+        # 特徴量数を数えて、特徴量数の順に文字列の番号を振り直す
+        sizes = np.zeros(len(strings), dtype=np.int64)
+        for start in range(0, len(strings), BUILD_CHUNK_SIZE):
+            chunk = strings[start:start + BUILD_CHUNK_SIZE]
+            _, owners = ngram_codes(chunk, self.n, self.mark, self.be)
+            sizes[start:start + len(chunk)] = np.bincount(owners, minlength=len(chunk))
+        order = np.argsort(sizes, kind='stable')
+        strings = [strings[i] for i in order]
+        sizes = sizes[order]
+        max_size = int(sizes.max()) if len(sizes) > 0 else 0
+        size_offsets = np.searchsorted(sizes, np.arange(max_size + 2)).astype(np.int64)
+
+        encoded = [s.encode('utf_8') for s in strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        string_offsets[1:] = np.cumsum([len(b) for b in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        del encoded
+
+        codes, occurrences, owners = [], [], []
+        for start in range(0, len(strings), BUILD_CHUNK_SIZE):
+            chunk_codes, chunk_occurrences, chunk_owners = features(strings[start:start + BUILD_CHUNK_SIZE],
+                                                                    self.n, self.be, self.mark)
+            codes.append(chunk_codes)
+            occurrences.append(chunk_occurrences.astype(np.uint32))
+            owners.append((chunk_owners + start).astype(np.uint32))
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint64)
+        occurrences = np.concatenate(occurrences) if occurrences else np.zeros(0, dtype=np.uint32)
+        owners = np.concatenate(owners) if owners else np.zeros(0, dtype=np.uint32)
+        # 特徴量(n-gram, 出現回数)ごとに文字列の番号を昇順に並べる
+        order = np.lexsort((owners, occurrences, codes))
+        codes, occurrences, postings = codes[order], occurrences[order], owners[order]
+        del order, owners
+        boundary = np.ones(len(codes), dtype=bool)
+        boundary[1:] = (codes[1:] != codes[:-1]) | (occurrences[1:] != occurrences[:-1])
+        feature_starts = np.flatnonzero(boundary)
+        feature_offsets = np.append(feature_starts, len(codes)).astype(np.int64)
+        feature_codes = codes[feature_starts]
+        feature_occurrences = occurrences[feature_starts]
+
+        arrays = {
+            'strings': blob,
+            'string_offsets': string_offsets,
+            'size_offsets': size_offsets,
+            'feature_codes': feature_codes,
+            'feature_occurrences': feature_occurrences.astype(_min_dtype(int(feature_occurrences.max(initial=0)))),
+            'feature_offsets': feature_offsets,
+            'postings': postings.astype(_min_dtype(max(len(strings) - 1, 0))),
+        }
+        remove_index(self.path)
+        for name in ARRAY_NAMES:
+            np.save(_array_path(self.path, name), arrays[name])
+        # 設定は最後に書く(設定ファイルがあれば配列は揃っている)
+        header = {'format': INDEX_FORMAT, 'version': INDEX_VERSION, 'n': self.n, 'be': self.be, 'mark': self.mark,
+                  'strings': len(strings), 'features': len(feature_codes), 'postings': len(postings)}
+        with open(self.path, mode='w', encoding='utf_8') as f:
+            json.dump(header, f)
+
+
+class NgramIndexReader(object):
+    """
+    simstring_cpp.reader と同じ使い方で検索する。measure は cosine だけ。
+    CPMerge と同じく、特徴量数が [ceil(α²|X|), floor(|X|/α²)] の文字列だけを候補にし、
+    共通する特徴量が ceil(α√(|X||Y|)) 以上の文字列を返す。
+    配列は読み出し専用なので、1 つの reader を複数のスレッドから使ってよい(threshold を変えない限り)。
+    """
+    def __init__(self, path, mmap=True):
+        with open(path, mode='r', encoding='utf_8') as f:
+            header = json.load(f)
+        if header.get('format') != INDEX_FORMAT or header.get('version') != INDEX_VERSION:
+            raise ValueError('%s is not an ngram_index (version %d) file' % (path, INDEX_VERSION))
+        self.path = path
+        self.n = header['n']
+        self.be = header['be']
+        self.mark = header['mark']
+        self.measure = cosine
+        self.threshold = 0.7
+        for name in ARRAY_NAMES:
+            array = np.load(_array_path(path, name), mmap_mode='r' if mmap else None)
+            # np.memmap のままだと演算のたびに memmap を作るので、同じメモリを指す ndarray にしておく
+            setattr(self, name, array.view(np.ndarray))
+        self.max_size = len(self.size_offsets) - 2
+
+    def retrieve(self, query):
+        if self.measure != cosine:
+            raise ValueError('unsupported measure: %s' % self.measure)
+        threshold = self.threshold
+        codes, occurrences, _ = features([query], self.n, self.be, self.mark)
+        query_size = len(codes)
+        if query_size == 0 or self.max_size < 0:
+            return []
+        min_size = max(int(math.ceil(threshold * threshold * query_size)), 1)
+        max_size = min(int(math.floor(query_size / (threshold * threshold))), self.max_size)
+        if min_size > max_size:
+            return []
+        # 特徴量数の範囲は、文字列の番号の範囲になる
+        id_lo = int(self.size_offsets[min_size])
+        id_hi = int(self.size_offsets[max_size + 1])
+
+        # query の特徴量の番号を引く。同じ n-gram の特徴量は出現回数の順に並んでいる
+        lo = np.searchsorted(self.feature_codes, codes, side='left')
+        hi = np.searchsorted(self.feature_codes, codes, side='right')
+        known = occurrences <= hi - lo
+        feature_ids = (lo + occurrences - 1)[known]
+
+        slices = []
+        for feature_id in feature_ids:
+            postings = self.postings[self.feature_offsets[feature_id]:self.feature_offsets[feature_id + 1]]
+            start, end = np.searchsorted(postings, (id_lo, id_hi))
+            if start < end:
+                slices.append(postings[start:end])
+        if len(slices) == 0:
+            return []
+        ids, counts = np.unique(np.concatenate(slices), return_counts=True)
+        sizes = np.searchsorted(self.size_offsets, ids, side='right') - 1
+        min_match = np.ceil(threshold * np.sqrt(float(query_size) * sizes))
+        ids = ids[counts >= min_match]
+        return [self._string(i) for i in ids]
+
+    def _string(self, i):
+        return bytes(self.strings[self.string_offsets[i]:self.string_offsets[i + 1]]).decode('utf_8')
+
+    def close(self):
+        pass
@@ -0,0 +1,200 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from umls_mapping import text2umls as tu
+from umls_mapping import brat_ann
+from umls_mapping.cache import LRUCache
+
+
+# 候補を持っておく文書の数
+PREFETCH_DOCUMENTS = 32
+# 先読みで一度に word2umls_many に渡す span の数
+PREFETCH_BATCH_SIZE = 16
+# 検索ダイアログを開いたときに、その span を先読みのスレッドが検索中なら、終わるのを待つ時間(秒)。過ぎたらその場で検索する。
+# まだ順番待ちの span は待たずにその場で検索する
+PREFETCH_WAIT = 2.0
+
+
+def _ann_stamp(ann_path):
+    try:
+        st = os.stat(ann_path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _resolving(document, key, types):
+    """key を semantic_types が types で検索中か(document.condition を取ってから呼ぶ)"""
+    return key in document.running and document.running[key] == types
+
+
+class DocumentCandidates(object):
+    """
+    1 つの文書の span ごとの候補。(小文字にした span の文字列, offsets) で引く。
+    entries は key -> (semantic_types, 候補)、pending は候補がまだ無い key -> semantic_types、
+    running は pending のうち検索中の key -> semantic_types。
+    """
+    def __init__(self, ann_path, database):
+        self.ann_path = ann_path
+        self.database = database
+        self.stamp = None
+        self.text_bounds = {}
+        self.entries = {}
+        self.pending = {}
+        self.running = {}
+        self.condition = threading.Condition()
+
+
+class DocumentPrefetcher(object):
+    """
+    文書を開いたとき(と .ann が書き換えられたとき)に、全ての text-bound annotation の候補を裏で検索しておく。
+    検索ダイアログを開いたときは get() で読むだけになる。
+    .ann が書き換えられたら、消えた span・文字列や offsets・エンティティタイプが変わった span の候補を捨て、
+    新しい span だけを検索し直す。
+    :param lookup: lookup(query_strings, database, semantic_types) -> 候補のリスト (UmlsMapper._prefetch_lookup)。
+                   先読みの候補に入れない span(翻訳に失敗したものなど)は None
+    """
+    def __init__(self, lookup, max_documents=PREFETCH_DOCUMENTS, batch_size=PREFETCH_BATCH_SIZE,
+                 wait=PREFETCH_WAIT):
+        self.lookup = lookup
+        self.batch_size = batch_size
+        self.wait = wait
+        self.documents = LRUCache(max_documents)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.inline = 0
+        # 先読みは 1 本のスレッドで順に行う(ダイアログからの検索を邪魔しないように)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='umls-prefetch')
+
+    def prefetch(self, ann_path, database='UMLS'):
+        """
+        ann_path の文書の候補の先読みを始める(すぐに返る)
+        :return: 新たに検索する span の数
+        """
+        key = (ann_path, database)
+        with self._lock:
+            document = self.documents.get(key)
+            if document is None:
+                document = DocumentCandidates(ann_path, database)
+                self.documents.put(key, document)
+        return self._refresh(document)
+
+    def get(self, ann_path, database, annotation_id, query_string, semantic_types=None):
+        """
+        先読みした候補を返す。先読みしていない、検索文字列が span の文字列と違う、などの場合は None
+        :param semantic_types: 明示された SemanticType(None ならエンティティタイプから決めたもの)
+        """
+        document = self.documents.get((ann_path, database))
+        if document is None or not annotation_id:
+            return None
+        self._refresh(document)
+        with document.condition:
+            text_bound = document.text_bounds.get(annotation_id)
+            if text_bound is None or text_bound.text.lower() != query_string:
+                return None
+            key = (query_string, text_bound.offsets)
+            types = document.pending.get(key)
+            # 明示された SemanticType が先読みのものと違えば、先読みの結果は使えない
+            usable = semantic_types is None or frozenset(semantic_types) == types
+            inline = usable and key in document.pending and not _resolving(document, key, types)
+            if inline:
+                # 大きな文書では、順番待ちの span を待つと先読みしない場合より遅くなるので、ここで検索する
+                document.running[key] = types
+            elif usable:
+                document.condition.wait_for(lambda: key not in document.pending, timeout=self.wait)
+        if inline:
+            with self._lock:
+                self.inline += 1
+            self._lookup(document, types, [key])
+        with document.condition:
+            entry = document.entries.get(key)
+        if entry is None or (semantic_types is not None and frozenset(semantic_types) != entry[0]):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return list(entry[1])
+
+    def clear(self):
+        """リソースが作り直されたときに全ての候補を捨てる"""
+        with self._lock:
+            self.documents.clear()
+
+    def _refresh(self, document):
+        """.ann が変わっていたら読み直して、古くなった候補を捨て、足りない span を検索に回す"""
+        stamp = _ann_stamp(document.ann_path)
+        with document.condition:
+            if stamp == document.stamp:
+                return 0
+            document.stamp = stamp
+            text_bounds = brat_ann.read_ann(document.ann_path)[1]
+            document.text_bounds = {text_bound.id: text_bound for text_bound in text_bounds}
+            wanted = {}
+            for text_bound in text_bounds:
+                types = tu.semantic_types_for_entity(text_bound.type)
+                wanted[(text_bound.text.lower(), text_bound.offsets)] = frozenset(types) if types else None
+            for key in list(document.entries):
+                if key not in wanted or document.entries[key][0] != wanted[key]:
+                    del document.entries[key]
+            for key in list(document.pending):
+                if key not in wanted:
+                    del document.pending[key]
+            missing = {}
+            for key, types in wanted.items():
+                if key[0] == '' or key in document.entries:
+                    continue
+                if key not in document.pending or document.pending[key] != types:
+                    document.pending[key] = types
+                    missing.setdefault(types, []).append(key)
+            # 消えた span を待っているダイアログを起こす
+            document.condition.notify_all()
+        for types, keys in missing.items():
+            for start in range(0, len(keys), self.batch_size):
+                self._executor.submit(self._run, document, types, keys[start:start + self.batch_size])
+        return sum(len(keys) for keys in missing.values())
+
+    def _run(self, document, types, keys):
+        with document.condition:
+            # 先読みを待つ間に .ann が書き換えられて要らなくなった span と、get() が検索を始めた span は検索しない
+            keys = [key for key in keys if key in document.pending and document.pending[key] == types
+                    and not _resolving(document, key, types)]
+            for key in keys:
+                document.running[key] = types
+        self._lookup(document, types, keys)
+
+    def _lookup(self, document, types, keys):
+        """running に入れた keys を検索して entries に入れる"""
+        if len(keys) == 0:
+            return
+        try:
+            results = self.lookup([key[0] for key in keys], document.database, types)
+        except Exception as e:
+            print('prefetch failed for %s: %s: %s' % (document.ann_path, type(e).__name__, e), file=sys.stderr)
+            results = [None] * len(keys)
+        with document.condition:
+            for key, scored_concept in zip(keys, results):
+                if _resolving(document, key, types):
+                    del document.running[key]
+                if key not in document.pending or document.pending[key] != types:
+                    continue
+                del document.pending[key]
+                if scored_concept is not None:
+                    document.entries[key] = (types, tuple(scored_concept))
+            document.condition.notify_all()
+
+    def stats(self):
+        documents = self.documents.values()
+        return {
+            'documents': len(documents),
+            'spans': sum(len(document.entries) for document in documents),
+            'pending': sum(len(document.pending) for document in documents),
+            'hits': self.hits,
+            'misses': self.misses,
+            'inline': self.inline,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
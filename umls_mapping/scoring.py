@@ -0,0 +1,119 @@
+import math
+import functools
+import numpy as np
+
+
+# コードポイントは 21 bit に収まるので、3-gram までは 1 つの uint64 に詰められる
+CODEPOINT_BITS = 21
+MAX_PACKED_NGRAM = 3
+# NgramCosineScorer が simstring と同じ値を返すかを確かめるための文字列
+PROBE_STRINGS = ['aab', 'abab', 'a$b', '大腿骨頸部骨折', '骨折 大腿', 'b']
+
+
+def ngram_codes(strings, n, endmarker='$', be=True):
+    """
+    strings の各文字列の n-gram を uint64 に詰めて返す。
+    be が True なら simstring の CharacterNgramFeatureExtractor と同じく、文字列の前後に endmarker を n-1 文字ずつ付ける。
+    False なら(simstring の C++ 版で be=false のとき)、n 文字より短い文字列の後ろにだけ endmarker を付ける。
+    :param strings: 文字列のリスト
+    :return: (codes, owners) codes[i] は n-gram、owners[i] はその n-gram を含む文字列の番号
+    """
+    if be:
+        pad = endmarker * (n - 1)
+    else:
+        pad = ''
+        strings = [s if len(s) >= n else s + endmarker * (n - len(s)) for s in strings]
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)) + 2 * len(pad)
+    # 全候補を 1 本の文字列にしてまとめてコードポイント列に変換する
+    joined = pad + (pad + pad).join(strings) + pad if len(strings) > 0 else ''
+    chars = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    n_positions = max(len(chars) - n + 1, 0)
+    codes = chars[:n_positions].copy()
+    for k in range(1, n):
+        codes = (codes << np.uint64(CODEPOINT_BITS)) | chars[k:k + n_positions]
+    # 文字列の境界をまたぐ n-gram を除く
+    owners = np.repeat(np.arange(len(strings)), lengths)[:n_positions]
+    starts = np.cumsum(lengths) - lengths
+    valid = (np.arange(n_positions) - starts[owners]) < (lengths - n + 1)[owners]
+    return codes[valid], owners[valid]
+
+
+class NgramCosineScorer(object):
+    """
+    query と候補文字列の cosine 類似度を numpy でまとめて計算する。
+    simstring の特徴量は n-gram に出現回数を付けて区別したものなので、
+    特徴量数は n-gram 数(文字数 + n - 1)、共通特徴量数は n-gram ごとの出現回数の小さい方の和になる。
+    """
+    def __init__(self, n, endmarker='$'):
+        self.n = n
+        self.endmarker = endmarker
+
+    def similarities(self, query, candidates):
+        """
+        :return: candidates と同じ順の類似度(numpy の float64 配列)
+        """
+        n_candidates = len(candidates)
+        q_codes, _ = ngram_codes([query], self.n, self.endmarker)
+        q_unique, q_counts = np.unique(q_codes, return_counts=True)
+        c_codes, owners = ngram_codes(candidates, self.n, self.endmarker)
+        c_sizes = np.bincount(owners, minlength=n_candidates)
+
+        # query に含まれる n-gram だけを残し、(候補, n-gram) ごとの出現回数を数える
+        shared = np.isin(c_codes, q_unique)
+        c_codes, owners = c_codes[shared], owners[shared]
+        order = np.lexsort((c_codes, owners))
+        c_codes, owners = c_codes[order], owners[order]
+        boundary = np.ones(len(c_codes), dtype=bool)
+        boundary[1:] = (c_codes[1:] != c_codes[:-1]) | (owners[1:] != owners[:-1])
+        group_starts = np.flatnonzero(boundary)
+        group_counts = np.diff(np.append(group_starts, len(c_codes)))
+        group_codes = c_codes[group_starts]
+        common = np.minimum(group_counts, q_counts[np.searchsorted(q_unique, group_codes)])
+        intersections = np.bincount(owners[group_starts], weights=common, minlength=n_candidates)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return intersections / np.sqrt(len(q_codes) * c_sizes)
+
+
+@functools.lru_cache(maxsize=4096)
+def unretrieved_score_bound(length, threshold, n):
+    """
+    simstring (n-gram, be=false) の cosine が threshold 未満で検索されなかった synonym の、
+    NgramCosineScorer (前後に endmarker を付けた n-gram) の cosine の上限。query が endmarker を含まない場合に成り立つ。
+    endmarker を含まない n-gram の共通数は検索の共通特徴量数(threshold * sqrt(検索の特徴量数の積) 未満)以下、
+    endmarker を含む n-gram の共通数は query の endmarker を含む n-gram の数以下になることから、synonym の長さごとに求めて最大をとる。
+    :param length: query の文字数
+    """
+    def sizes(m):
+        # (順位付けの特徴量数, endmarker を含まない n-gram 数, 検索の特徴量数)
+        inner = max(m - n + 1, 0)
+        return m + n - 1, inner, max(inner, 1)
+
+    q_size, q_inner, q_retrieval = sizes(length)
+    q_marked = q_size - q_inner
+    # 共通数が q_inner で頭打ちになり、synonym が query より長くなった後は、長いほど上限は小さくなる
+    longest = max(int(math.ceil(q_inner * q_inner / (threshold * threshold * q_retrieval))) + n - 1, length) + 1
+    bound = 0.0
+    for m in range(1, longest + 1):
+        size, inner, retrieval = sizes(m)
+        common = min(q_inner, inner, threshold * math.sqrt(q_retrieval * retrieval)) + q_marked
+        bound = max(bound, min(common, q_size, size) / math.sqrt(q_size * size))
+    return bound
+
+
+def make_scorer(feature_extractor, measure):
+    """
+    feature_extractor / measure と同じ値を返す NgramCosineScorer を作る。
+    対応していない組み合わせ(simstring のバージョン違いなど)の場合は None を返す。
+    """
+    n = getattr(feature_extractor, 'n', None)
+    endmarker = getattr(feature_extractor, 'endmarker', None)
+    if n is None or endmarker is None or not 1 <= n <= MAX_PACKED_NGRAM or len(endmarker) != 1:
+        return None
+    scorer = NgramCosineScorer(n, endmarker)
+    for query in PROBE_STRINGS:
+        features = feature_extractor.features(query)
+        expected = [measure.similarity(features, feature_extractor.features(s)) for s in PROBE_STRINGS]
+        if scorer.similarities(query, PROBE_STRINGS).tolist() != expected:
+            return None
+    return scorer
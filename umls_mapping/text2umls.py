@@ -1,35 +1,82 @@
+import time
+_import_started_at = time.perf_counter()
 import os
 import re
 import gc
-import pandas as pd
-import numpy as np
+import copy
+import hashlib
+import heapq
+import json
+import queue
 import mojimoji
-import MeCab
-from googletrans import Translator
+import contextlib
 from collections import defaultdict
-from pkg_resources import parse_version
-import sklearn
-if parse_version(sklearn.__version__) > parse_version('0.23'):
-    from sklearn.feature_extraction import _stop_words as stop_words
-else:
-    from sklearn.feature_extraction import stop_words
 import normdb
-import simstring_cpp
 from simstring.feature_extractor.character_ngram import CharacterNgramFeatureExtractor
 from simstring.measure.cosine import CosineMeasure
 import sys
 import sqlite3 as sqlite
 import argparse
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
 from message import Messager
+from umls_mapping.translation import make_translator
+from umls_mapping.tokenizer import get_tokenizer
+from umls_mapping.instrumentation import get_instrumentation
 import glob
+# pandas, numpy, sklearn, simstring_cpp, MeCab, googletrans は起動を速くするため、使うときに import する
 
 
-stop_words_sklearn = stop_words.ENGLISH_STOP_WORDS
+# 起動時間の内訳(秒)
+STARTUP_TIMINGS = {}
+
+# init_db のときに作る、起動時に読む表(英語ストップワード、検査値の基準値)
+STARTUP_ARTIFACT_NAME = 'startup_tables.json'
+STARTUP_ARTIFACT_VERSION = 1
+
+
+def _sklearn_stop_words():
+    from pkg_resources import parse_version
+    import sklearn
+    if parse_version(sklearn.__version__) > parse_version('0.23'):
+        from sklearn.feature_extraction import _stop_words as stop_words
+    else:
+        from sklearn.feature_extraction import stop_words
+    return stop_words.ENGLISH_STOP_WORDS
+
+
+_stop_words = None
+
+
+def english_stop_words():
+    global _stop_words
+    if _stop_words is None:
+        artifact = load_startup_artifact()
+        if artifact is not None:
+            _stop_words = frozenset(artifact['stop_words'])
+        else:
+            _stop_words = _sklearn_stop_words()
+    return _stop_words
+
+
+def __getattr__(name):
+    # 以前の stop_words_sklearn を参照しているコードのため
+    if name == 'stop_words_sklearn':
+        return english_stop_words()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+# 該当なし(Unknown)の CUI。検索結果には必ず先頭に入れる
+UNKNOWN_CUI = 'C0439673'
 
 # 検索用 DB の初期化を行うか否かのフラグ
 INIT_DB = False
 
 UMLS_DB_NAME = 'UMLS.ss.db'
+# update_db で追加された synonym だけを入れる simstring DB
+UMLS_DELTA_DB_NAME = 'UMLS.delta.ss.db'
 # UMLS_DB_PATH = '../../../work'
 UMLS_DB_PATH = 'resource'
 
@@ -38,6 +85,82 @@ UMLS_DB_PATH = 'resource'
 #SEARCH_THRESHOLD = 0.85
 NGRAM = 2
 SEARCH_THRESHOLD = 0.65
+# top-k 検索: 0 より大きいと、上位 SEARCH_TOP_K 個の CUI が確定するまで閾値を TOP_K_THRESHOLDS の順に
+# (最後は SEARCH_THRESHOLD まで)下げながら検索し、score の上位 SEARCH_TOP_K 個の CUI だけを返す。
+# 検索されなかった synonym の score の上限を上位の CUI の score が超えたときだけ打ち切るので、上位の CUI は全件の検索と変わらない。
+# 短い query や多くの synonym に一致する query でも、候補の数が抑えられる。
+# 0 なら SEARCH_THRESHOLD 以上の候補を全て返す
+SEARCH_TOP_K = 0
+TOP_K_THRESHOLDS = (0.9, 0.8)
+# 完全一致の近道: query が synonym に完全一致し、その CUI が EXACT_MATCH_MIN_CUIS 個以上あれば、
+# 近似文字列検索をせずにそれらの行を score 1.0 で返す。span の query 全体(と訳語)だけに使い、部分一致検索で削った query には使わない。
+# synonym から行を引くのは concept store のハッシュ索引
+# (無ければ umls_synonyms の synonym_idx)。0 なら常に近似文字列検索する(word2UMLS の fuzzy=True と同じ)。
+# 完全一致しない他の CUI の候補が出なくなるので、既定では使わない
+EXACT_MATCH_MIN_CUIS = 0
+# 近似文字列検索のエンジン
+# 'simstring': SimString の C++ 版(simstring_cpp), 'ngram_index': numpy による n-gram 転置インデックス(ngram_index.py)
+SEARCH_ENGINE = 'simstring'
+
+# word2UMLS で翻訳と日本語の検索を並行して行うスレッド数(0 なら並行しない)
+STAGE_WORKERS = 4
+
+# 英語検索のための翻訳の設定
+# 'google': googletrans, 'dictionary': resource/translation_dict.tsv, 'none': 翻訳しない
+TRANSLATOR_BACKEND = 'google'
+# 1 回の word2UMLS の翻訳(再試行を含む。まとめて翻訳する語の全体)にかけてよい時間(秒)。
+# 翻訳サービスが落ちているときは translation.py の BREAKER_SECONDS の間、待たずに英語検索を諦める
+TRANSLATION_TIMEOUT = 0.8
+
+# umls_synonyms.db の読み出し設定
+SYNONYMS_DB_NAME = 'umls_synonyms.db'
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -64 * 1024  # 負値は KiB 単位
+# sqlite のプレースホルダ上限(古い sqlite は 999)を超えないように IN 句を分割する
+SQLITE_MAX_VARIABLES = 512
+# umls_synonyms テーブルを memory-map できる配列にしたもの(concept_store.py)。
+# init_db / update_db で作り、あれば synonym から行を引くのに SQL の代わりに使う
+CONCEPT_STORE_NAME = 'umls_concepts.db'
+USE_CONCEPT_STORE = True
+# update_db では concept store を作り直さず、行が変わった synonym だけの差分をこの名前で作って重ねる。
+# 差分の synonym が全体の CONCEPT_DELTA_MAX_FRACTION を超えたら全体を作り直す
+CONCEPT_DELTA_STORE_NAME = 'umls_concepts.delta.db'
+CONCEPT_DELTA_MAX_FRACTION = 0.2
+# convert_umls2simstring.py が UMLS_synonyms.txt と一緒に書く build profile (絞り込みの設定と件数)。
+# init_db / update_db のときに umls_synonyms.db の umls_metadata テーブルに記録する
+BUILD_PROFILE_NAME = 'build_profile.json'
+
+# brat のエンティティタイプごとに、検索する SemanticType を限定する
+# 例: {'Medication': ['Pharmacologic Substance', 'Clinical Drug'],
+#      'Lab_test': ['Laboratory Procedure', 'Laboratory or Test Result']}
+# init_db / update_db のときに、SemanticType の組ごとにその synonym だけを入れた検索用 DB を作り、
+# 限定した検索ではそれを引く(候補が最初から絞られる)。ここに無いエンティティタイプは全ての SemanticType から検索する
+ENTITY_SEMANTIC_TYPES = {}
+# SemanticType ごとの検索用 DB の一覧(SemanticType の組と DB の名前、作ったときの umls_synonyms.db)
+SEMANTIC_INDEX_MANIFEST_NAME = 'semantic_indexes.json'
+SEMANTIC_INDEX_VERSION = 1
+
+
+def resource_dir():
+    return os.path.join(os.path.dirname(__file__), UMLS_DB_PATH)
+
+
+def resource_fingerprint():
+    """
+    検索用リソース(simstring DB, umls_synonyms.db)の更新を検知するための値を返す。
+    init_db で作り直されると mtime / size が変わる。
+    """
+    fingerprint = []
+    for name in (UMLS_DB_NAME, UMLS_DELTA_DB_NAME, SYNONYMS_DB_NAME, CONCEPT_STORE_NAME, CONCEPT_DELTA_STORE_NAME,
+                 SEMANTIC_INDEX_MANIFEST_NAME):
+        path = os.path.join(resource_dir(), name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            fingerprint.append((name, None, None))
+            continue
+        fingerprint.append((name, st.st_mtime_ns, st.st_size))
+    return tuple(fingerprint)
 
 
 # 英数字判定
@@ -63,15 +186,370 @@ if TEST:
     assert flag is True, 'is_harf 判定ミス'
 
 
+class ObjectPool(object):
+    """
+    スレッド間で使い回すオブジェクト(sqlite の接続、simstring の reader)のプール。
+    1 つのオブジェクトを同時に使うのは 1 スレッドだけ。空いているものが無ければ create() で作り、使い終わったら戻す。
+    リクエストごとにスレッドを作るサーバでも、オブジェクトの数は同時に使われた数までしか増えない。
+    """
+    def __init__(self, create):
+        self._create = create
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._objects = []
+
+    @contextlib.contextmanager
+    def get(self):
+        try:
+            obj = self._idle.get_nowait()
+        except queue.Empty:
+            obj = self._create()
+            with self._lock:
+                self._objects.append(obj)
+        try:
+            yield obj
+        finally:
+            self._idle.put(obj)
+
+    def close(self):
+        """作ったオブジェクトを全て閉じる。使用中のものも閉じるので、使い終わってから呼ぶ"""
+        with self._lock:
+            objects, self._objects = self._objects, []
+            self._idle = queue.LifoQueue()
+        for obj in objects:
+            obj.close()
+
+
+class SynonymsConnectionPool(ObjectPool):
+    """
+    umls_synonyms.db への読み出し専用接続のプール。
+    接続は足りなくなったときに開き、close() でまとめて閉じる。
+    """
+    def __init__(self, db_path):
+        super(SynonymsConnectionPool, self).__init__(self._connect)
+        self.db_path = db_path
+
+    def connection(self):
+        return self.get()
+
+    def _connect(self):
+        if not os.path.exists(self.db_path):
+            raise normdb.dbNotFoundError(self.db_path)
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(self.db_path))
+        # IN 句のプレースホルダ数は _placeholder_count() で丸めているので、
+        # 同じ SQL 文字列が繰り返し使われ、prepared statement がキャッシュから再利用される
+        connection = sqlite.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        connection.execute('PRAGMA query_only = ON')
+        connection.execute('PRAGMA mmap_size = %d' % SQLITE_MMAP_SIZE)
+        connection.execute('PRAGMA cache_size = %d' % SQLITE_CACHE_SIZE)
+        return connection
+
+
+class SimstringReaderPool(ObjectPool):
+    """
+    検索用 DB の reader のプール。simstring_cpp の reader は複数のスレッドから同時に使えず、
+    閾値も reader ごとに持つので、検索のたびにプールから借りる。
+    """
+    def __init__(self, path):
+        super(SimstringReaderPool, self).__init__(lambda: simstring_reader(path))
+        self.path = path
+        # DB が無い場合などはここで例外にする
+        with self.get():
+            pass
+
+    def reader(self):
+        return self.get()
+
+
+def open_concept_store(resource_path):
+    """concept store を開く。無い場合や umls_synonyms.db と対応していない場合は None (SQL で引く)"""
+    path = os.path.join(resource_path, CONCEPT_STORE_NAME)
+    if not USE_CONCEPT_STORE or not os.path.exists(path):
+        return None
+    try:
+        store = _read_concept_store(resource_path)
+    except (OSError, ValueError) as e:
+        print('concept store is not available: %s' % e, file=sys.stderr)
+        return None
+    if not store.matches(os.path.join(resource_path, SYNONYMS_DB_NAME)):
+        print('concept store is older than %s; run --init_db or --update_db to rebuild it' % SYNONYMS_DB_NAME,
+              file=sys.stderr)
+        return None
+    return store
+
+
+def _read_concept_store(resource_path):
+    """concept store を開き、update_db の差分があれば重ねる"""
+    from umls_mapping.concept_store import ConceptStore
+    store = ConceptStore(os.path.join(resource_path, CONCEPT_STORE_NAME))
+    delta_path = os.path.join(resource_path, CONCEPT_DELTA_STORE_NAME)
+    if os.path.exists(delta_path):
+        store.attach(ConceptStore(delta_path))
+    return store
+
+
+def build_concept_store():
+    from umls_mapping.concept_store import build_concept_store as build, remove_store
+    resource_path = resource_dir()
+    remove_store(os.path.join(resource_path, CONCEPT_DELTA_STORE_NAME))
+    return build(os.path.join(resource_path, SYNONYMS_DB_NAME), os.path.join(resource_path, CONCEPT_STORE_NAME))
+
+
+def update_concept_store(store, synonyms):
+    """
+    update_db で行が変わった synonyms の差分を作り、concept store に重ねる。前の update_db の差分の synonym も入れ直す。
+    差分が大きくなった場合と、store が無い(update_db の前の umls_synonyms.db と対応していない)場合は全体を作り直す。
+    :return: 差分の synonym の数(全体を作り直したら None)
+    """
+    from umls_mapping.concept_store import build_concept_store as build
+    if store is not None:
+        synonyms = set(synonyms)
+        if store.delta is not None:
+            synonyms.update(store.delta.synonyms.to_list())
+        if len(synonyms) <= CONCEPT_DELTA_MAX_FRACTION * store.header['synonyms']:
+            resource_path = resource_dir()
+            build(os.path.join(resource_path, SYNONYMS_DB_NAME), os.path.join(resource_path, CONCEPT_DELTA_STORE_NAME),
+                  synonyms, store)
+            return len(synonyms)
+    build_concept_store()
+    return None
+
+
+def has_semantic_type(semantic, semantic_types):
+    """
+    umls_synonyms の semantic 列(CUI の SemanticType を '/' でつないだもの)に semantic_types のどれかが含まれるか
+    """
+    return not semantic_types.isdisjoint(semantic.split('/'))
+
+
+def semantic_types_for_entity(entity_type):
+    """:return: brat のエンティティタイプ entity_type で検索する SemanticType の frozenset (限定しない場合は None)"""
+    semantic_types = ENTITY_SEMANTIC_TYPES.get(entity_type)
+    return frozenset(semantic_types) if semantic_types else None
+
+
+def semantic_index_name(semantic_types):
+    """SemanticType の組の検索用 DB の名前(組が同じなら同じ名前)"""
+    key = '\n'.join(sorted(semantic_types)).encode('utf_8')
+    return 'UMLS.sty_%s.ss.db' % hashlib.md5(key).hexdigest()[:12]
+
+
+def build_semantic_indexes():
+    """
+    ENTITY_SEMANTIC_TYPES の SemanticType の組ごとに、その SemanticType の行がある synonym だけの検索用 DB を作る。
+    umls_synonyms.db から作るので、init_db / update_db で umls_synonyms テーブルを書き換えた後に呼ぶ。
+    :return: {DB の名前: synonym の数}
+    """
+    resource_path = resource_dir()
+    manifest_path = os.path.join(resource_path, SEMANTIC_INDEX_MANIFEST_NAME)
+    # 前に作ったものは消しておく(設定から外れた組の DB を残さない)
+    for path in glob.glob(os.path.join(resource_path, 'UMLS.sty_*.ss.db')):
+        _remove_simstring_db(path)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    groups = {}
+    for semantic_types in ENTITY_SEMANTIC_TYPES.values():
+        if semantic_types:
+            groups[semantic_index_name(semantic_types)] = sorted(set(semantic_types))
+    if len(groups) == 0:
+        return {}
+    sqldbfn = os.path.join(resource_path, SYNONYMS_DB_NAME)
+    connection = sqlite.connect(sqldbfn)
+    dbs = {name: simstring_writer(os.path.join(resource_path, name)) for name in groups}
+    sizes = {name: 0 for name in groups}
+    last_synonyms = {name: None for name in groups}
+    # semantic 列は SemanticType を '/' でつないだものなので、組ごとに SemanticType を 1 つでも含む synonym を入れる。
+    # semantic 列の値の種類は少ないので、どの組に入るかは値ごとに一度だけ調べる
+    names_by_semantic = {}
+    cursor = connection.execute('SELECT DISTINCT synonym, semantic FROM umls_synonyms ORDER BY synonym')
+    for synonym, semantic in cursor:
+        names = names_by_semantic.get(semantic)
+        if names is None:
+            names = names_by_semantic[semantic] = [name for name, semantic_types in groups.items()
+                                                   if has_semantic_type(semantic, frozenset(semantic_types))]
+        for name in names:
+            # synonym の順に読むので、同じ synonym が続いたら入れない
+            if last_synonyms[name] != synonym:
+                dbs[name].insert(synonym)
+                last_synonyms[name] = synonym
+                sizes[name] += 1
+    connection.close()
+    for name, semantic_types in groups.items():
+        dbs[name].close()
+        print('semantic index {} ({}): {} synonyms'.format(name, ', '.join(semantic_types), sizes[name]))
+    # 一覧は最後に書く(一覧があれば DB は揃っている)
+    _write_semantic_manifest(resource_path, {'version': SEMANTIC_INDEX_VERSION, 'indexes': groups})
+    return sizes
+
+
+def semantic_delta_name(name):
+    """SemanticType の組の検索用 DB に、update_db で加えた synonym だけを入れる DB の名前"""
+    return name[:-len('.ss.db')] + '.delta.ss.db'
+
+
+def _write_semantic_manifest(resource_path, manifest):
+    """SemanticType ごとの検索用 DB の一覧を、今の umls_synonyms.db に対応するものとして書く"""
+    manifest['synonyms_db'] = _file_fingerprint(os.path.join(resource_path, SYNONYMS_DB_NAME))
+    with open(os.path.join(resource_path, SEMANTIC_INDEX_MANIFEST_NAME), mode='w', encoding='utf_8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def read_semantic_manifest(resource_path):
+    """
+    SemanticType ごとの検索用 DB の一覧を読む。無い場合や umls_synonyms.db と対応していない場合は None
+    :return: {'indexes': {DB の名前: SemanticType のリスト}, 'delta_synonyms': {DB の名前: update_db で加えた synonym}, ...}
+    """
+    try:
+        with open(os.path.join(resource_path, SEMANTIC_INDEX_MANIFEST_NAME), mode='r', encoding='utf_8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != SEMANTIC_INDEX_VERSION:
+        return None
+    if manifest.get('synonyms_db') != _file_fingerprint(os.path.join(resource_path, SYNONYMS_DB_NAME)):
+        print('semantic indexes are older than %s; run --init_db or --update_db to rebuild them' % SYNONYMS_DB_NAME,
+              file=sys.stderr)
+        return None
+    return manifest
+
+
+def semantic_index_additions(cursor, manifest):
+    """
+    update_db で、SemanticType の組の行が新たに加わる synonym を組ごとに求める(組の検索用 DB とその差分に無いもの)。
+    組の SemanticType の行が既にある synonym は、組の検索用 DB か差分に入っている。
+    umls_synonyms を書き換える前に、added_synonyms を作ってから呼ぶ。
+    :return: {DB の名前: synonym のリスト}
+    """
+    added = cursor.execute('SELECT DISTINCT synonym, semantic FROM added_synonyms').fetchall()
+    synonyms = sorted(set(synonym for synonym, _ in added))
+    current = defaultdict(list)
+    for start in range(0, len(synonyms), SQLITE_MAX_VARIABLES):
+        chunk = synonyms[start:start + SQLITE_MAX_VARIABLES]
+        for synonym, semantic in cursor.execute(
+                'SELECT DISTINCT synonym, semantic FROM umls_synonyms WHERE synonym IN (%s)'
+                % ','.join(['?'] * len(chunk)), chunk):
+            current[synonym].append(semantic)
+    additions = {}
+    for name, semantic_types in manifest['indexes'].items():
+        semantic_types = frozenset(semantic_types)
+        indexed = set(manifest.get('delta_synonyms', {}).get(name, []))
+        new = set(synonym for synonym, semantic in added
+                  if synonym not in indexed and has_semantic_type(semantic, semantic_types)
+                  and not any(has_semantic_type(s, semantic_types) for s in current[synonym]))
+        if new:
+            additions[name] = sorted(new)
+    return additions
+
+
+def update_semantic_indexes(manifest, additions):
+    """
+    SemanticType の組ごとの検索用 DB は作り直さず、additions の synonym をその組の差分の DB に加える
+    (差分の DB は小さいので作り直す)。umls_synonyms.db を書き換えた後に呼ぶ。
+    :param manifest: update_db の前の umls_synonyms.db に対応する一覧(read_semantic_manifest)
+    :param additions: semantic_index_additions の結果
+    """
+    resource_path = resource_dir()
+    delta_synonyms = manifest.setdefault('delta_synonyms', {})
+    for name, synonyms in additions.items():
+        delta_synonyms[name] = delta_synonyms.get(name, []) + synonyms
+        path = os.path.join(resource_path, semantic_delta_name(name))
+        _remove_simstring_db(path)
+        db = simstring_writer(path)
+        for synonym in delta_synonyms[name]:
+            db.insert(synonym)
+        db.close()
+        print('semantic index {}: added {} synonyms (delta {})'.format(name, len(synonyms), len(delta_synonyms[name])))
+    _write_semantic_manifest(resource_path, manifest)
+
+
+def load_semantic_indexes(resource_path):
+    """
+    SemanticType ごとの検索用 DB の一覧を読む。無い場合や umls_synonyms.db と対応していない場合は空
+    (限定した検索は全体の DB を引いてから行を絞る)。
+    :return: {SemanticType の frozenset: (DB のパス, update_db で加えた synonym の DB のパス(無ければ None))}
+    """
+    manifest = read_semantic_manifest(resource_path)
+    if manifest is None:
+        return {}
+    delta_synonyms = manifest.get('delta_synonyms', {})
+    return {frozenset(semantic_types): (os.path.join(resource_path, name),
+                                        os.path.join(resource_path, semantic_delta_name(name))
+                                        if delta_synonyms.get(name) else None)
+            for name, semantic_types in manifest['indexes'].items()}
+
+
+def _placeholder_count(n):
+    """プレースホルダ数を 2 のべき乗に丸める(SQL 文字列の種類を抑えて statement cache を効かせる)"""
+    count = 1
+    while count < n:
+        count *= 2
+    return min(count, SQLITE_MAX_VARIABLES)
+
+
 class UmlsSearcherCpp(object):
-    def __init__(self, db_name, db, feature_extractor, measure):
+    def __init__(self, db_name, db, feature_extractor, measure, delta_db=None):
         self.db_name = db_name
+        # simstring DB の reader のプール (SimstringReaderPool)。searcher は複数のスレッドから使ってよい
         self.db = db
+        # update_db で追加された synonym の simstring DB (無ければ None)
+        self.delta_db = delta_db
         self.feature_extractor = feature_extractor
         self.measure = measure
-        self.translator = Translator(service_urls=['translate.googleapis.com'])
-        self.resource_path = os.path.join(os.path.dirname(__file__), 'resource')
-        self.synonyms_db = os.path.join(self.resource_path, 'umls_synonyms.db')
+        # 候補の類似度を numpy でまとめて計算する(feature_extractor / measure と同じ値にならない場合は None)
+        from umls_mapping.scoring import make_scorer
+        self.scorer = make_scorer(feature_extractor, measure)
+        self.resource_path = resource_dir()
+        self.translator = make_translator(TRANSLATOR_BACKEND, self.resource_path, TRANSLATION_TIMEOUT)
+        self.synonyms_db = os.path.join(self.resource_path, SYNONYMS_DB_NAME)
+        self.connections = SynonymsConnectionPool(self.synonyms_db)
+        self.concepts = open_concept_store(self.resource_path)
+        self.top_k = SEARCH_TOP_K
+        self.exact_min_cuis = EXACT_MATCH_MIN_CUIS
+        # SemanticType を限定した検索(scoped() で作る)では、その SemanticType を含む行だけを返す
+        self.semantic_types = None
+        self.semantic_indexes = load_semantic_indexes(self.resource_path)
+        self._semantic_dbs = {}
+        self._semantic_lock = threading.Lock()
+
+    def scoped(self, semantic_types):
+        """
+        SemanticType を semantic_types に限定して検索する searcher を返す(DB や接続はこの searcher と共有する)。
+        その SemanticType の組の検索用 DB があればそれを引き、無ければ全体の DB を引いてから行を絞る。
+        :param semantic_types: SemanticType の集合(None や空なら限定しない)
+        """
+        if not semantic_types:
+            return self
+        semantic_types = frozenset(semantic_types)
+        if semantic_types == self.semantic_types:
+            return self
+        searcher = copy.copy(self)
+        searcher.semantic_types = semantic_types
+        dbs = self._semantic_db(semantic_types)
+        if dbs is not None:
+            # update_db で追加された synonym は、その組の差分の DB に入っている
+            searcher.db, searcher.delta_db = dbs
+        return searcher
+
+    def fuzzy(self):
+        """完全一致の近道を使わず、常に近似文字列検索する searcher を返す"""
+        if self.exact_min_cuis <= 0:
+            return self
+        searcher = copy.copy(self)
+        searcher.exact_min_cuis = 0
+        return searcher
+
+    def _semantic_db(self, semantic_types):
+        """:return: SemanticType の組の (検索用 DB, 差分の DB または None)。組の DB が無ければ None"""
+        paths = self.semantic_indexes.get(semantic_types)
+        if paths is None:
+            return None
+        with self._semantic_lock:
+            dbs = self._semantic_dbs.get(semantic_types)
+            if dbs is None:
+                path, delta_path = paths
+                dbs = self._semantic_dbs[semantic_types] = (
+                    SimstringReaderPool(path), SimstringReaderPool(delta_path) if delta_path is not None else None)
+        return dbs
 
     def ranked_search(self, query_string):
         """
@@ -79,40 +557,196 @@ class UmlsSearcherCpp(object):
         :param query_string:
         :return: (score, cui, synonym, SemanticType)
         """
-        strs = self.db.retrieve(query_string)
-        id_names = self.ids_by_names(strs)
-        # reature は cui, synonym, SemanticType, representative の順で並ぶ
-        features = self.feature_extractor.features(query_string)
+        exact = self.exact_search_many([query_string])
+        if query_string in exact:
+            return exact[query_string]
+        if self.top_k > 0:
+            return self.ranked_search_many([query_string])[query_string]
+        instrumentation = get_instrumentation()
+        with instrumentation.stage('retrieve'):
+            strs = self.retrieve(query_string)
+        with instrumentation.stage('sql'):
+            id_names = self.ids_by_names(strs)
+        instrumentation.count('searches')
+        instrumentation.count('candidates', len(strs))
+        instrumentation.count('rows', len(id_names))
+        with instrumentation.stage('score'):
+            return self._rank(query_string, id_names)
+
+    def retrieve(self, query_string, threshold=None):
+        # reader はプールから借り、借りている間だけ閾値を threshold にする
+        if threshold is None:
+            threshold = SEARCH_THRESHOLD
+        strs = []
+        for db in (self.db, self.delta_db):
+            if db is None:
+                continue
+            with db.reader() as reader:
+                reader.threshold = threshold
+                strs.extend(reader.retrieve(query_string))
+        return strs
+
+    def ranked_search_many(self, query_strings):
+        """
+        複数の query をまとめて検索する。simstring の検索は query ごとに行い、
+        SQL は全 query の候補をまとめて 1 回で引く。
+        :param query_strings:
+        :return: {query: ranked_search(query) と同じ結果}
+        """
+        query_strings = list(dict.fromkeys(query_strings))
+        results = self.exact_search_many(query_strings)
+        query_strings = [query for query in query_strings if query not in results]
+        if len(query_strings) == 0:
+            return results
+        if self.top_k > 0:
+            results.update(self._ranked_search_top_k(query_strings))
+            return results
+        id_names = self._id_names_many(query_strings)
+        with get_instrumentation().stage('score'):
+            results.update({query: self._rank(query, id_names[query]) for query in query_strings})
+        return results
+
+    def exact_search_many(self, query_strings):
+        """
+        synonym に完全一致する query の行を score 1.0 として、ranked_search と同じ形で返す。
+        CUI が exact_min_cuis 個に満たない query は含めない(近似文字列検索にまわす)。
+        :return: {query: (score, cui, synonym, SemanticType, representative, in_use) のリスト}
+        """
+        if self.exact_min_cuis <= 0 or len(query_strings) == 0:
+            return {}
+        instrumentation = get_instrumentation()
+        with instrumentation.stage('exact'):
+            rows = self.ids_by_names(query_strings)
+        rows_by_synonym = defaultdict(list)
+        for row in rows:
+            rows_by_synonym[row[1]].append(row)
+        results = {}
+        for query in query_strings:
+            best = {row[0]: 1.0 for row in rows_by_synonym.get(query, [])}
+            if len(best) == 0 or len(best) < self.exact_min_cuis:
+                continue
+            # _rank と同じく score, cui の順に並べる
+            ranked = sorted([[1.0, x[0], x[1], x[2], x[3], x[4]] for x in rows_by_synonym[query]],
+                            key=lambda x: (x[0], x[1]))
+            results[query] = self._top_k_rows(ranked, best) if self.top_k > 0 else ranked
+        instrumentation.count('exact_hits', len(results))
+        return results
+
+    def _id_names_many(self, query_strings, threshold=None):
+        """
+        query ごとに simstring で検索し、候補の synonym の行を SQL でまとめて引く。
+        :return: {query: ids_by_names(retrieve(query)) と同じ行}
+        """
+        instrumentation = get_instrumentation()
+        with instrumentation.stage('retrieve'):
+            retrieved = {query: self.retrieve(query, threshold) for query in query_strings}
+        rows_by_synonym = defaultdict(list)
+        with instrumentation.stage('sql'):
+            rows = self.ids_by_names([s for strs in retrieved.values() for s in strs])
+        for row in rows:
+            rows_by_synonym[row[1]].append(row)
+        instrumentation.count('searches', len(query_strings))
+        instrumentation.count('candidates', sum(len(strs) for strs in retrieved.values()))
+        instrumentation.count('rows', len(rows))
+        # ids_by_names と同じく synonym の昇順に並べる
+        return {query: [row for s in sorted(set(strs)) for row in rows_by_synonym.get(s, [])]
+                for query, strs in retrieved.items()}
+
+    def _ranked_search_top_k(self, query_strings):
+        """
+        閾値を高い方から下げながら検索し、上位 top_k 個の CUI が確定した query はそこで打ち切る。
+        検索(simstring の特徴量)と順位付け(前後に $ を付けた特徴量)の cosine は異なるので、閾値 t で見つからなかった
+        synonym の score も t 未満とは限らない。top_k 番目の CUI の score がその上限(scoring.unretrieved_score_bound)を
+        超えたときだけ打ち切るので、上位 top_k 個の CUI とその最大 score の行は閾値 SEARCH_THRESHOLD で全件を検索した場合と同じになる。
+        :return: {query: ranked_search() のうち上位 top_k 個の CUI の行(打ち切った場合、score の低い行は含まないことがある)}
+        """
+        thresholds = [SEARCH_THRESHOLD]
+        if self.scorer is not None and self.scorer.n == NGRAM:
+            # 上限は numpy の scorer と同じ特徴量の場合だけ求められる
+            thresholds = [t for t in TOP_K_THRESHOLDS if t > SEARCH_THRESHOLD] + thresholds
+        instrumentation = get_instrumentation()
+        results = {}
+        pending = query_strings
+        for i, threshold in enumerate(thresholds):
+            id_names = self._id_names_many(pending, threshold)
+            next_pending = []
+            with instrumentation.stage('score'):
+                for query in pending:
+                    ranked = self._rank(query, id_names[query])
+                    # ranked は score の昇順なので、CUI ごとに最後の score が最大になる
+                    best = {row[1]: row[0] for row in ranked}
+                    if i == len(thresholds) - 1 or self._top_k_settled(query, best, threshold):
+                        results[query] = self._top_k_rows(ranked, best)
+                    else:
+                        next_pending.append(query)
+            pending = next_pending
+            if len(pending) == 0:
+                break
+            instrumentation.count('threshold_relaxations', len(pending))
+        return results
+
+    def _top_k_settled(self, query, best, threshold):
+        """閾値 threshold で見つからなかった synonym が上位 top_k 個の CUI に入らないか"""
+        if len(best) < self.top_k or self.scorer.endmarker in query:
+            return False
+        from umls_mapping.scoring import unretrieved_score_bound
+        kth = heapq.nlargest(self.top_k, best.values())[-1]
+        return kth > unretrieved_score_bound(len(query), threshold, NGRAM)
+
+    def _top_k_rows(self, ranked, best):
+        if len(best) <= self.top_k:
+            return ranked
+        keep = set(cui for cui, _ in heapq.nlargest(self.top_k, best.items(), key=lambda x: (x[1], x[0])))
+        return [row for row in ranked if row[1] in keep]
+
+    def _rank(self, query_string, id_names):
+        # id_names は cui, synonym, SemanticType, representative, in_use の順で並ぶ
+        # 同じ synonym が複数の cui に現れるので、類似度は synonym ごとに一度だけ計算する
+        synonyms = list(dict.fromkeys([x[1] for x in id_names]))
+        score_by_synonym = dict(zip(synonyms, self.similarities(query_string, synonyms)))
         # result_with_score は score, cui, synonym, SemanticType の順で並ぶ
-        results_with_score = list(map(lambda x: [self.measure.similarity(features,
-                                                                         self.feature_extractor.features(x[1])), x[0], x[1], x[2], x[3], x[4]],
-                                      id_names))
+        results_with_score = [[score_by_synonym[x[1]], x[0], x[1], x[2], x[3], x[4]] for x in id_names]
         # score の小さなものから順にソートする(後で CUI 単位に集約するときに最大 score が残るようにする）
         return sorted(results_with_score, key=lambda x: (x[0], x[1]))
 
-    def ids_by_names(self, strs):
-        connection, cursor = self._get_connection_cursor()
-
-        command = 'SELECT cui, synonym, semantic, representative, in_use from umls_synonyms where synonym in (%s)' % ','.join(['?' for n in strs])
-        cursor.execute(command, strs)
-        response = cursor.fetchall()
+    def similarities(self, query_string, strs):
+        """query_string と strs の各文字列の類似度を strs の順で返す"""
+        if self.scorer is not None:
+            return self.scorer.similarities(query_string, strs).tolist()
+        features = self.feature_extractor.features(query_string)
+        return [self.measure.similarity(features, self.feature_extractor.features(x)) for x in strs]
 
-        cursor.close()
+    def ids_by_names(self, strs):
+        if self.concepts is not None:
+            return self.concepts.rows_by_names(strs, self.semantic_types)
+        # IN 句は synonym の昇順で評価されるので、分割しても結果の並びが変わらないように先にソートしておく
+        strs = sorted(set(strs))
+        if len(strs) == 0:
+            return []
+        response = []
+        with self.connections.connection() as connection:
+            for start in range(0, len(strs), SQLITE_MAX_VARIABLES):
+                chunk = strs[start:start + SQLITE_MAX_VARIABLES]
+                n_placeholders = _placeholder_count(len(chunk))
+                command = 'SELECT cui, synonym, semantic, representative, in_use from umls_synonyms where synonym in (%s)' % ','.join(['?'] * n_placeholders)
+                # 余ったプレースホルダは NULL で埋める(NULL はどの synonym にも一致しない)
+                response.extend(connection.execute(command, chunk + [None] * (n_placeholders - len(chunk))).fetchall())
+        if self.semantic_types is not None:
+            response = [row for row in response if has_semantic_type(row[2], self.semantic_types)]
 
         return response
 
-    def _get_connection_cursor(self):
-        # helper for DB access functions
-        # open DB
-        if not os.path.exists(self.synonyms_db):
-            raise normdb.dbNotFoundError(self.synonyms_db)
-        connection = sqlite.connect(self.synonyms_db)
-        cursor = connection.cursor()
-
-        return connection, cursor
+    def close(self):
+        self.connections.close()
+        self.translator.close()
+        for db in [self.db, self.delta_db] + [db for dbs in self._semantic_dbs.values() for db in dbs]:
+            if db is not None:
+                db.close()
 
 DROP_COMMANDS = [
     'DROP TABLE IF EXISTS umls_synonyms;',
+    'DROP TABLE IF EXISTS umls_delta_synonyms;',
+    'DROP TABLE IF EXISTS umls_metadata;',
     'DROP INDEX IF EXISTS cui_idx;',
     'DROP INDEX IF EXISTS synonym_idx;',
 ]
@@ -133,31 +767,200 @@ CREATE_INDEX_COMMANDS = [
     "CREATE INDEX synonym_idx ON umls_synonyms (synonym);",
 ]
 
+# リソースの情報(build profile など)。key ごとに JSON で持つ
+CREATE_METADATA_TABLE_COMMAND = """CREATE TABLE IF NOT EXISTS umls_metadata (
+  key VARCHAR(255) PRIMARY KEY,
+  value TEXT
+);"""
+
+# update_db で追加した synonym (UMLS.delta.ss.db の中身)
+CREATE_DELTA_TABLE_COMMAND = """CREATE TABLE IF NOT EXISTS umls_delta_synonyms (
+  synonym VARCHAR(255) PRIMARY KEY
+);"""
+
+
+# init_db で UMLS_synonyms.txt を一度に読み込む行数
+BULK_CHUNK_SIZE = 100000
+# init_db 中だけ使う設定(ジャーナルを書かず、同期もしない)
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = MEMORY;',
+    'PRAGMA synchronous = OFF;',
+    'PRAGMA temp_store = MEMORY;',
+    'PRAGMA cache_size = -262144;',
+]
+# update_db ではジャーナルを残す(途中で止まっても DB が壊れないように)。
+# 新しい UMLS_synonyms.txt 全体を TEMP テーブルに読み込んで差分を取るので、TEMP はメモリではなくファイルに置く
+# (メモリ使用量が UMLS 全体の大きさで増えないように。TEMP のページキャッシュは 64MB まで)
+UPDATE_PRAGMAS = [
+    'PRAGMA temp_store = FILE;',
+    'PRAGMA cache_size = -262144;',
+    'PRAGMA temp.cache_size = -65536;',
+]
+SYNONYMS_TEXT_COLUMNS = ['cui', 'SemanticType', 'synonym', 'representative']
+INSERT_SYNONYM_COMMAND = "INSERT into umls_synonyms VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def read_synonyms_chunks(path, chunksize=None):
+    """
+    UMLS_synonyms.txt を chunksize 行ずつ DataFrame で返す(全体をメモリに載せない)。
+    in_use が無い行は 0 とし、それ以外の列に欠損がある行は捨てる。
+    """
+    import pandas as pd
+    if chunksize is None:
+        chunksize = BULK_CHUNK_SIZE
+    for df in pd.read_csv(path, sep='\t', chunksize=chunksize,
+                          dtype={column: str for column in SYNONYMS_TEXT_COLUMNS}):
+        if 'in_use' not in df.columns:
+            df['in_use'] = 0
+        df = df.fillna({'in_use': 0.0}).dropna()
+        df['in_use'] = df['in_use'].astype('int')
+        yield df
+
+
+def _insert_synonym_rows(cursor, rows, error_count, max_error_lines=100):
+    """
+    rows を executemany でまとめて insert する。
+    失敗したときは rows を取り消し、1 行ずつ insert し直して失敗した行だけを飛ばす。
+    :return: (insert した行数, error_count)
+    """
+    cursor.execute('SAVEPOINT bulk_insert;')
+    try:
+        cursor.executemany(INSERT_SYNONYM_COMMAND, rows)
+        cursor.execute('RELEASE bulk_insert;')
+        return len(rows), error_count
+    except sqlite.IntegrityError:
+        cursor.execute('ROLLBACK TO bulk_insert;')
+        cursor.execute('RELEASE bulk_insert;')
+    inserted = 0
+    for row in rows:
+        try:
+            cursor.execute(INSERT_SYNONYM_COMMAND, row)
+        except sqlite.IntegrityError as e:
+            if error_count < max_error_lines:
+                print("Error inserting %s (skipping): %s" % (row[1], e), file=sys.stderr)
+            elif error_count == max_error_lines:
+                print("(Too many errors; suppressing further error messages)", file=sys.stderr)
+            error_count += 1
+            continue
+        inserted += 1
+    return inserted, error_count
+
+
+def iter_synonym_row_chunks(path):
+    """
+    UMLS_synonyms.txt の行を (cui, SemanticType, synonym, representative, in_use) のリストで chunk ごとに返す。
+    CUI の最初の行の representative は synonym にする。
+    """
+    prev_cui = ''
+    for df1 in read_synonyms_chunks(path):
+        rows = []
+        for cui, s_type, synonym, representative, in_use in zip(df1["cui"], df1["SemanticType"], df1["synonym"],
+                                                              df1["representative"], df1["in_use"]):
+            if prev_cui != cui:
+                prev_cui = cui
+                representative = synonym
+            rows.append((cui, s_type, synonym, representative, in_use))
+        yield rows
+
+
+def read_build_profile_file(synonyms_path):
+    """
+    synonyms_path と同じディレクトリの build_profile.json を返す。
+    無い場合や、別の UMLS_synonyms.txt について書かれたものの場合は None
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(synonyms_path)), BUILD_PROFILE_NAME)
+    try:
+        with open(path, mode='r', encoding='utf_8') as f:
+            build_profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if build_profile.get('synonyms_file') != _file_fingerprint(synonyms_path):
+        return None
+    return build_profile
+
+
+def _record_build_profile(cursor, synonyms_path):
+    """synonyms_path の build profile を umls_metadata に記録する(変わっていなければ書かない)"""
+    cursor.execute(CREATE_METADATA_TABLE_COMMAND)
+    build_profile = read_build_profile_file(synonyms_path)
+    value = json.dumps(build_profile, ensure_ascii=False, sort_keys=True) if build_profile is not None else None
+    row = cursor.execute("SELECT value FROM umls_metadata WHERE key = 'build_profile'").fetchone()
+    if (row[0] if row is not None else None) != value:
+        cursor.execute("DELETE FROM umls_metadata WHERE key = 'build_profile'")
+        if value is not None:
+            cursor.execute("INSERT INTO umls_metadata VALUES ('build_profile', ?)", (value,))
+    print('build profile: {}'.format(build_profile['profile'] if build_profile is not None else 'unknown'))
+
+
+def read_build_profile(resource_path=None):
+    """
+    umls_synonyms.db を作った UMLS_synonyms.txt の build profile を返す(記録が無ければ None)
+    :return: {'profile': 名前, 'filters': {...}, 'rows': ..., 'full_rows': ..., ...}
+    """
+    if resource_path is None:
+        resource_path = resource_dir()
+    sqldbfn = os.path.join(resource_path, SYNONYMS_DB_NAME)
+    if not os.path.exists(sqldbfn):
+        return None
+    connection = sqlite.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(sqldbfn)), uri=True)
+    try:
+        row = connection.execute("SELECT value FROM umls_metadata WHERE key = 'build_profile'").fetchone()
+    except sqlite.OperationalError:
+        # umls_metadata が無い(古い DB)
+        return None
+    finally:
+        connection.close()
+    return json.loads(row[0]) if row is not None else None
+
+
+def _remove_simstring_db(path):
+    if os.path.exists(path):
+        os.remove(path)
+        d_l = glob.glob(path + '.*.cdb') + glob.glob(path + '.*.npy')
+        for d in d_l:
+            os.remove(d)
+
+
+def simstring_writer(path):
+    """SEARCH_ENGINE の検索用 DB の writer を作る"""
+    if SEARCH_ENGINE == 'ngram_index':
+        from umls_mapping.ngram_index import NgramIndexWriter
+        return NgramIndexWriter(path, NGRAM, False, True)
+    import simstring_cpp
+    return simstring_cpp.writer(path, NGRAM, False, True)
+
+
+def simstring_reader(path):
+    """SEARCH_ENGINE の検索用 DB を cosine 類似度、閾値 SEARCH_THRESHOLD で開く"""
+    if SEARCH_ENGINE == 'ngram_index':
+        from umls_mapping import ngram_index
+        db = ngram_index.NgramIndexReader(path)
+        db.measure = ngram_index.cosine
+    else:
+        import simstring_cpp
+        db = simstring_cpp.reader(path)
+        db.measure = simstring_cpp.cosine
+    db.threshold = SEARCH_THRESHOLD
+    return db
+
 
 def init_db_cpp():
 
-    resource_path = (os.path.join(os.path.dirname(__file__), UMLS_DB_PATH))
-    df1 = pd.read_csv(os.path.join(resource_path, 'UMLS_synonyms.txt'), sep='\t')
-    df1.fillna({'in_use': 0.0}, inplace=True)
-    df1['in_use'].astype('int')
-    df1 = df1.dropna()
+    resource_path = resource_dir()
+    synonyms_path = os.path.join(resource_path, 'UMLS_synonyms.txt')
 
     # Create a SimString database
     db_path_base = os.path.join(resource_path)
     if not os.path.exists(db_path_base):
         os.makedirs(db_path_base)
     simastring_db_path = os.path.join(db_path_base, UMLS_DB_NAME)
-    if os.path.exists(simastring_db_path):
-        os.remove(simastring_db_path)
-        d_l = glob.glob(simastring_db_path + '.*.cdb')
-        for d in d_l:
-            os.remove(d)
-    db = simstring_cpp.writer(simastring_db_path,
-                              NGRAM, False, True)
-    t_size = len(df1)
+    _remove_simstring_db(simastring_db_path)
+    # 作り直すので update_db で追加した分も不要になる
+    _remove_simstring_db(os.path.join(db_path_base, UMLS_DELTA_DB_NAME))
+    db = simstring_writer(simastring_db_path)
 
     # create SQL DB
-    sqldbfn = os.path.join(db_path_base, 'umls_synonyms.db')
+    sqldbfn = os.path.join(db_path_base, SYNONYMS_DB_NAME)
     try:
         connection = sqlite.connect(sqldbfn, isolation_level='EXCLUSIVE')
     except sqlite.OperationalError as e:
@@ -165,6 +968,9 @@ def init_db_cpp():
         return 1
     cursor = connection.cursor()
 
+    for pragma in BULK_LOAD_PRAGMAS:
+        cursor.execute(pragma)
+
     for drp in DROP_COMMANDS:
         try:
             cursor.execute(drp)
@@ -178,38 +984,26 @@ def init_db_cpp():
         except sqlite.OperationalError as e:
             print("Error creating %s:" % sqldbfn, e, "(DB exists?)", file=sys.stderr)
             return 1
+    _record_build_profile(cursor, synonyms_path)
 
     error_count = 0
-    MAX_ERROR_LINES = 100
     count = 0
-    prev_cui = ''
-    representative = ''
-    for cui, s_type, synonym, representative, in_use in zip(df1["cui"], df1["SemanticType"], df1["synonym"],
-                                                          df1["representative"], df1["in_use"]):
-        db.insert(synonym)
-
-        # insert entity
-        if prev_cui != cui:
-            prev_cui = cui
-            representative = synonym
-        try:
-            cursor.execute(
-                "INSERT into umls_synonyms VALUES (?, ?, ?, ?, ?, ?)",
-                (count, cui, s_type, synonym, representative, in_use))
-        except sqlite.IntegrityError as e:
-            if error_count < MAX_ERROR_LINES:
-                print("Error inserting %s (skipping): %s" % (cui, e), file=sys.stderr)
-            elif error_count == MAX_ERROR_LINES:
-                print("(Too many errors; suppressing further error messages)", file=sys.stderr)
-            error_count += 1
-            continue
-
-        count += 1
-        if count % 100000 == 0:
-            print('{}/{}'.format(count, t_size))
-            connection.commit()
-
-    connection.commit()
+    row_id = 0
+    start_time = time.time()
+    for chunk in iter_synonym_row_chunks(synonyms_path):
+        rows = []
+        for cui, s_type, synonym, representative, in_use in chunk:
+            db.insert(synonym)
+            # insert entity
+            rows.append((row_id, cui, s_type, synonym, representative, in_use))
+            row_id += 1
+        inserted, error_count = _insert_synonym_rows(cursor, rows, error_count)
+        count += inserted
+        connection.commit()
+        elapsed = time.time() - start_time
+        print('{} rows, {:.1f} sec, {:.0f} rows/sec'.format(count, elapsed, count / max(elapsed, 1e-6)))
+
+    # index は全行を insert し終えてから作る
     for command in CREATE_INDEX_COMMANDS:
         try:
             cursor.execute(command)
@@ -217,7 +1011,150 @@ def init_db_cpp():
             print("DB Error creating index: ", e, file=sys.stderr)
             raise e
     connection.commit()
+    connection.close()
     db.close()
+    build_concept_store()
+    build_semantic_indexes()
+    build_startup_artifact()
+    elapsed = time.time() - start_time
+    print('loaded {} rows in {:.1f} sec ({:.0f} rows/sec)'.format(count, elapsed, count / max(elapsed, 1e-6)))
+
+
+UPDATE_COMMANDS = [
+    # 新しい UMLS_synonyms.txt の内容
+    """CREATE TEMP TABLE new_synonyms (
+  cui VARCHAR(8),
+  semantic VARCHAR(255),
+  synonym VARCHAR(255),
+  representative VARCHAR(255),
+  in_use INTEGER
+);""",
+]
+
+# 行全体で比較して、現在の DB にしかない行(削除)と新しいファイルにしかない行(追加)を求める
+DIFF_COMMANDS = [
+    """CREATE TEMP TABLE removed_synonyms AS
+  SELECT cui, semantic, synonym, representative, in_use FROM umls_synonyms
+  EXCEPT SELECT cui, semantic, synonym, representative, in_use FROM new_synonyms;""",
+    """CREATE TEMP TABLE added_synonyms AS
+  SELECT cui, semantic, synonym, representative, in_use FROM new_synonyms
+  EXCEPT SELECT cui, semantic, synonym, representative, in_use FROM umls_synonyms;""",
+    "CREATE INDEX temp.removed_idx ON removed_synonyms (synonym);",
+    "CREATE INDEX temp.new_synonym_idx ON new_synonyms (synonym);",
+]
+
+# (cui, synonym) 単位の追加・削除・変更の数。差分の行(removed_synonyms, added_synonyms)の (cui, synonym) を
+# 現在の DB (umls_synonyms) と新しいファイル(new_synonyms)で引いて、片方にしか無ければ追加・削除、両方にあれば変更
+KEY_DIFF_COMMANDS = [
+    """SELECT COUNT(*) FROM (SELECT DISTINCT cui, synonym FROM added_synonyms a
+  WHERE NOT EXISTS (SELECT 1 FROM umls_synonyms o WHERE o.synonym = a.synonym AND o.cui = a.cui));""",
+    """SELECT COUNT(*) FROM (SELECT DISTINCT cui, synonym FROM removed_synonyms r
+  WHERE NOT EXISTS (SELECT 1 FROM new_synonyms n WHERE n.synonym = r.synonym AND n.cui = r.cui));""",
+    """SELECT COUNT(*) FROM (SELECT cui, synonym FROM removed_synonyms UNION SELECT cui, synonym FROM added_synonyms) d
+  WHERE EXISTS (SELECT 1 FROM umls_synonyms o WHERE o.synonym = d.synonym AND o.cui = d.cui)
+  AND EXISTS (SELECT 1 FROM new_synonyms n WHERE n.synonym = d.synonym AND n.cui = d.cui);""",
+]
+
+
+def update_db_cpp(new_synonyms_path=None):
+    """
+    新しい UMLS_synonyms.txt と現在の umls_synonyms テーブルの差分(追加・削除・変更された行)だけを DB に反映する。
+    simstring DB は追記できないので、新しく現れた synonym は UMLS.delta.ss.db に入れる(検索時は両方を引く)。
+    削除された synonym は simstring DB に残るが、umls_synonyms に行が無いので検索結果には現れない。
+    concept store も作り直さず、行が変わった synonym だけの差分(umls_concepts.delta.db)を作り直す。
+    差分が CONCEPT_DELTA_MAX_FRACTION を超えたときだけ全体を作り直す。
+    SemanticType ごとの検索用 DB も、その型の行が新たに加わった synonym だけを差分(UMLS.sty_*.delta.ss.db)に入れる。
+    追加・削除・変更は (cui, synonym) 単位で数える。新しいファイルにだけある (cui, synonym) が追加、現在の DB にだけあるものが削除、
+    両方にあって行(SemanticType, representative, in_use)が違うものが変更。
+    :param new_synonyms_path: 新しい UMLS_synonyms.txt (省略時は resource/UMLS_synonyms.txt)
+    :return: (追加, 削除, 変更) の (cui, synonym) の数
+    """
+    resource_path = resource_dir()
+    if new_synonyms_path is None:
+        new_synonyms_path = os.path.join(resource_path, 'UMLS_synonyms.txt')
+    sqldbfn = os.path.join(resource_path, SYNONYMS_DB_NAME)
+    if not os.path.exists(sqldbfn):
+        raise normdb.dbNotFoundError(sqldbfn)
+    start_time = time.time()
+    # 書き換える前の umls_synonyms.db に対応する concept store と SemanticType ごとの検索用 DB には差分を重ねる
+    try:
+        store = _read_concept_store(resource_path)
+    except (OSError, ValueError):
+        store = None
+    if store is not None and not store.matches(sqldbfn):
+        store = None
+    groups = set(frozenset(semantic_types) for semantic_types in ENTITY_SEMANTIC_TYPES.values() if semantic_types)
+    manifest = read_semantic_manifest(resource_path)
+    if manifest is not None and set(frozenset(t) for t in manifest['indexes'].values()) != groups:
+        manifest = None
+    connection = sqlite.connect(sqldbfn, isolation_level='EXCLUSIVE')
+    cursor = connection.cursor()
+    for pragma in UPDATE_PRAGMAS:
+        cursor.execute(pragma)
+    for command in UPDATE_COMMANDS + [CREATE_DELTA_TABLE_COMMAND]:
+        cursor.execute(command)
+
+    n_rows = 0
+    for rows in iter_synonym_row_chunks(new_synonyms_path):
+        cursor.executemany("INSERT into new_synonyms VALUES (?, ?, ?, ?, ?)", rows)
+        n_rows += len(rows)
+    for command in DIFF_COMMANDS:
+        cursor.execute(command)
+    _record_build_profile(cursor, new_synonyms_path)
+
+    # 行の数(DB に書く量)と、(cui, synonym) 単位の追加・削除・変更の数
+    n_removed = cursor.execute("SELECT COUNT(*) FROM removed_synonyms").fetchone()[0]
+    n_added = cursor.execute("SELECT COUNT(*) FROM added_synonyms").fetchone()[0]
+    n_added_keys, n_removed_keys, n_changed_keys = [cursor.execute(command).fetchone()[0] for command in KEY_DIFF_COMMANDS]
+    # 現在の DB に無かった synonym は simstring DB にも無いので、delta に追加する
+    new_strings = [row[0] for row in cursor.execute(
+        """SELECT DISTINCT synonym FROM added_synonyms a
+  WHERE NOT EXISTS (SELECT 1 FROM umls_synonyms o WHERE o.synonym = a.synonym)
+  AND NOT EXISTS (SELECT 1 FROM umls_delta_synonyms d WHERE d.synonym = a.synonym)""").fetchall()]
+    # 行が変わった synonym (concept store の差分に入れる)と、SemanticType の組ごとの検索用 DB に加える synonym
+    changed_synonyms = [row[0] for row in cursor.execute(
+        "SELECT synonym FROM removed_synonyms UNION SELECT synonym FROM added_synonyms")]
+    additions = semantic_index_additions(cursor, manifest) if manifest is not None else {}
+
+    cursor.execute(
+        """DELETE FROM umls_synonyms WHERE id IN (
+  SELECT o.id FROM umls_synonyms o JOIN removed_synonyms r
+  ON o.synonym = r.synonym AND o.cui = r.cui AND o.semantic = r.semantic
+  AND o.representative = r.representative AND o.in_use = r.in_use)""")
+    next_id = cursor.execute("SELECT COALESCE(MAX(id), -1) + 1 FROM umls_synonyms").fetchone()[0]
+    cursor.execute(
+        """INSERT INTO umls_synonyms (id, cui, semantic, synonym, representative, in_use)
+  SELECT ? + ROWID - 1, cui, semantic, synonym, representative, in_use FROM added_synonyms""", (next_id,))
+    cursor.executemany("INSERT OR IGNORE INTO umls_delta_synonyms VALUES (?)", [(s,) for s in new_strings])
+    delta_strings = [row[0] for row in cursor.execute("SELECT synonym FROM umls_delta_synonyms")]
+    connection.commit()
+    connection.close()
+
+    # 追加分の simstring DB を作り直す(追加分だけなので小さい)
+    delta_db_path = os.path.join(resource_path, UMLS_DELTA_DB_NAME)
+    _remove_simstring_db(delta_db_path)
+    if len(delta_strings) > 0:
+        db = simstring_writer(delta_db_path)
+        for synonym in delta_strings:
+            db.insert(synonym)
+        db.close()
+    # concept store は行が変わった synonym の差分だけを作る(差分が大きい場合と、store が無い・古い場合は全体を作り直す)
+    delta_store = 'unchanged'
+    if store is None or not store.matches(sqldbfn):
+        n_delta = update_concept_store(store, changed_synonyms)
+        delta_store = 'rebuilt' if n_delta is None else '{} synonyms'.format(n_delta)
+    # SemanticType ごとの DB には、組の行が新たに加わった synonym の差分の DB を足す。
+    # 一覧が無い・古い場合と、ENTITY_SEMANTIC_TYPES の組が変わった場合は作り直す
+    if manifest is None:
+        build_semantic_indexes()
+    else:
+        update_semantic_indexes(manifest, additions)
+    elapsed = time.time() - start_time
+    print('compared {} rows: (cui, synonym) added {}, removed {}, changed {}; rows inserted {}, deleted {} '
+          '(new synonyms {}, delta index {}, concept store delta {}) in {:.1f} sec'.format(
+              n_rows, n_added_keys, n_removed_keys, n_changed_keys, n_added, n_removed, len(new_strings),
+              len(delta_strings), delta_store, elapsed))
+    return n_added_keys, n_removed_keys, n_changed_keys
 
 
 def main():
@@ -225,6 +1162,8 @@ def main():
     # 初回のみ init_db() を実行して Mongo DB にデータを insert しておく
     if args.init_db:
         init_db_cpp()
+    elif args.update_db is not None:
+        update_db_cpp(args.update_db or None)
     else:
         # '''
         querys_list = [["白血球数 15.0 ×千/μl"], ["身長"], ["身長", "body height"], ["身長 190 cm"], ["高い身長"],
@@ -235,9 +1174,9 @@ def main():
         # query_list[['身長'], ['高さ']]
         # querys_list = [["white blood cell disorder"], ["左大腿骨 頸部 骨折"]]
         searcher = load_dct()
-        test_value_df = test_value_set()
+        test_value_index = test_value_set()
         for querys in querys_list:
-            querys = lab_value_normalization(querys, test_value_df)
+            querys = lab_value_normalization(querys, test_value_index)
             scored_concept = word2UMLS(querys,  searcher, database='UMLS')
             print(scored_concept)
         # '''
@@ -245,6 +1184,7 @@ def main():
 
 # 翻訳
 def translate_Google(querys):
+    from googletrans import Translator
     translator = Translator()
     tmp = []
     for name in (querys):
@@ -252,41 +1192,154 @@ def translate_Google(querys):
     return tmp
 
 
-def word2UMLS(querys, searcher, database):
-    scored_concept = {}
-    for query in querys:
-        query = query.lower()
-        is_alnum_flag = is_alnum(query)
-        scored_concept, direct_hit = _word2umls_impl(query, scored_concept, is_alnum_flag, searcher, database)
-        # if not direct_hit:
-        if True:
-            try:  # direct_hit に関係せず英語翻訳を実行するように変更してみた。(20211222)
-                # googletrans はたまに失敗する。失敗したら googletrans を作り直して再検索する。
-                # 5回失敗したら変換検索は諦める
-                t_query = None
-                for i in range(5):
-                    try:
-                        t_query = searcher.translator.translate(query, src='ja')
-                        break
-                    except Exception as e:
-                        if i == 4:
-                            # googletrans がどうしても成功しないとき
-                            Messager.error(e)
-                        searcher.translator = Translator(service_urls=['translate.googleapis.com'])
-                if t_query is not None:
-                    t_query = t_query.text.lower().replace('_', '')
-                    scored_concept, direct_hit = _word2umls_impl(t_query, scored_concept, True, searcher, database)
-            except ConnectionError as e:
-                Messager.error(e)
+def word2UMLS(querys, searcher, database, semantic_types=None, fuzzy=False):
+    """
+    :param semantic_types: 検索する SemanticType の集合(None なら全て)。Unknown はこれによらず返す
+    :param fuzzy: True なら synonym に完全一致しても近似文字列検索する
+    """
+    return word2UMLS_many([querys], searcher, database, semantic_types, fuzzy)[0]
+
+
+def word2UMLS_many(querys_list, searcher, database, semantic_types=None, fuzzy=False, untranslated=None):
+    """
+    複数の span の querys をまとめて word2UMLS にかける。
+    同じ query(小文字にしたもの)と同じ訳語は一度だけ処理し、翻訳はまとめて 1 回、simstring と SQL は
+    直接検索(日本語・英語)と部分一致検索にまとめて行う。翻訳は日本語の直接検索と並行して行う。
+    :param querys_list: querys (lab_value_normalization の結果)のリスト
+    :param semantic_types: 検索する SemanticType の集合(None なら全て)。Unknown はこれによらず返す
+    :param fuzzy: True なら synonym に完全一致しても近似文字列検索する
+    :param untranslated: set を渡すと、翻訳に失敗して(翻訳サービスを止めている間を含む)英語で検索できなかった
+                         span の番号(querys_list の添字)を加える。その結果は英語の候補を欠くので、長く保存しない
+    :return: querys_list と同じ順の word2UMLS(querys) の結果
+    """
+    instrumentation = get_instrumentation()
+    searcher = searcher.scoped(semantic_types)
+    if fuzzy:
+        searcher = searcher.fuzzy()
+    querys_list = [[query.lower() for query in querys] for querys in querys_list]
+    with instrumentation.query([query for querys in querys_list for query in querys]):
+        querys = list(dict.fromkeys(query for querys in querys_list for query in querys))
+        # direct_hit に関係せず英語翻訳を実行するように変更してみた。(20211222)
+        # 再試行・タイムアウト・翻訳結果のキャッシュは searcher.translator (translation.py) が行う。
+        # 翻訳できなかった場合は英語検索を諦める
+        translate = instrumentation.bind(searcher.translator.translate_many)
+        executor = _stage_executor()
+        future = executor.submit(translate, querys, src='ja') if executor is not None else None
+        # (query, is_alnum_flag) ごとの検索をまとめて行う
+        searches = [(query, is_alnum(query)) for query in querys]
+        ranked = _direct_search_round(searcher, searches)
+        with instrumentation.stage('translate'):
+            translations, errors = future.result() if future is not None else translate(querys, src='ja')
+        for e in errors.values():
+            instrumentation.count('translation_errors')
+            Messager.error(e)
+        t_querys = {}
+        for query, t_query in translations.items():
+            if t_query is not None:
+                t_querys[query] = t_query.lower().replace('_', '')
+        t_searches = [(t_query, True) for t_query in dict.fromkeys(t_querys.values())]
+        ranked.update(_direct_search_round(searcher, t_searches, ranked))
+        trimmed = _trim_search_round(searcher, list(dict.fromkeys(searches + t_searches)), ranked)
+
+        results = []
+        for i, querys in enumerate(querys_list):
+            if untranslated is not None and any(query in errors for query in querys):
+                untranslated.add(i)
+            scored_concept = {}
+            for query in querys:
+                scored_concept, direct_hit = _word2umls_impl(query, scored_concept, is_alnum(query), searcher, database,
+                                                             ranked, trimmed)
+                if query in t_querys:
+                    scored_concept, direct_hit = _word2umls_impl(t_querys[query], scored_concept, True, searcher,
+                                                                 database, ranked, trimmed)
+            results.append(_sorted_concepts(scored_concept, searcher.top_k))
+    return results
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _stage_executor():
+    """word2UMLS の stage を並行して行うスレッドプール(STAGE_WORKERS が 0 なら None)"""
+    global _executor
+    if STAGE_WORKERS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='word2UMLS')
+        return _executor
+
+
+def _reset_stage_executor():
+    # fork した子プロセス(bulk_link の process pool など)には親のスレッドが無いので、引き継いだプールに投げると返ってこない
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_stage_executor)
+
+
+def _sorted_concepts(scored_concept, top_k):
     # UNKを先頭に
-    if "C0439673" not in scored_concept:
-        scored_concept["C0439673"] = (5.0, 'unknown', 'Qualitative Concept', 'Unknown', 0)  # 1.0 より大きい数字
+    if UNKNOWN_CUI not in scored_concept:
+        scored_concept[UNKNOWN_CUI] = (5.0, 'unknown', 'Qualitative Concept', 'Unknown', 0)  # 1.0 より大きい数字
     scored_concept = sorted(scored_concept.items(), key=lambda x: -1.0 * x[1][0])
+    if top_k > 0:
+        scored_concept = _top_k_concepts(scored_concept, top_k)
     return scored_concept
 
 
-def _search_id(searcher, query, alpha, database='UMLS'):
-    results = searcher.ranked_search(query)
+def _direct_search_round(searcher, searches, ranked=None):
+    """
+    _word2umls_impl の直接検索をまとめて行う(ranked にあるものは検索しない)
+    :param searches: [(query, is_alnum_flag), ...]
+    :return: {検索した文字列: ranked_search(文字列)}
+    """
+    direct_querys = [query.replace('_', ' ') for query, _ in searches]
+    with get_instrumentation().stage('direct_search'):
+        return searcher.ranked_search_many([query for query in direct_querys if ranked is None or query not in ranked])
+
+
+def _trim_search_round(searcher, searches, ranked):
+    """
+    直接検索で見つからなかった query の部分一致検索の query をまとめて検索する。
+    部分一致検索には完全一致の近道を使わないので、直接検索の結果(ranked)とは分けて返す
+    :param searches: [(query, is_alnum_flag), ...]
+    :return: {部分一致検索の query: searcher.fuzzy().ranked_search(query)}
+    """
+    instrumentation = get_instrumentation()
+    trim_querys = []
+    for query, is_alnum_flag in searches:
+        if len(ranked[query.replace('_', ' ')]) == 0:
+            right_querys, left_querys = _trim_querys(query, is_alnum_flag)
+            instrumentation.count('trim_querys', len(right_querys) + len(left_querys))
+            trim_querys.extend(right_querys + left_querys)
+    with instrumentation.stage('trim'):
+        return searcher.fuzzy().ranked_search_many(list(dict.fromkeys(trim_querys)))
+
+
+def _top_k_concepts(scored_concept, top_k):
+    """score の降順に並んだ scored_concept から、Unknown と上位 top_k 個の概念を残す"""
+    kept = []
+    n_concepts = 0
+    for concept in scored_concept:
+        if concept[0] == UNKNOWN_CUI:
+            kept.append(concept)
+        elif n_concepts < top_k:
+            kept.append(concept)
+            n_concepts += 1
+    return kept
+
+
+def _search_id(searcher, query, alpha, database='UMLS', ranked=None):
+    # ranked は ranked_search_many() でまとめて検索した結果
+    if ranked is not None and query in ranked:
+        results = ranked[query]
+    else:
+        results = searcher.ranked_search(query)
     # strs = [s[1] for s in results]
     # ersults は score の小さなものから並んでいるので順に辞書に積むと、最大の値が残る
     # results は score, cui, synonym, SemanticType の順で並ぶ
@@ -306,15 +1359,50 @@ def _concept_update(concept, results):
                 concept[k] = (score, synonym, ty, rep, in_use)
 
 
-def _word2umls_impl(query, scored_concept, is_alnum_flag, searcher, database):
+def _trim_querys(query, is_alnum_flag):
+    """
+    部分一致検索の query を返す
+    :return: (右から 1 単語ずつ削った query, 左から 1 単語ずつ削った query)
+    """
+    # 形態素解析
+    wakati = []
+    if not is_alnum_flag:
+        sep = ''
+        # 名詞・動詞・形容詞だけを取り出す(Tagger はプールで使い回し、結果は query 単位でキャッシュされる)
+        with get_instrumentation().stage('mecab'):
+            content_words = get_tokenizer().content_words(query)
+        for w in content_words:
+            # high とか low とかの文字列が hit するのを回避する。
+            # 英語検索の時に検索されるので、ここで無視しても問題ない。
+            if not is_alnum(w):
+                wakati.append(w)
+    else:
+        sep = ' '
+        stop_words = english_stop_words()
+        wakati = [w.lower() for w in query.split(' ') if not w.lower() in stop_words]
+    right_querys = [sep.join(wakati[:i]) for i in range(len(wakati), 0, -1)]
+    left_querys = [sep.join(wakati[i:]) for i in range(1, len(wakati), 1)]
+    return right_querys, left_querys
+
+
+def _word2umls_impl(query, scored_concept, is_alnum_flag, searcher, database, ranked=None, trimmed=None):
+    """
+    :param ranked: word2UMLS_many でまとめて直接検索した結果。無い query はここで検索する
+    :param trimmed: word2UMLS_many でまとめて部分一致検索した結果(_trim_search_round)
+    """
     # alpha が低いと検索がいちじるしく遅くなる
     # results = _search_id(searcher, query, 0.75, database)
     if not is_alnum_flag:
         base_score = 2.0
     else:
         base_score = 0.0
+    instrumentation = get_instrumentation()
     org_len_features = float(len(searcher.feature_extractor.features(query)))
-    results = _search_id(searcher, query.replace('_', ' '), SEARCH_THRESHOLD, database)
+    direct_query = query.replace('_', ' ')
+    # word2UMLS_many でまとめて検索した query は、その検索(_direct_search_round)で stage を記録している
+    searched = ranked is None or direct_query not in ranked
+    with instrumentation.stage('direct_search') if searched else contextlib.nullcontext():
+        results = _search_id(searcher, direct_query, SEARCH_THRESHOLD, database, ranked)
     if len(results) != 0:
         # 日本語検索は + 2点、ダイレクトヒットは +1 点にしておく
         results = {cui: (score + 1.0 + base_score, synonym, ty, rep, in_use) for cui, (score, synonym, ty, rep, in_use) in results.items()}
@@ -323,46 +1411,33 @@ def _word2umls_impl(query, scored_concept, is_alnum_flag, searcher, database):
     # ここでまだない場合は部分一致で検索を実行
     else:
         direct_hit = False
-        # 形態素解析
-        wakati = []
-        if not is_alnum_flag:
-            sep = ''
-            mecab = MeCab.Tagger()
-            for w in mecab.parse(query).split('\n'):
-                if w == "EOS":
-                    break
-                else:
-                    if w.split("\t")[1].split(",")[0] in ["名詞", "動詞", "形容詞"]:
-                        # high とか low とかの文字列が hit するのを回避する。
-                        # 英語検索の時に検索されるので、ここで無視しても問題ない。
-                        if not is_alnum(w.split("\t")[0]):
-                            wakati.append(w.split("\t")[0])
-                    else:
-                        pass
-        else:
-            sep = ' '
-            wakati = [w.lower() for w in query.split(' ') if not w.lower() in stop_words_sklearn]
-
+        right_querys, left_querys = _trim_querys(query, is_alnum_flag)
+        # 右から削った query と左から削った query を先に全部作り、重複を除いてまとめて検索しておく
+        # (word2UMLS_many では _trim_search_round で検索済みなので、stage もそちらで記録している)
+        # 完全一致の近道は span の query 全体だけに使い、削った query は常に近似文字列検索する
+        if trimmed is None or any(q not in trimmed for q in right_querys + left_querys):
+            instrumentation.count('trim_querys', len(right_querys) + len(left_querys))
+            with instrumentation.stage('trim'):
+                trimmed = searcher.fuzzy().ranked_search_many(right_querys + left_querys)
         # 右から1単語ずつ削る
-        for i in range(len(wakati), 0, -1):
-            partial_query = sep.join(wakati[:i])
-            results = partial_search(searcher, partial_query, database, org_len_features, base_score)
+        for partial_query in right_querys:
+            results = partial_search(searcher, partial_query, database, org_len_features, base_score, trimmed)
             if len(results) != 0:
                 _concept_update(scored_concept, results)
                 break
         # 左側から1単語ずつ削る
-        for i in range(1, len(wakati), 1):
-            partial_query = sep.join(wakati[i:])
-            results = partial_search(searcher, partial_query, database, org_len_features, base_score)
+        for partial_query in left_querys:
+            results = partial_search(searcher, partial_query, database, org_len_features, base_score, trimmed)
             if len(results) != 0:
                 _concept_update(scored_concept, results)
                 break
     return scored_concept, direct_hit
 
 
-def partial_search(searcher, partial_query, database, org_len_features, base_score):
+def partial_search(searcher, partial_query, database, org_len_features, base_score, ranked=None):
+    get_instrumentation().count('partial_searches')
     results = _search_id(searcher, partial_query,
-                         SEARCH_THRESHOLD, database)
+                         SEARCH_THRESHOLD, database, ranked)
     if len(results) != 0:
         feature_len = float(len(searcher.feature_extractor.features(partial_query)))
         # 文字を削って見つけた結果は減点する
@@ -372,6 +1447,7 @@ def partial_search(searcher, partial_query, database, org_len_features, base_sco
 
 
 def convert2df(sub, file):
+    import pandas as pd
     list_df = []
     for i in range(0, sub.shape[0], 1):
         tmp_df = sub.iloc[i]
@@ -435,20 +1511,56 @@ def convert2df(sub, file):
 
 def load_dct():
     # simstring
-    db_path = (os.path.join(os.path.dirname(__file__), UMLS_DB_PATH))
-    simstring_db = simstring_cpp.reader(os.path.join(db_path, UMLS_DB_NAME))
-    simstring_db.measure = simstring_cpp.cosine
-    simstring_db.threshold = SEARCH_THRESHOLD
+    db_path = resource_dir()
+    simstring_db = SimstringReaderPool(os.path.join(db_path, UMLS_DB_NAME))
+    # update_db で追加された synonym
+    delta_db = None
+    if os.path.exists(os.path.join(db_path, UMLS_DELTA_DB_NAME)):
+        delta_db = SimstringReaderPool(os.path.join(db_path, UMLS_DELTA_DB_NAME))
     searcher = UmlsSearcherCpp('UMLS', simstring_db,
                                CharacterNgramFeatureExtractor(NGRAM),
-                               CosineMeasure())
+                               CosineMeasure(), delta_db)
     gc.collect()
     return searcher
 
 
-def test_value_set():
-    resource_path = (os.path.join(os.path.dirname(__file__), 'resource'))
-    test_df = pd.read_csv(os.path.join(resource_path, "test_value.csv"))
+# 検査値の上限・下限が欠損しているときの値
+LAB_VALUE_MAX = 10000000
+LAB_VALUE_MIN = -10000000
+
+
+def _lab_bound(value, default):
+    # 欠損の可能性がある
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+@functools.lru_cache(maxsize=65536)
+def _han_to_zen(string):
+    return mojimoji.han_to_zen(string)
+
+
+def _test_value_csv():
+    return os.path.join(resource_dir(), "test_value.csv")
+
+
+def _file_fingerprint(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def build_test_value_index():
+    """
+    test_value.csv から、検査名(全角)で (下限, 上限) を引く辞書を作る。同じ検査名が複数あるときは最初のものを使う。
+    :return: {検査名: (下限, 上限)}
+    """
+    import pandas as pd
+    test_df = pd.read_csv(_test_value_csv())
     names, upper, lower = [], [], []
     for x, y, z in zip(test_df["LOCAL_NAME"], test_df["上限"], test_df["下限"]):
         x = x.split("_")[0]
@@ -463,38 +1575,101 @@ def test_value_set():
     names.extend([x.lower() for x in ["Creatine Kinase"]])
     upper.extend([210])
     lower.extend([50])
-    # to DF
-    df = pd.DataFrame({"name": names, "上限": upper, "下限": lower})
-    df["name"] = [mojimoji.han_to_zen(x.replace(" ", "_")) for x in df["name"]]
+    names = [mojimoji.han_to_zen(x.replace(" ", "_")) for x in names]
     # 結合
-    test_df = test_df[["LOCAL_NAME", "上限", "下限"]].rename(columns={'LOCAL_NAME': "name"})
+    test_df = test_df[["LOCAL_NAME", "上限", "下限"]]
     test_df = test_df[~test_df.duplicated()]
-    return pd.concat([df, test_df])
+    names.extend(test_df["LOCAL_NAME"])
+    upper.extend(test_df["上限"])
+    lower.extend(test_df["下限"])
+    test_value_index = {}
+    for name, high, low in zip(names, upper, lower):
+        if name not in test_value_index:
+            test_value_index[name] = (_lab_bound(low, LAB_VALUE_MIN), _lab_bound(high, LAB_VALUE_MAX))
+    return test_value_index
 
 
-def lab_value_normalization(querys, test_value_df):
+def build_startup_artifact():
+    """
+    起動時に使う表(英語ストップワード、検査値の基準値)を resource/startup_tables.json に書き出す。
+    これがあれば起動時に pandas と sklearn を import しなくてよい。
+    """
+    artifact = {
+        'version': STARTUP_ARTIFACT_VERSION,
+        'test_value_csv': _file_fingerprint(_test_value_csv()),
+        'stop_words': sorted(_sklearn_stop_words()),
+        'test_value_index': build_test_value_index() if os.path.exists(_test_value_csv()) else None,
+    }
+    path = os.path.join(resource_dir(), STARTUP_ARTIFACT_NAME)
+    with open(path + '.tmp', mode='w', encoding='utf_8') as f:
+        json.dump(artifact, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+@functools.lru_cache(maxsize=1)
+def _read_startup_artifact(path, fingerprint):
+    try:
+        with open(path, mode='r', encoding='utf_8') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if artifact.get('version') != STARTUP_ARTIFACT_VERSION:
+        return None
+    return artifact
+
+
+def load_startup_artifact():
+    """startup_tables.json を読む。無い場合や壊れている場合は None"""
+    path = os.path.join(resource_dir(), STARTUP_ARTIFACT_NAME)
+    fingerprint = _file_fingerprint(path)
+    if fingerprint is None:
+        return None
+    return _read_startup_artifact(path, tuple(fingerprint))
+
+
+def test_value_set():
+    """
+    検査名(全角)で (下限, 上限) を引く辞書を返す。
+    startup_tables.json が test_value.csv と同じ内容を持っていればそれを使い、無ければ test_value.csv から作る。
+    :return: {検査名: (下限, 上限)}
+    """
+    artifact = load_startup_artifact()
+    if artifact is not None and artifact.get('test_value_index') is not None \
+            and artifact.get('test_value_csv') == _file_fingerprint(_test_value_csv()):
+        return {name: tuple(bounds) for name, bounds in artifact['test_value_index'].items()}
+    return build_test_value_index()
+
+
+def lab_value_normalization(querys, test_value_index):
     """
     queryの第一項目が検査を表す文字列であり、第二項目が数値の場合に、
     その値を検査値の標準範囲と比較して、標準範囲を超えている場合には 検査項目に"_high"、標準範囲を下回る場合は検査項目に"_low"を付与する。
     querys の順番は保証されないが、querys は基本的に並列関係になっているものと想定しているので順番が変更されても問題がないと考える。
     :param querys:
-    :param test_value_df:
+    :param test_value_index: test_value_set() の結果
     :return:
     """
     norm_querys = []
 
     querys = [q.lower().replace("\u3000", " ") for q in querys]
 
-    # 1) 合成されていない query には何もしない
-    simple_querys = [q for q in querys if len(q.split(' ')) < 2]
-    for query in simple_querys:
-        norm_querys.append(query)
-    querys = [q for q in querys if q not in simple_querys]
+    # query ごとに 1)〜4) のどの処理を行うかを一度だけ判定して振り分ける
+    compound_querys, bp_querys, lab_querys = [], [], []
+    for query in querys:
+        tokens = query.split(' ')
+        if len(tokens) < 2:
+            # 1) 合成されていない query には何もしない
+            norm_querys.append(query)
+        elif not tokens[1].replace('.', '', 1).isdigit():
+            compound_querys.append((query, tokens))
+        elif tokens[0] == '血圧':
+            bp_querys.append((query, tokens))
+        else:
+            lab_querys.append((query, tokens))
 
     # 2) value が非数値の場合
-    simple_querys = [q for q in querys if not q.split(' ')[1].replace('.', '', 1).isdigit()]
-    for query in simple_querys:
-        test_name, test_value = query.split(' ')[:2]
+    for query, tokens in compound_querys:
+        test_name, test_value = tokens[:2]
         # 数値ではなく文字で書かれている場合
         if test_value.find("高値") != -1:
             norm_querys.append(test_name + "_high")
@@ -503,15 +1678,12 @@ def lab_value_normalization(querys, test_value_df):
             norm_querys.append(test_name + "_low")
         else:
             norm_querys.append(query)
-    querys = [q for q in querys if q not in simple_querys]
 
-    # 3) 血圧の処理: 別途処理　-> 血圧query とそれ以外に分割する
-    bp_querys = [q for q in querys if q.split(' ')[0] == '血圧']
-    bp_cnt, bp_flags = 0, []
-    for query in bp_querys:
-        # 血圧の処理: 別途処理
+    # 3) 血圧の処理: 別途処理
+    bp_flags = []
+    for bp_cnt, (query, tokens) in enumerate(bp_querys):
         # 最初が収縮時血圧、最後が拡張機血圧だと信じます
-        value = float(query.split(" ")[1])
+        value = float(tokens[1])
         if bp_cnt == 0 and value < 120:
             bp_flags.append(0)
         elif bp_cnt == 0 and value >= 120:
@@ -520,57 +1692,66 @@ def lab_value_normalization(querys, test_value_df):
             bp_flags.append(0)
         else:
             bp_flags.append(1)
-        bp_cnt += 1
-        if len(bp_querys) == bp_cnt:  # bp_querys の最後の処理
-            # 全部チェックして異常値が無ければ normal
-            if np.array(bp_flags).sum() == 0:
-                norm_querys.append("血圧_normal")
-            else:
-                norm_querys.append("血圧_high")
-                norm_querys.append("blood_pressure_abnormal")
-    querys = [q for q in querys if q not in bp_querys]
+    if len(bp_querys) > 0:
+        # 全部チェックして異常値が無ければ normal
+        if sum(bp_flags) == 0:
+            norm_querys.append("血圧_normal")
+        else:
+            norm_querys.append("血圧_high")
+            norm_querys.append("blood_pressure_abnormal")
 
     # 4) 上記以外
-    for query in querys:
-        # print(query)
+    for query, tokens in lab_querys:
         # 検査値かの確認
-        if mojimoji.han_to_zen(query.split(" ")[0]) not in test_value_df["name"].tolist():
+        test_name = _han_to_zen(tokens[0])
+        reference = test_value_index.get(test_name)
+        if reference is None:
+            norm_querys.append(query)
+            continue
+        try:
+            test_value = float(tokens[1])
+        # それ以外は弾く
+        except ValueError:
             norm_querys.append(query)
+            continue
+        low, high = reference
+        test_name = mojimoji.zen_to_han(test_name)
+        if test_value > high:
+            norm_querys.append(test_name + "_high")
+        elif test_value < low:
+            norm_querys.append(test_name + "_low")
         else:
-            try:
-                test_name, test_value =\
-                    query.split(" ")[0], float(query.split(" ")[1])
-            # それ以外は弾く
-            except:
-                norm_querys.append(query)
-                continue
-            test_name = mojimoji.han_to_zen(test_name)
-            tmp_df = test_value_df[test_value_df["name"] == test_name]
-            if tmp_df.shape[0] > 0:
-                test_name = mojimoji.zen_to_han(test_name)
-                # 欠損の可能性がある
-                try:
-                    high = float(tmp_df["上限"].iloc[0])
-                except:
-                    high = 10000000
-                try:
-                    low = float(tmp_df["下限"].iloc[0])
-                except:
-                    low = -10000000
-                if test_value > high:
-                    norm_querys.append(test_name + "_high")
-                elif test_value < low:
-                    norm_querys.append(test_name + "_low")
-                else:
-                    norm_querys.append(test_name + "_normal")
-            else:
-                norm_querys.append(query)
+            norm_querys.append(test_name + "_normal")
     return norm_querys
 
 
+def lab_value_normalization_many(querys_list, test_value_index):
+    """
+    span ごとの querys をまとめて正規化する(検査結果の文書全体の事前正規化用)。
+    同じ querys は一度だけ処理し、残りは span ごとに lab_value_normalization を呼ぶ。
+    検査値の基準値は検査名で引く辞書なので、まとめて引いても速くならない(時間がかかるのは文字列の処理)。
+    :param querys_list: querys のリスト
+    :param test_value_index: test_value_set() の結果
+    :return: querys_list と同じ順の norm_querys のリスト
+    """
+    normalized = {}
+    results = []
+    for querys in querys_list:
+        key = tuple(querys)
+        if key not in normalized:
+            normalized[key] = lab_value_normalization(querys, test_value_index)
+        results.append(list(normalized[key]))
+    return results
+
+
+STARTUP_TIMINGS['import_text2umls'] = time.perf_counter() - _import_started_at
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--init_db', action='store_true', help='initialize database')
+    parser.add_argument('--update_db', nargs='?', const='', default=None, metavar='UMLS_SYNONYMS_TXT',
+                        help='apply only the rows changed in UMLS_synonyms.txt (default: resource/UMLS_synonyms.txt)')
 #    parser.add_argument('--resource_version', type=str, default=None, help='init_dbする際のリソースバージョンを指定する')
     args = parser.parse_args()
 #    if args.resource_version is not None:
@@ -582,4 +1763,3 @@ if __name__ == "__main__":
     except Exception as e:
         print("Failed to create standard dictionary.", e.args, file=sys.stderr)
         sys.exit(1)
-
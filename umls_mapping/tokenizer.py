@@ -0,0 +1,75 @@
+import queue
+import threading
+import contextlib
+from umls_mapping.cache import LRUCache
+
+
+# 部分一致検索に使う品詞
+CONTENT_POS = ('名詞', '動詞', '形容詞')
+# MeCab の BOS/EOS ノード
+MECAB_BOS_NODE = 2
+MECAB_EOS_NODE = 3
+
+
+class TaggerPool(object):
+    """
+    MeCab.Tagger をプロセス内で使い回すためのプール。
+    Tagger の生成は辞書の読み込みを伴うので一度だけにする。1 つの Tagger を同時に使うのは 1 スレッドだけ。
+    """
+    def __init__(self, maxsize=8, tagger_args=''):
+        self.tagger_args = tagger_args
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def _create(self):
+        import MeCab
+        return MeCab.Tagger(self.tagger_args)
+
+    @contextlib.contextmanager
+    def tagger(self):
+        with self._slots:
+            try:
+                tagger = self._idle.get_nowait()
+            except queue.Empty:
+                tagger = self._create()
+            try:
+                yield tagger
+            finally:
+                self._idle.put(tagger)
+
+
+class ContentWordTokenizer(object):
+    """
+    query を形態素解析して内容語(名詞・動詞・形容詞)の表層形を返す。結果は query 単位でキャッシュする。
+    """
+    def __init__(self, pool=None, cache_size=16384):
+        self.pool = pool if pool is not None else TaggerPool()
+        self.cache = LRUCache(cache_size)
+
+    def content_words(self, query):
+        words = self.cache.get(query)
+        if words is None:
+            words = tuple(self._parse(query))
+            self.cache.put(query, words)
+        return words
+
+    def _parse(self, query):
+        with self.pool.tagger() as tagger:
+            node = tagger.parseToNode(query)
+            while node:
+                if node.stat not in (MECAB_BOS_NODE, MECAB_EOS_NODE):
+                    if node.feature.split(',', 1)[0] in CONTENT_POS:
+                        yield node.surface
+                node = node.next
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = ContentWordTokenizer()
+        return _tokenizer
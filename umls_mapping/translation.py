@@ -0,0 +1,336 @@
+import os
+import csv
+import time
+import hashlib
+import threading
+import sqlite3 as sqlite
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from umls_mapping.cache import LRUCache
+from umls_mapping.instrumentation import get_instrumentation
+
+
+TRANSLATION_CACHE_DB_NAME = 'translation_cache.db'
+TRANSLATION_DICT_NAME = 'translation_dict.tsv'
+
+# 翻訳に失敗した語は、この時間(秒)は backend に問い合わせずに失敗として返す
+FAILURE_CACHE_SECONDS = 60.0
+# backend への問い合わせが続けて BREAKER_FAILURES 語失敗したら、BREAKER_SECONDS 秒は backend に問い合わせない
+# (翻訳サービスが落ちている間、検索のたびにタイムアウトまで待たないように)
+BREAKER_FAILURES = 3
+BREAKER_SECONDS = 30.0
+
+# 訳語は backend.version ごとに持つ(backend を替えたり対訳辞書を書き換えたりしたら古い訳語は使わない)
+CREATE_CACHE_TABLE_COMMAND = """CREATE TABLE IF NOT EXISTS backend_translations (
+  backend VARCHAR(64),
+  src VARCHAR(8),
+  dest VARCHAR(8),
+  source TEXT,
+  translation TEXT,
+  PRIMARY KEY (backend, src, dest, source)
+);"""
+
+
+class TranslationError(Exception):
+    pass
+
+
+class TranslatorBackend(object):
+    """
+    翻訳バックエンドの基底クラス。
+    translate() は訳語の文字列を返す。訳語が無ければ None を返し、翻訳に失敗したときは TranslationError を投げる。
+    version は訳語のキャッシュのキーに使う(訳語が変わりうる変更をしたら変える)
+    """
+    name = 'base'
+
+    @property
+    def version(self):
+        return self.name
+
+    def translate(self, text, src='ja', dest='en', timeout=None):
+        raise NotImplementedError()
+
+    def translate_many(self, texts, src='ja', dest='en', timeout=None):
+        """
+        texts をまとめて翻訳する。既定では 1 つずつ translate() を呼ぶ。
+        :return: ({text: 訳語または None}, {text: 翻訳に失敗したときの例外})
+        """
+        translations, errors = {}, {}
+        for text in texts:
+            try:
+                translations[text] = self.translate(text, src=src, dest=dest, timeout=timeout)
+            except (TranslationError, ConnectionError) as e:
+                errors[text] = e
+        return translations, errors
+
+    def close(self):
+        pass
+
+
+class NullTranslatorBackend(TranslatorBackend):
+    """翻訳しない(英語検索を行わない)"""
+    name = 'none'
+
+    def translate(self, text, src='ja', dest='en', timeout=None):
+        return None
+
+
+class DictionaryTranslatorBackend(TranslatorBackend):
+    """
+    ローカルの対訳辞書(TSV: 原文<TAB>訳文)で翻訳する。ネットワークが無い環境向け。
+    """
+    name = 'dictionary'
+
+    def __init__(self, dict_path):
+        self.dict_path = dict_path
+        self.entries = {}
+        self.digest = None
+        if os.path.exists(dict_path):
+            with open(dict_path, mode='rb') as f:
+                content = f.read()
+            self.digest = hashlib.md5(content).hexdigest()[:12]
+            for row in csv.reader(content.decode('utf_8').splitlines(), delimiter='\t'):
+                if len(row) < 2 or row[0].startswith('#'):
+                    continue
+                self.entries.setdefault(row[0].lower(), row[1])
+
+    @property
+    def version(self):
+        # 対訳辞書を書き換えたら、前の辞書の訳語はキャッシュから引かない
+        return '%s:%s' % (self.name, self.digest)
+
+    def translate(self, text, src='ja', dest='en', timeout=None):
+        return self.entries.get(text)
+
+
+class GoogleTranslatorBackend(TranslatorBackend):
+    """
+    googletrans による翻訳。
+    googletrans はたまに失敗するので、失敗したら Translator を作り直して再試行する。
+    再試行は timeout 秒の予算内に限り、予算を使い切ったら TranslationError を投げる。
+    :param request_timeout: 1 回の HTTP リクエストのタイムアウト(秒)。None なら googletrans の既定値
+    """
+    name = 'google'
+
+    def __init__(self, service_urls=('translate.googleapis.com',), retries=5, request_timeout=None):
+        self.service_urls = list(service_urls)
+        self.retries = retries
+        self.request_timeout = request_timeout
+        self._translator = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        # translate_many で複数の語を同時に翻訳する(各語の translate() は _executor を使う)
+        self._batch_executor = ThreadPoolExecutor(max_workers=4)
+
+    def _get_translator(self):
+        # Translator は使い回すので、呼び出しごとに減っていく予算ではなく設定されたタイムアウトで作る
+        # (予算は translate() の future.result で守る)
+        with self._lock:
+            if self._translator is None:
+                import httpx
+                from googletrans import Translator
+                self._translator = Translator(service_urls=self.service_urls,
+                                              timeout=httpx.Timeout(self.request_timeout)
+                                              if self.request_timeout is not None else None)
+            return self._translator
+
+    def _reset_translator(self):
+        with self._lock:
+            self._translator = None
+
+    def translate(self, text, src='ja', dest='en', timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        error = None
+        for attempt in range(self.retries):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            if attempt > 0:
+                get_instrumentation().count('translation_retries')
+            translator = self._get_translator()
+            future = self._executor.submit(translator.translate, text, src=src, dest=dest)
+            try:
+                return future.result(timeout=remaining).text
+            except FutureTimeoutError:
+                get_instrumentation().count('translation_timeouts')
+                error = TranslationError('translation timed out after %.1f sec: %s' % (timeout, text))
+                break
+            except Exception as e:
+                error = e
+                self._reset_translator()
+        raise TranslationError(str(error) if error is not None else 'translation timed out: %s' % text)
+
+    def _translate_until(self, text, src, dest, deadline):
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            get_instrumentation().count('translation_timeouts')
+            raise TranslationError('translation timed out: %s' % text)
+        return self.translate(text, src=src, dest=dest, timeout=remaining)
+
+    def translate_many(self, texts, src='ja', dest='en', timeout=None):
+        # timeout はまとめて翻訳する全体の予算(語の数が多くても timeout 秒を超えて待たない)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        futures = [(text, self._batch_executor.submit(self._translate_until, text, src, dest, deadline))
+                   for text in texts]
+        translations, errors = {}, {}
+        for text, future in futures:
+            try:
+                translations[text] = future.result()
+            except (TranslationError, ConnectionError) as e:
+                errors[text] = e
+        return translations, errors
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._batch_executor.shutdown(wait=False)
+
+
+class CachedTranslator(object):
+    """
+    翻訳結果を SQLite(umls_synonyms.db と同じディレクトリの translation_cache.db)に保存して再利用する。
+    キャッシュにない語だけ backend に問い合わせる。
+    失敗した語は FAILURE_CACHE_SECONDS 秒覚えておき、失敗が BREAKER_FAILURES 語続いたら
+    BREAKER_SECONDS 秒は backend に問い合わせずに失敗として返す(翻訳サービスが落ちていても検索を待たせない)。
+    """
+    def __init__(self, backend, cache_path=None, timeout=None, memory_cache_size=4096):
+        self.backend = backend
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.memory_cache = LRUCache(memory_cache_size)
+        # 失敗した語 -> 再び問い合わせてよい時刻
+        self.failures = LRUCache(memory_cache_size)
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+        self._connection = None
+        if cache_path is not None:
+            try:
+                self._connection = sqlite.connect(cache_path, check_same_thread=False)
+                self._connection.execute(CREATE_CACHE_TABLE_COMMAND)
+                self._connection.commit()
+            except sqlite.Error:
+                # 書き込めない場所ではメモリ上のキャッシュだけを使う
+                self._connection = None
+
+    def _key(self, src, dest, text):
+        return self.backend.version, src, dest, text
+
+    def translate(self, text, src='ja', dest='en'):
+        translations, errors = self.translate_many([text], src=src, dest=dest)
+        if text in errors:
+            raise errors[text]
+        return translations[text]
+
+    def translate_many(self, texts, src='ja', dest='en'):
+        """
+        texts をまとめて翻訳する。キャッシュはまとめて引き、キャッシュにない語だけをまとめて backend に問い合わせる。
+        :return: ({text: 訳語または None}, {text: 翻訳に失敗したときの例外})
+        """
+        translations = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            translation = self.memory_cache.get(self._key(src, dest, text))
+            if translation is not None:
+                translations[text] = translation
+            else:
+                missing.append(text)
+        stored = self._load_many(src, dest, missing)
+        requests = [text for text in missing if text not in stored]
+        requests, errors = self._skip_failing(src, dest, requests)
+        get_instrumentation().count('translation_requests', len(requests))
+        translated, failed = self.backend.translate_many(requests, src=src, dest=dest, timeout=self.timeout) \
+            if requests else ({}, {})
+        self._record_failures(src, dest, requests, failed)
+        errors.update(failed)
+        self._store_many(src, dest, [(text, translation) for text, translation in translated.items()
+                                     if translation is not None])
+        for text in missing:
+            translation = stored.get(text, translated.get(text))
+            if translation is not None:
+                self.memory_cache.put(self._key(src, dest, text), translation)
+            if text not in errors:
+                translations[text] = translation
+        return translations, errors
+
+    def _skip_failing(self, src, dest, requests):
+        """
+        最近失敗した語と、backend への問い合わせを止めている間の語を requests から除く
+        :return: (問い合わせる語, {問い合わせない語: TranslationError})
+        """
+        now = time.monotonic()
+        with self._lock:
+            breaker_open = now < self._open_until
+        if breaker_open:
+            get_instrumentation().count('translation_skipped', len(requests))
+            return [], {text: TranslationError('translation backend is unavailable: %s' % text) for text in requests}
+        kept, errors = [], {}
+        for text in requests:
+            retry_at = self.failures.get(self._key(src, dest, text))
+            if retry_at is not None and now < retry_at:
+                errors[text] = TranslationError('translation failed recently: %s' % text)
+            else:
+                kept.append(text)
+        if errors:
+            get_instrumentation().count('translation_skipped', len(errors))
+        return kept, errors
+
+    def _record_failures(self, src, dest, requests, errors):
+        if len(requests) == 0:
+            return
+        now = time.monotonic()
+        for text in errors:
+            self.failures.put(self._key(src, dest, text), now + FAILURE_CACHE_SECONDS)
+        with self._lock:
+            if len(errors) < len(requests):
+                # 1 語でも翻訳できれば backend は動いている
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += len(errors)
+            if self._consecutive_failures >= BREAKER_FAILURES:
+                self._consecutive_failures = 0
+                self._open_until = now + BREAKER_SECONDS
+
+    def _load_many(self, src, dest, texts):
+        if self._connection is None or len(texts) == 0:
+            return {}
+        found = {}
+        with self._lock:
+            # sqlite のプレースホルダ上限(古い sqlite は 999)を超えないように分ける
+            for start in range(0, len(texts), 500):
+                chunk = texts[start:start + 500]
+                found.update(self._connection.execute(
+                    'SELECT source, translation FROM backend_translations'
+                    ' WHERE backend = ? AND src = ? AND dest = ? AND source IN (%s)'
+                    % ','.join(['?'] * len(chunk)), [self.backend.version, src, dest] + chunk).fetchall())
+        return found
+
+    def _store_many(self, src, dest, translations):
+        if self._connection is None or len(translations) == 0:
+            return
+        with self._lock:
+            try:
+                self._connection.executemany('INSERT OR REPLACE INTO backend_translations VALUES (?, ?, ?, ?, ?)',
+                                             [(self.backend.version, src, dest, text, translation)
+                                              for text, translation in translations])
+                self._connection.commit()
+            except sqlite.Error:
+                pass
+
+    def close(self):
+        self.backend.close()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def make_translator(backend_name, resource_path, timeout=None):
+    if backend_name == 'google':
+        backend = GoogleTranslatorBackend(request_timeout=timeout)
+    elif backend_name == 'dictionary':
+        backend = DictionaryTranslatorBackend(os.path.join(resource_path, TRANSLATION_DICT_NAME))
+    elif backend_name == 'none':
+        backend = NullTranslatorBackend()
+    else:
+        raise ValueError('unknown translator backend: %s' % backend_name)
+    return CachedTranslator(backend, os.path.join(resource_path, TRANSLATION_CACHE_DB_NAME), timeout)
@@ -1,43 +1,267 @@
 import sys
+import atexit
 import mojimoji
 import os
 import re
-import pandas as pd
 import time
+import threading
+import contextlib
 from umls_mapping import text2umls as tu
+from umls_mapping import brat_ann
+from umls_mapping.cache import LRUCache
+from umls_mapping.prefetch import DocumentPrefetcher
 
 
 class UmlsMapper(object):
+    """
+    brat の検索ダイアログから使う。複数のスレッドから同時に呼んでよい。
+    searcher は読み出し専用の索引と、接続・reader のプールからなり、リソースが作り直されたら新しい searcher に差し替える。
+    古い searcher は、それを使っている検索が全て終わってから閉じる。
+    """
     __instance = None
     mrc_dct_jpn = None
     mrc_dct_eng = None
     m_dict = None
     rezepen_dct = None
     db_jpn = None
-    test_value_df = None
+    test_value_index = None
+    searcher = None
+    # word2umls の結果キャッシュ
+    RESULT_CACHE_SIZE = 4096
+    # リソース DB の作り直しを確認する間隔(秒)
+    RESOURCE_CHECK_INTERVAL = 1.0
+    result_cache = None
+    # 文書を開いたときに全 span の候補を先読みしておく(prefetch)
+    prefetcher = None
+    resource_version = None
+    resource_checked_at = 0.0
+    # 使用中の searcher と、それを使っている検索の数
+    _in_use = {}
+    _lock = threading.Lock()
+    _init_lock = threading.Lock()
+    _reload_lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
-        if cls.__instance is None:
-            cls.__instance = super(UmlsMapper, cls).__new__(cls)
-            cls.searcher = tu.load_dct()
-            cls.test_value_df = tu.test_value_set()
+        with cls._init_lock:
+            if cls.__instance is None:
+                cls._initialize()
+                cls.__instance = super(UmlsMapper, cls).__new__(cls)
         return cls.__instance
 
     @classmethod
-    def word2umls(cls, collection, document, annotation_id, query_string='', database='UMLS'):
+    def _initialize(cls):
+        start = time.perf_counter()
+        cls.searcher = tu.load_dct()
+        tu.STARTUP_TIMINGS['load_dct'] = time.perf_counter() - start
+        start = time.perf_counter()
+        cls.test_value_index = tu.test_value_set()
+        tu.STARTUP_TIMINGS['test_value_set'] = time.perf_counter() - start
+        cls.result_cache = LRUCache(cls.RESULT_CACHE_SIZE)
+        cls.prefetcher = DocumentPrefetcher(cls._prefetch_lookup)
+        cls.resource_version = tu.resource_fingerprint()
+        cls.resource_checked_at = time.monotonic()
+        # サーバ終了時に umls_synonyms.db への接続を閉じる
+        atexit.register(cls.close)
+
+    @classmethod
+    def word2umls(cls, collection, document, annotation_id, query_string='', database='UMLS', semantic_types=None,
+                  fuzzy=False):
+        """
+        :param semantic_types: 検索する SemanticType の集合。None なら annotation_id のエンティティタイプから
+                               tu.ENTITY_SEMANTIC_TYPES で決める(設定が無ければ全ての SemanticType を検索する)
+        :param fuzzy: True なら synonym に完全一致しても近似文字列検索する(先読みした候補も使わない)
+        """
         # query_string は小文字に正規化しておく
         query_string = query_string.lower()
 
-        if query_string != '':
-            query_string = tu.lab_value_normalization([query_string], cls.test_value_df)[0]
-            querys = [query_string]
-        else:
+        if query_string == '':
             return []
+        cls._check_resource()
+        ann_path = cls.ann_path(collection, document)
+        if ann_path is not None and not fuzzy:
+            prefetched = cls.prefetcher.get(ann_path, database, annotation_id, query_string,
+                                            frozenset(semantic_types) if semantic_types else None)
+            if prefetched is not None:
+                return prefetched
+        if semantic_types is None:
+            semantic_types = tu.semantic_types_for_entity(cls.entity_type(collection, document, annotation_id))
+        semantic_types = frozenset(semantic_types) if semantic_types else None
+        cache_key = (query_string, database, semantic_types, fuzzy)
+        cached = cls.result_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        query_string = tu.lab_value_normalization([query_string], cls.test_value_index)[0]
+        querys = [query_string]
         # querys_eng = tu.translate_Google(querys)
 
-        scored_concept = tu.word2UMLS(querys, cls.searcher, database)
+        untranslated = set()
+        with cls._lease() as searcher:
+            scored_concept = tu.word2UMLS_many([querys], searcher, database, semantic_types, fuzzy, untranslated)[0]
+            # 翻訳に失敗した結果は英語の候補を欠くので、キャッシュせずに翻訳サービスが戻ったら検索し直す
+            if len(untranslated) == 0:
+                cls._cache_result(searcher, cache_key, scored_concept)
         return scored_concept
 
+    @classmethod
+    def word2umls_many(cls, query_strings, database='UMLS', semantic_types=None, fuzzy=False):
+        """
+        複数の span の文字列をまとめて検索する(一括処理用)。同じ文字列・同じ訳語は一度だけ処理する。
+        :param semantic_types: 検索する SemanticType の集合(None なら全て)
+        :param fuzzy: True なら synonym に完全一致しても近似文字列検索する
+        :return: query_strings と同じ順の word2umls の結果
+        """
+        return cls._word2umls_many(query_strings, database, semantic_types, fuzzy)[0]
+
+    @classmethod
+    def _prefetch_lookup(cls, query_strings, database, semantic_types):
+        """先読み用の word2umls_many。翻訳に失敗した span は None にして先読みの候補に入れない"""
+        results, untranslated = cls._word2umls_many(query_strings, database, semantic_types)
+        return [None if i in untranslated else scored_concept for i, scored_concept in enumerate(results)]
+
+    @classmethod
+    def _word2umls_many(cls, query_strings, database='UMLS', semantic_types=None, fuzzy=False):
+        """
+        :return: (word2umls_many の結果, 翻訳に失敗した span の番号(query_strings の添字)の集合)
+        """
+        cls._check_resource()
+        semantic_types = frozenset(semantic_types) if semantic_types else None
+        query_strings = [query_string.lower() for query_string in query_strings]
+        results = {'': []}
+        missing = []
+        for query_string in dict.fromkeys(query_strings):
+            if query_string in results:
+                continue
+            cached = cls.result_cache.get((query_string, database, semantic_types, fuzzy))
+            if cached is not None:
+                results[query_string] = list(cached)
+            else:
+                missing.append(query_string)
+        # word2umls と同じく、検査値の正規化の結果は最初の 1 つだけを使う
+        querys_list = [querys[:1] for querys in
+                       tu.lab_value_normalization_many([[query_string] for query_string in missing], cls.test_value_index)]
+        untranslated = set()
+        with cls._lease() as searcher:
+            scored_concepts = tu.word2UMLS_many(querys_list, searcher, database, semantic_types, fuzzy, untranslated)
+            for i, (query_string, scored_concept) in enumerate(zip(missing, scored_concepts)):
+                if i not in untranslated:
+                    cls._cache_result(searcher, (query_string, database, semantic_types, fuzzy), scored_concept)
+                results[query_string] = scored_concept
+        untranslated = set(missing[i] for i in untranslated)
+        return ([list(results[query_string]) for query_string in query_strings],
+                set(i for i, query_string in enumerate(query_strings) if query_string in untranslated))
+
+    @staticmethod
+    def ann_path(collection, document):
+        """brat の文書の .ann のパス(brat の外から呼ばれて分からなければ None)"""
+        if collection is None or document is None:
+            return None
+        try:
+            # brat の server/src にある
+            from document import real_directory
+        except ImportError:
+            return None
+        return os.path.join(real_directory(collection), document + '.ann')
+
+    @classmethod
+    def entity_type(cls, collection, document, annotation_id):
+        """brat の文書の annotation_id の text-bound annotation のエンティティタイプ(分からなければ None)"""
+        if not tu.ENTITY_SEMANTIC_TYPES or not annotation_id:
+            return None
+        ann_path = cls.ann_path(collection, document)
+        if ann_path is None:
+            return None
+        text_bound = brat_ann.find_text_bound(ann_path, annotation_id)
+        return text_bound.type if text_bound is not None else None
+
+    @classmethod
+    def prefetch(cls, collection, document, database='UMLS'):
+        """
+        文書の全ての text-bound annotation の候補を裏で検索しておく。brat で文書を開いたときに呼ぶ。
+        :return: 新たに検索する span の数
+        """
+        cls._check_resource()
+        ann_path = cls.ann_path(collection, document)
+        if ann_path is None:
+            return 0
+        return cls.prefetcher.prefetch(ann_path, database)
+
+    @classmethod
+    @contextlib.contextmanager
+    def _lease(cls):
+        """今の searcher を借りる。差し替えられた古い searcher は、最後に借りていた検索が返したときに閉じる"""
+        with cls._lock:
+            searcher = cls.searcher
+            cls._in_use[searcher] = cls._in_use.get(searcher, 0) + 1
+        try:
+            yield searcher
+        finally:
+            with cls._lock:
+                cls._in_use[searcher] -= 1
+                retired = cls._in_use[searcher] == 0 and searcher is not cls.searcher
+                if cls._in_use[searcher] == 0:
+                    del cls._in_use[searcher]
+            if retired:
+                searcher.close()
+
+    @classmethod
+    def _cache_result(cls, searcher, cache_key, scored_concept):
+        # 検索中に searcher が差し替えられた場合は、古いリソースの結果なのでキャッシュしない
+        with cls._lock:
+            if searcher is cls.searcher:
+                cls.result_cache.put(cache_key, tuple(scored_concept))
+
+    @classmethod
+    def _check_resource(cls):
+        """init_db でリソース DB が作り直されていたら、searcher を開き直してキャッシュを捨てる"""
+        now = time.monotonic()
+        if now - cls.resource_checked_at < cls.RESOURCE_CHECK_INTERVAL:
+            return
+        # 他のスレッドが確認している間は、今の searcher のまま検索する
+        if not cls._reload_lock.acquire(blocking=False):
+            return
+        try:
+            cls.resource_checked_at = now
+            version = tu.resource_fingerprint()
+            if version == cls.resource_version:
+                return
+            searcher = tu.load_dct()
+            with cls._lock:
+                old_searcher, cls.searcher = cls.searcher, searcher
+                cls.resource_version = version
+                cls.result_cache.clear()
+                cls.prefetcher.clear()
+                idle = old_searcher not in cls._in_use
+            if idle:
+                old_searcher.close()
+        finally:
+            cls._reload_lock.release()
+
+    @classmethod
+    def cache_stats(cls):
+        return cls.result_cache.stats()
+
+    @classmethod
+    def prefetch_stats(cls):
+        return cls.prefetcher.stats()
+
+    @classmethod
+    def build_profile(cls):
+        """リソースを作った build profile (convert_umls2simstring.py --profile) の名前と件数"""
+        return tu.read_build_profile()
+
+    @classmethod
+    def startup_report(cls):
+        """起動にかかった時間(秒)の内訳"""
+        return dict(tu.STARTUP_TIMINGS)
+
+    @classmethod
+    def close(cls):
+        if cls.prefetcher is not None:
+            cls.prefetcher.close()
+        if cls.searcher is not None:
+            cls.searcher.close()
+
 
 if __name__ == '__main__':
     UmlsMapper()
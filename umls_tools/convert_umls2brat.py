@@ -1,6 +1,10 @@
 import argparse
 import os
 import csv
+import sys
+import time
+import resource
+import itertools
 import jaconv
 
 # データ行の最後に'|' が入っているので、'|'でスプリットした最後は必ず''になる。（''が一つ余計に入る)
@@ -13,6 +17,103 @@ MRDEFF_DEF = 5
 MRSTY_STY = 3
 
 
+def iter_cui_groups(path):
+    """
+    CUI 順に並んだ RRF を CUI ごとにまとめて (cui, [行, ...]) を返す。メモリに載るのは 1 つの CUI の行だけ。
+    CUI 順に並んでいなければ ValueError
+    """
+    prev_cui = ''
+    with open(path, mode='r', encoding='utf_8') as sf:
+        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
+        for cui, records in itertools.groupby(reader, key=lambda ws: ws[CUI]):
+            if cui <= prev_cui:
+                raise ValueError('{} is not sorted by CUI: {} after {}'.format(path, cui, prev_cui))
+            prev_cui = cui
+            yield cui, list(records)
+
+
+class CuiCursor(object):
+    """
+    CUI 順に並んだ RRF を、MRCONSO.RRF の CUI に合わせて読み進める(MRDEF.RRF, MRSTY.RRF 用)
+    """
+    def __init__(self, path):
+        self.groups = iter_cui_groups(path)
+        self.cui, self.records = next(self.groups, (None, []))
+        self.n_cuis = 0
+
+    def take(self, cui):
+        """
+        cui の行を返す(無ければ [])。cui より前の CUI の行は読み捨てる
+        """
+        while self.cui is not None and self.cui < cui:
+            self._advance()
+        if self.cui != cui:
+            return []
+        records = self.records
+        self._advance()
+        return records
+
+    def _advance(self):
+        self.n_cuis += 1
+        self.cui, self.records = next(self.groups, (None, []))
+
+    def close(self):
+        # 読み残した CUI も数えておく
+        while self.cui is not None:
+            self._advance()
+        self.groups.close()
+
+
+def cui_names(records):
+    """1 つの CUI の MRCONSO の行から、TARGET_LANG ごとの表記を出現順に(重複なしで)返す"""
+    names = {lang: [] for lang in TARGET_LANG}
+    seen = {lang: set() for lang in TARGET_LANG}
+    for ws in records:
+        lang = ws[MRCONS_LANG]
+        if lang not in TARGET_LANG:
+            continue
+        tmp = ws[MRCONS_STR]
+        if lang == 'JPN':
+            # 日本語の半角文字(半角カナは全角に揃えておく)
+            tmp = jaconv.h2z(tmp, digit=False, ascii=False)
+            # 日本語の全角英数文字は半角英数文字に揃えておく
+            tmp = jaconv.z2h(tmp, kana=False, digit=True, ascii=True)
+        if tmp not in seen[lang]:
+            seen[lang].add(tmp)
+            names[lang].append(tmp)
+    return names
+
+
+def cui_definition(records):
+    """
+    1 つの CUI の MRDEF の行から定義を 1 つ選ぶ(無ければ None)。
+    TODO: 仮実装、とりあえず最初に見つかったソースの定義を採用している(同じソースが複数あれば最後の行)
+    """
+    definitions = {}
+    for ws in records:
+        definitions[ws[MRDEFF_SRC]] = ws[MRDEFF_DEF]
+    if len(definitions) == 0:
+        return None
+    return list(definitions.values())[0]
+
+
+def brat_line(cui, names, semantic_types, definition):
+    """brat の normdb (UMLS.txt) の 1 行"""
+    line = [cui]
+    for lang in TARGET_LANG:
+        line += ['name:Synonym:' + s for s in names[lang]]
+    line += ['attr:SemanticType:' + s for s in semantic_types]
+    if definition is not None:
+        # definition に \t が入っていることがある。\t -> ' ' に変換しておく
+        line.append('info:Definition:' + definition.replace('\t', ' '))
+    return '\t'.join(line) + '\n'
+
+
+def peak_rss_mb():
+    # ru_maxrss は Linux では KB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
 if __name__ == '__main__':
     # 引数を処理する
     file_body = os.path.splitext(os.path.basename(__file__))[0]
@@ -23,82 +124,32 @@ if __name__ == '__main__':
     parse.add_argument('--sty_source', type=str, default='MRSTY.RRF')
     args = parse.parse_args()
 
-    # "CUI-表記"辞書の作成
-    cui_dict = {}
-    with open(os.path.join(args.data_root, args.concept_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in cui_dict:
-                # if len(cui_dict) >= 10:
-                #     break
-                cui_dict[cui] = {'JPN': [], 'ENG': []}
-            if ws[MRCONS_LANG] in TARGET_LANG:
-                tmp = ws[MRCONS_STR]
-                if ws[MRCONS_LANG] == 'JPN':
-                    # 日本語の半角文字(半角カナは全角に揃えておく)
-                    tmp = jaconv.h2z(tmp, digit=False, ascii=False)
-                    # 日本語の全角英数文字は半角英数文字に揃えておく
-                    tmp = jaconv.z2h(tmp, kana=False, digit=True, ascii=True)
-                if tmp not in cui_dict[cui][ws[MRCONS_LANG]]:
-                    cui_dict[cui][ws[MRCONS_LANG]].append(tmp)
-
-    # "CUI-DEF"辞書の作成
-    def_dict = {}
-    with open(os.path.join(args.data_root, args.def_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in def_dict:
-                # if len(def_dict) >= 10:
-                #     break
-                def_dict[cui] = {}
-            def_dict[cui][ws[MRDEFF_SRC]] = ws[MRDEFF_DEF]
-    # 定義が空のデータが存在しないことを確認する
-    assert len([k for k, v in def_dict.items() if len(v) == 0]) == 0,\
-        'non defined: {}'.format([k for k, v in def_dict.items() if len(v) == 0])
-    # assert len(cui_dict) == len(def_dict),\
-    #     'len(cui_dict) not match len(def_dict): {}, {}'.format(len(cui_dict), len(def_dict))
-
-    # "CUI-Semantic_Types"辞書の作成
-    sty_dict = {}
-    with open(os.path.join(args.data_root, args.sty_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in sty_dict:
-                # if len(sty_dict) >= 10:
-                #    break
-                sty_dict[cui] = []
-            sty_dict[cui].append(ws[MRSTY_STY])
-    # Semantic typeが空のデータが存在しないことを確認する
-    assert len([k for k, v in sty_dict.items() if len(v) == 0]) == 0,\
-        'non defined: {}'.format([k for k, v in sty_dict.items() if len(v) == 0])
-    # assert len(cui_dict) == len(sty_dict),\
-    #     'len(cui_dict) not match len(sem_dict): {}, {}'.format(len(cui_dict), len(sty_dict))
-
-    print('len(cui_dict)\t{}\tlen(def_dict)\t{}\tlen(sty_dict)\t{}'.format(len(cui_dict), len(def_dict), len(sty_dict)))
+    start_time = time.time()
     # ファイル出力
     out_dir = os.path.join(os.getcwd(), 'ext_tools','umls_tools','resource')
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    max_len = len(cui_dict)
-    cnt = 0
+    # MRCONSO.RRF, MRDEF.RRF, MRSTY.RRF はどれも CUI 順に並んでいるので、MRCONSO.RRF の CUI ごとに
+    # MRDEF.RRF と MRSTY.RRF を読み進めて突き合わせ、揃った CUI から 1 行ずつ出力する
+    definitions = CuiCursor(os.path.join(args.data_root, args.def_source))
+    semantic_types = CuiCursor(os.path.join(args.data_root, args.sty_source))
+    n_cuis, n_defs, n_stys = 0, 0, 0
     with open(os.path.join(out_dir, 'UMLS.txt'), mode='w', encoding='utf_8', newline='\n') as of:
-        for k, v in cui_dict.items():
-            line = [k]
-            for lang in TARGET_LANG:
-                line += ['name:Synonym:' + s for s in cui_dict[k][lang]]
-            if k in sty_dict:
-                line += ['attr:SemanticType:' + s for s in sty_dict[k]]
-            if k in def_dict:
-                # TODO: 仮実装、とりあえず最初に見つかった定義を採用している
-                # definition に \t が入っていることがある。\t -> ' ' に変換しておく
-                line.append('info:Definition:' + list(def_dict[k].values())[0].replace('\t', ' '))
-            of.write('\t'.join(line) + '\n')
-            of.flush()
-            cnt += 1
-            if cnt % 10000 == 0:
-                print('{}/{}'.format(cnt, max_len))
+        for cui, records in iter_cui_groups(os.path.join(args.data_root, args.concept_source)):
+            definition = cui_definition(definitions.take(cui))
+            stys = [ws[MRSTY_STY] for ws in semantic_types.take(cui)]
+            n_defs += definition is not None
+            n_stys += len(stys) > 0
+            of.write(brat_line(cui, cui_names(records), stys, definition))
+            n_cuis += 1
+            if n_cuis % 10000 == 0:
+                print('{} cuis, {:.1f} sec'.format(n_cuis, time.time() - start_time))
+    definitions.close()
+    semantic_types.close()
 
+    print('len(cui_dict)\t{}\tlen(def_dict)\t{}\tlen(sty_dict)\t{}'.format(n_cuis, definitions.n_cuis,
+                                                                          semantic_types.n_cuis))
+    print('cuis with definition\t{}\tcuis with SemanticType\t{}'.format(n_defs, n_stys))
+    print('{:.1f} sec, peak RSS {:.1f} MB'.format(time.time() - start_time, peak_rss_mb()))
     print('end of process.')
+    sys.exit(0)
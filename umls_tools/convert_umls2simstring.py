@@ -1,16 +1,26 @@
 import argparse
 import os
+import io
 import csv
+import json
 import jaconv
 import re
 import sys
+import time
+import resource
+import itertools
+import collections
+import multiprocessing
 sys.path.append('./server/src/')
-from umls_mapping.text2umls import is_harf
+from umls_mapping.text2umls import is_harf, BUILD_PROFILE_NAME
 
 # データ行の最後に'|' が入っているので、'|'でスプリットした最後は必ず''になる。（''が一つ余計に入る)
 CUI = 0
 MRCONS_LANG = 1
+MRCONS_SAB = 11
+MRCONS_TTY = 12
 MRCONS_STR = 14
+MRCONS_SUPPRESS = 16
 TARGET_LANG = ['JPN', 'ENG']
 TARGET_LANG_EXT = ['JPN_p', 'ENG_p', 'JPN', 'ENG']
 MRDEFF_SRC = 4
@@ -18,6 +28,192 @@ MRDEFF_DEF = 5
 MRSTY_STY = 3
 TERM_STATUS = 2
 
+# MRCONSO.RRF を分割するときの 1 区間の最大サイズ(byte)
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+# worker 1 つあたり、同時に投げておく(結果待ちを含む)区間の数。
+# メモリに載るのは最大で workers * IN_FLIGHT_PER_WORKER + 1 区間分(区間の文字列と行)で、ファイルの大きさによらない
+IN_FLIGHT_PER_WORKER = 2
+
+# 検索用の辞書に入れる文字列を絞り込む設定(--profile で選ぶ。--profile_file の JSON で追加・上書きできる)
+#   sabs           : 残すソース(SAB)
+#   ttys           : 残す term type(TTY)
+#   suppress       : 残す SUPPRESS の値('N' は抑制されていないもの)
+#   semantic_types : 残す CUI の SemanticType(どれか 1 つでも含めば残す)
+#   max_length     : synonym の最大文字数
+# 書かなかった項目では絞り込まない
+BUILD_PROFILES = {
+    'full': {},
+    'clinical': {
+        'sabs': ['MDRJPN', 'MSHJPN', 'MDR', 'MSH', 'SNOMEDCT_US', 'ICD10CM', 'LNC', 'RXNORM', 'NCI'],
+        'suppress': ['N'],
+        'max_length': 60,
+    },
+}
+PROFILE_KEYS = ['sabs', 'ttys', 'suppress', 'semantic_types', 'max_length']
+
+
+def load_profile(name, profile_file=None):
+    """
+    name の profile を返す。項目のリストは set にする
+    :return: {項目: 値}
+    """
+    profiles = dict(BUILD_PROFILES)
+    if profile_file is not None:
+        with open(profile_file, mode='r', encoding='utf_8') as f:
+            profiles.update(json.load(f))
+    if name not in profiles:
+        raise ValueError('unknown profile: {} (choose from {})'.format(name, ', '.join(sorted(profiles))))
+    profile = {}
+    for key, value in profiles[name].items():
+        if key not in PROFILE_KEYS:
+            raise ValueError('profile {}: unknown key {} (choose from {})'.format(name, key, ', '.join(PROFILE_KEYS)))
+        profile[key] = value if key == 'max_length' else frozenset(value)
+    return profile
+
+
+def keep_record(ws, profile):
+    """MRCONSO の行が profile の SAB, TTY, SUPPRESS の条件を満たすか"""
+    if 'sabs' in profile and ws[MRCONS_SAB] not in profile['sabs']:
+        return False
+    if 'ttys' in profile and ws[MRCONS_TTY] not in profile['ttys']:
+        return False
+    if 'suppress' in profile and ws[MRCONS_SUPPRESS] not in profile['suppress']:
+        return False
+    return True
+
+
+def cui_aligned_ranges(path, n_chunks):
+    """
+    path をおよそ n_chunks 個のバイト区間に分ける。
+    MRCONSO.RRF は CUI ごとにまとまっているので、同じ CUI の行が 2 つの区間にまたがらないように境界をずらす。
+    :return: [(start, end), ...]
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, mode='rb') as f:
+        for i in range(1, n_chunks):
+            f.seek(max(size * i // n_chunks, offsets[-1]))
+            # 行の途中から読み始めないように、読み始めの行は捨てる
+            f.readline()
+            line = f.readline()
+            if not line:
+                break
+            cui = line.split(b'|', 1)[0]
+            # 同じ CUI の行を読み飛ばし、次の CUI の先頭を境界にする
+            while True:
+                line_start = f.tell()
+                line = f.readline()
+                if not line or line.split(b'|', 1)[0] != cui:
+                    break
+            if offsets[-1] < line_start < size:
+                offsets.append(line_start)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+
+
+def cui_synonyms(records, profile=None):
+    """
+    1 つの CUI の MRCONSO の行から、出力する (synonym, representative) を出力順に返す。
+    :param profile: load_profile() の結果。SAB, TTY, SUPPRESS, 文字数で絞り込む(SemanticType は呼び出し側で絞る)
+    """
+    synonyms = {key: [] for key in TARGET_LANG_EXT}
+    synonyms_rep = {key: [] for key in TARGET_LANG_EXT}
+    seen = {key: set() for key in TARGET_LANG_EXT}
+    for ws in records:
+        # TARGET_LANG の文字列だけを処理する
+        if ws[MRCONS_LANG] not in TARGET_LANG:
+            continue
+        if profile and not keep_record(ws, profile):
+            continue
+        tmp = ws[MRCONS_STR]
+        preferred = ws[TERM_STATUS]
+        ext = ''
+        if preferred == 'P' or preferred == 'p':
+            ext = '_p'
+        lang = ws[MRCONS_LANG]+ext
+        if ws[MRCONS_LANG] == 'JPN':
+            if is_harf(tmp):
+                # 日本語で全部半角の文字列は読み仮名。読み仮名は simstring の key から除外する
+                continue
+                # 日本語の半角文字(半角カナは全角に揃えておく)
+                # tmp = jaconv.h2z(tmp, digit=False, ascii=False)
+            # 日本語の全角英数文字は半角英数文字(lower)に揃えておく
+            tmp = jaconv.z2h(tmp, kana=False, digit=True, ascii=True)
+        # 英数文字は lower に揃える。";" の有無による違いは無視する。
+        tmp_rep = tmp.replace(';', ' ')
+        # 連続するスペースは一つのスペースにする
+        tmp_rep = re.sub(r' (2,)', ' ', tmp_rep)
+        tmp = tmp_rep.lower()
+        if profile and 'max_length' in profile and len(tmp) > profile['max_length']:
+            continue
+        if tmp not in seen[lang]:
+            seen[lang].add(tmp)
+            synonyms[lang].append(tmp)
+            synonyms_rep[lang].append(tmp_rep)
+
+    # 代表表記は 日本語(推奨) > 日本語 > 英語(推奨) > 英語 の順に選ぶ
+    representative = ''
+    for lang in (TARGET_LANG_EXT[0], TARGET_LANG_EXT[2], TARGET_LANG_EXT[1], TARGET_LANG_EXT[3]):
+        if len(synonyms_rep[lang]) > 0:
+            representative = synonyms_rep[lang][0]
+            break
+    return [(s, representative) for lang in TARGET_LANG_EXT for s in synonyms[lang]]
+
+
+def convert_range(task):
+    """
+    MRCONSO.RRF の [start, end) を処理して (行数, [(cui, synonym, representative), ...], 絞り込まない場合の件数) を返す。
+    絞り込まない場合の件数は (synonym の数, CUI の数)
+    """
+    path, start, end, profile = task
+    with open(path, mode='rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf_8')
+    n_lines = 0
+    rows = []
+    full_rows, full_cuis = 0, 0
+    reader = csv.reader(io.StringIO(text), delimiter='|', lineterminator='\n')
+    for cui, records in itertools.groupby(reader, key=lambda ws: ws[CUI]):
+        records = list(records)
+        n_lines += len(records)
+        synonyms = cui_synonyms(records, profile)
+        for synonym, representative in synonyms:
+            rows.append((cui, synonym, representative))
+        # profile で絞り込んだ場合は、絞り込まない場合の件数も数えておく(削減率の報告用)
+        n_full = len(cui_synonyms(records)) if profile else len(synonyms)
+        full_rows += n_full
+        full_cuis += n_full > 0
+    return n_lines, rows, (full_rows, full_cuis)
+
+
+def imap_bounded(pool, func, tasks, window):
+    """
+    pool.imap と同じく tasks の順に func(task) の結果を返す。ただし同時に投げておく task は window 個まで。
+    (imap は全ての task を一度に投げるので、書き出しが追いつかないと結果をいくらでも溜め込む)
+    """
+    tasks = iter(tasks)
+    pending = collections.deque(pool.apply_async(func, (task,)) for task in itertools.islice(tasks, window))
+    while pending:
+        result = pending.popleft().get()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+        yield result
+
+
+def iter_semantic_types(path):
+    """MRSTY.RRF を CUI ごとにまとめて (cui, 'SemanticType/SemanticType/...') を返す"""
+    with open(path, mode='r', encoding='utf_8') as sf:
+        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
+        for cui, records in itertools.groupby(reader, key=lambda ws: ws[CUI]):
+            yield cui, '/'.join([ws[MRSTY_STY] for ws in records])
+
+
+def peak_rss_mb():
+    # ru_maxrss は Linux では KB 単位
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage_self / 1024.0, usage_children / 1024.0
+
 
 if __name__ == '__main__':
     # 引数を処理する
@@ -25,114 +221,78 @@ if __name__ == '__main__':
     parse = argparse.ArgumentParser(description=file_body)
     parse.add_argument('--data_root', type=str, help='path to directory which contains MRCONSO.RRF, MRDEF.RRF, and MRSTY.RRF (for example, "./UMLS/2019AB/META")', required=True)
     parse.add_argument('--concept_source', type=str, default='MRCONSO.RRF')
+    # MRDEF.RRF は出力に使わない(互換性のため引数だけ残している)
     parse.add_argument('--def_source', type=str, default='MRDEF.RRF')
     parse.add_argument('--sty_source', type=str, default='MRSTY.RRF')
     parse.add_argument('--output_dir', type=str, default='resource')
+    parse.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parse.add_argument('--profile', type=str, default='full', help='build profile in BUILD_PROFILES (or --profile_file)')
+    parse.add_argument('--profile_file', type=str, default=None, help='JSON file of additional build profiles {name: {...}}')
     args = parse.parse_args()
 
-    # "CUI-表記"辞書の作成
-    cui_dict = {}
-    cui_dict_rep = {}
-    with open(os.path.join(args.data_root, args.concept_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in cui_dict:
-                # if len(cui_dict) >= 10:
-                #     break
-                cui_dict[cui] = {}
-                cui_dict_rep[cui] = {}
-                for key in TARGET_LANG_EXT:
-                    cui_dict[cui][key] = []
-                    cui_dict_rep[cui][key] = []
-            # TARGET_LANG の文字列だけを処理する
-            if ws[MRCONS_LANG] in TARGET_LANG:
-                tmp = ws[MRCONS_STR]
-                preferred = ws[TERM_STATUS]
-                ext = ''
-                if preferred == 'P' or preferred == 'p':
-                    ext = '_p'
-                lang = ws[MRCONS_LANG]+ext
-                if ws[MRCONS_LANG] == 'JPN':
-                    if is_harf(tmp):
-                        # 日本語で全部半角の文字列は読み仮名。読み仮名は simstring の key から除外する
-                        continue
-                        # 日本語の半角文字(半角カナは全角に揃えておく)
-                        # tmp = jaconv.h2z(tmp, digit=False, ascii=False)
-                    # 日本語の全角英数文字は半角英数文字(lower)に揃えておく
-                    tmp = jaconv.z2h(tmp, kana=False, digit=True, ascii=True)
-                # 英数文字は lower に揃える。";" の有無による違いは無視する。
-                tmp_rep = tmp.replace(';', ' ')
-                # 連続するスペースは一つのスペースにする
-                tmp_rep = re.sub(r' (2,)', ' ', tmp_rep)
-                tmp = tmp_rep.lower()
-                if tmp not in cui_dict[cui][lang]:
-                    cui_dict[cui][lang].append(tmp)
-                    cui_dict_rep[cui][lang].append(tmp_rep)
-
-    # "CUI-DEF"辞書の作成
-    def_dict = {}
-    with open(os.path.join(args.data_root, args.def_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in def_dict:
-                # if len(def_dict) >= 10:
-                #     break
-                def_dict[cui] = {}
-            def_dict[cui][ws[MRDEFF_SRC]] = ws[MRDEFF_DEF]
-    # 定義が空のデータが存在しないことを確認する
-    assert len([k for k, v in def_dict.items() if len(v) == 0]) == 0,\
-        'non defined: {}'.format([k for k, v in def_dict.items() if len(v) == 0])
-    # assert len(cui_dict) == len(def_dict),\
-    #     'len(cui_dict) not match len(def_dict): {}, {}'.format(len(cui_dict), len(def_dict))
-
-    # "CUI-Semantic_Types"辞書の作成
-    sty_dict = {}
-    with open(os.path.join(args.data_root, args.sty_source), mode='r', encoding='utf_8') as sf:
-        reader = csv.reader(sf, delimiter='|', lineterminator='\n')
-        for ws in reader:
-            cui = ws[CUI]
-            if cui not in sty_dict:
-                # if len(sty_dict) >= 10:
-                #    break
-                sty_dict[cui] = []
-            sty_dict[cui].append(ws[MRSTY_STY])
-    # Semantic typeが空のデータが存在しないことを確認する
-    assert len([k for k, v in sty_dict.items() if len(v) == 0]) == 0,\
-        'non defined: {}'.format([k for k, v in sty_dict.items() if len(v) == 0])
-    # assert len(cui_dict) == len(sty_dict),\
-    #     'len(cui_dict) not match len(sem_dict): {}, {}'.format(len(cui_dict), len(sty_dict))
-
-    print('len(cui_dict)\t{}\tlen(def_dict)\t{}\tlen(sty_dict)\t{}'.format(len(cui_dict), len(def_dict), len(sty_dict)))
+    profile = load_profile(args.profile, args.profile_file)
+    start_time = time.time()
+    concept_path = os.path.join(args.data_root, args.concept_source)
+    n_chunks = max(args.workers * 4, os.path.getsize(concept_path) // MAX_CHUNK_BYTES + 1)
+    tasks = [(concept_path, start, end, profile) for start, end in cui_aligned_ranges(concept_path, n_chunks)]
+
     # ファイル出力
     work_dir = os.path.dirname(os.path.dirname(os.getcwd()))
     resource_dir = os.path.join(work_dir, 'server/src/umls_mapping', args.output_dir)
-    max_len = len(cui_dict)
-    cnt = 0
-    with open(os.path.join(resource_dir, 'UMLS_synonyms.txt'), mode='w', encoding='utf_8', newline='\n') as of:
+    n_lines, n_rows, n_cuis = 0, 0, 0
+    full_rows, full_cuis = 0, 0
+    prev_cui = ''
+    kept_cui = False
+    # MRCONSO.RRF と MRSTY.RRF はどちらも CUI 順に並んでいるので、突き合わせながら出力する
+    semantic_types = iter_semantic_types(os.path.join(args.data_root, args.sty_source))
+    sty_cui, sty = next(semantic_types, (None, ''))
+    synonyms_path = os.path.join(resource_dir, 'UMLS_synonyms.txt')
+    with open(synonyms_path, mode='w', encoding='utf_8', newline='\n') as of, \
+            multiprocessing.Pool(processes=args.workers) as pool:
         writer = csv.writer(of, delimiter='\t', lineterminator='\n', quoting=csv.QUOTE_ALL)
         writer.writerow(['cui', 'SemanticType', 'synonym', 'representative'])
-        for k in cui_dict:
-            if len(cui_dict_rep[k][TARGET_LANG_EXT[0]]) > 0:
-                representative = cui_dict_rep[k][TARGET_LANG_EXT[0]][0]
-            elif len(cui_dict[k][TARGET_LANG_EXT[2]]) > 0:
-                representative_rep = cui_dict_rep[k][TARGET_LANG_EXT[2]][0]
-            elif len(cui_dict_rep[k][TARGET_LANG_EXT[1]]) > 0:
-                representative = cui_dict_rep[k][TARGET_LANG_EXT[1]][0]
-            elif len(cui_dict[k][TARGET_LANG_EXT[3]]) > 0:
-                representative_rep = cui_dict_rep[k][TARGET_LANG_EXT[3]][0]
-            else:
-                representative = ''
-            for lang in TARGET_LANG_EXT:
-                for s in cui_dict[k][lang]:
-                    line = [k, '/'.join(sty_dict[k]), s, representative]
-                    # line += [s for s in cui_dict[k][lang]]
-                    writer.writerow(line)
-            of.flush()
-            cnt += 1
-            if cnt % 10000 == 0:
-                print('{}/{}'.format(cnt, max_len))
+        # 区間の順に結果を受け取るので、出力の順番は MRCONSO.RRF と同じになる
+        results = imap_bounded(pool, convert_range, tasks, args.workers * IN_FLIGHT_PER_WORKER)
+        for chunk_lines, rows, (chunk_full_rows, chunk_full_cuis) in results:
+            for cui, synonym, representative in rows:
+                if cui != prev_cui:
+                    if cui < prev_cui:
+                        raise ValueError('{} is not sorted by CUI: {} after {}'.format(args.concept_source, cui, prev_cui))
+                    prev_cui = cui
+                    while sty_cui is not None and sty_cui < cui:
+                        sty_cui, sty = next(semantic_types, (None, ''))
+                    # SemanticType での絞り込みは CUI 単位
+                    kept_cui = 'semantic_types' not in profile or \
+                        (sty_cui == cui and not profile['semantic_types'].isdisjoint(sty.split('/')))
+                    n_cuis += kept_cui
+                if not kept_cui:
+                    continue
+                writer.writerow([cui, sty if sty_cui == cui else '', synonym, representative])
+                n_rows += 1
+            n_lines += chunk_lines
+            full_rows += chunk_full_rows
+            full_cuis += chunk_full_cuis
+            elapsed = time.time() - start_time
+            print('{} lines, {} rows, {:.0f} lines/sec'.format(n_lines, n_rows, n_lines / max(elapsed, 1e-6)))
 
+    elapsed = time.time() - start_time
+    rss_self, rss_children = peak_rss_mb()
+    print('cuis\t{}\trows\t{}\tlines\t{}'.format(n_cuis, n_rows, n_lines))
+    # 使った profile と、絞り込まない場合(full)との比較を UMLS_synonyms.txt と一緒に書く。
+    # text2umls.py --init_db が umls_synonyms.db に記録する
+    st = os.stat(synonyms_path)
+    build_profile = {
+        'profile': args.profile,
+        'filters': {key: value if key == 'max_length' else sorted(value) for key, value in profile.items()},
+        'rows': n_rows, 'cuis': n_cuis, 'full_rows': full_rows, 'full_cuis': full_cuis,
+        'synonyms_file': [st.st_mtime_ns, st.st_size],
+    }
+    with open(os.path.join(resource_dir, BUILD_PROFILE_NAME), mode='w', encoding='utf_8') as f:
+        json.dump(build_profile, f, ensure_ascii=False, indent=1)
+    print('profile {}: rows {}/{} ({:.1f}%), cuis {}/{} ({:.1f}%), UMLS_synonyms.txt {:.1f} MB'.format(
+        args.profile, n_rows, full_rows, 100.0 * n_rows / max(full_rows, 1), n_cuis, full_cuis,
+        100.0 * n_cuis / max(full_cuis, 1), st.st_size / 1024.0 / 1024.0))
+    print('{:.1f} sec, {:.0f} lines/sec, {:.0f} rows/sec, peak RSS {:.1f} MB (workers {:.1f} MB)'.format(
+        elapsed, n_lines / max(elapsed, 1e-6), n_rows / max(elapsed, 1e-6), rss_self, rss_children))
     print('end of process.')
     sys.exit(0)